@@ -13,6 +13,7 @@ import pyvips
 logging.getLogger('pyvips').setLevel(logging.WARNING)
 
 import boto3
+from botocore.exceptions import ClientError
 
 import requests
 logging.getLogger('requests').setLevel(logging.INFO)
@@ -31,7 +32,14 @@ else:
   ).client('s3')
 
 def exists(key):
-  return s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=key)['KeyCount'] > 0
+  # HEAD matches the exact key, a prefix listing also matched longer keys starting with it
+  try:
+    s3.head_object(Bucket=BUCKET_NAME, Key=key)
+    return True
+  except ClientError as ex:
+    if ex.response['Error']['Code'] in ('404', 'NoSuchKey'):
+      return False
+    raise
 
 def download_image(url):
   logger.info(f'download_image: url={url}')
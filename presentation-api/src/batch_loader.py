@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import asyncio
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from urllib.parse import quote
+
+import http_client
+from deadline import Deadline, DeadlineExceeded
+from executors import io_executor
+
+BATCH_WINDOW = float(os.environ.get('BATCH_WINDOW', 0.005)) # seconds lookups are collected before a batch is sent
+WIKIBASE_MAX_IDS = 50                                        # wbgetentities limit for anonymous clients
+SPARQL_MAX_VALUES = 200
+
+class _Batch(object):
+  __slots__ = ('keys', 'deadline', 'claimed')
+
+  def __init__(self, keys, deadline):
+    self.keys = keys
+    self.deadline = deadline
+    self.claimed = False
+
+def _consume(future):
+  # errors of batches nobody waits on any more are not logged as never retrieved
+  if not future.cancelled():
+    future.exception()
+
+class BatchLoader(object):
+  '''Collects keys requested by concurrent builds over a short window and loads them with one upstream call.
+  load_batch(keys, deadline) returns a dict of key to value, keys missing from the dict resolve to None.'''
+
+  def __init__(self, name, load_batch, max_batch=WIKIBASE_MAX_IDS, window=BATCH_WINDOW):
+    self.name = name
+    self.load_batch = load_batch
+    self.max_batch = max_batch
+    self.window = window
+    self.lock = threading.Lock()
+    self.futures = {}   # key -> Future, for keys queued or in flight
+    self.queued = []    # keys waiting for the next batch
+    self.deadlines = []
+    self.timer = None
+    self.batches = 0
+    self.keys = 0
+    self.coalesced = 0
+
+  def _enqueue(self, key, deadline):
+    with self.lock:
+      future = self.futures.get(key)
+      if future is not None and not future.cancelled():
+        self.coalesced += 1
+        return future
+      future = self.futures[key] = Future()
+      future.batch = None
+      self.queued.append(key)
+      self.deadlines.append(deadline)
+      if len(self.queued) >= self.max_batch:
+        self._flush_locked()
+      elif self.timer is None:
+        self.timer = threading.Timer(self.window, self._flush)
+        self.timer.daemon = True
+        self.timer.start()
+      return future
+
+  def _flush(self):
+    with self.lock:
+      self._flush_locked()
+
+  def _flush_locked(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    if not self.queued:
+      return
+    batch = _Batch(self.queued, self._batch_deadline(self.deadlines))
+    self.queued, self.deadlines = [], []
+    for key in batch.keys:
+      self.futures[key].batch = batch
+    io_executor.submit(self._run, batch)
+
+  def _run(self, batch):
+    # a batch is run once, by an io worker or by a blocked caller that got to it first
+    with self.lock:
+      if batch.claimed:
+        return
+      batch.claimed = True
+    self._dispatch(batch.keys, batch.deadline)
+
+  @staticmethod
+  def _batch_deadline(deadlines):
+    # the batch is given the longest budget of its callers, each caller still stops waiting at its own deadline
+    if any(deadline is None for deadline in deadlines):
+      return None
+    return Deadline(max(deadline.remaining() for deadline in deadlines))
+
+  def _dispatch(self, keys, deadline):
+    with self.lock:
+      self.batches += 1
+      self.keys += len(keys)
+    logger.debug(f'batch_loader: name={self.name} keys={len(keys)}')
+    try:
+      results = self.load_batch(keys, deadline) or {}
+      error = None
+    except Exception as exc:
+      results, error = {}, exc
+    with self.lock:
+      futures = [(key, self.futures.pop(key)) for key in keys]
+    for key, future in futures:
+      # a future cancelled by its waiter is skipped, running ones can no longer be cancelled
+      if future.done() or not future.set_running_or_notify_cancel():
+        continue
+      if error is not None:
+        future.set_exception(error)
+      else:
+        future.set_result(results.get(key))
+
+  def load(self, key, deadline=None):
+    return self.load_many([key], deadline).get(key)
+
+  def _result(self, future, deadline):
+    try:
+      return future.result(timeout=min(2 * self.window, deadline.remaining()) if deadline else 2 * self.window)
+    except FutureTimeout:
+      pass
+    # the batch is run in this thread when no io worker has picked it up, callers that block io workers
+    # could otherwise wait on batches queued behind themselves
+    if future.batch is None:
+      self._flush()
+    if future.batch is not None:
+      self._run(future.batch)
+    try:
+      return future.result(timeout=deadline.remaining() if deadline else None)
+    except FutureTimeout:
+      raise DeadlineExceeded(f'{self.name} batch lookup')
+
+  def load_many(self, keys, deadline=None):
+    futures = {key: self._enqueue(key, deadline) for key in keys}
+    return dict([(key, self._result(future, deadline)) for key, future in futures.items()])
+
+  async def aload(self, key, deadline=None):
+    return (await self.aload_many([key], deadline)).get(key)
+
+  async def aload_many(self, keys, deadline=None):
+    futures = {key: asyncio.wrap_future(self._enqueue(key, deadline)) for key in keys}
+    try:
+      # shielded, a caller running out of time stops waiting without cancelling keys other callers share
+      gathered = asyncio.gather(*futures.values())
+      gathered.add_done_callback(_consume)
+      values = await asyncio.wait_for(asyncio.shield(gathered), deadline.remaining() if deadline else None)
+    except asyncio.TimeoutError:
+      raise DeadlineExceeded(f'{self.name} batch lookup')
+    return dict(zip(futures.keys(), values))
+
+  def stats(self):
+    with self.lock:
+      return {'batches': self.batches, 'keys': self.keys, 'coalesced': self.coalesced}
+
+def _wbgetentities(api, ids, deadline, props=None):
+  entities = {}
+  for start in range(0, len(ids), WIKIBASE_MAX_IDS):
+    chunk = ids[start:start+WIKIBASE_MAX_IDS]
+    resp = http_client.get(f'{api}?action=wbgetentities&format=json&ids={quote("|".join(chunk))}{"&props="+props if props else ""}', deadline=deadline)
+    logger.debug(f'wbgetentities: api={api} ids={len(chunk)} status={resp.status_code}')
+    if resp.status_code == 200:
+      for eid, entity in resp.json().get('entities', {}).items():
+        if 'missing' not in entity:
+          entities[eid] = entity
+  return entities
+
+def _load_wd_entities(qids, deadline):
+  return _wbgetentities('https://www.wikidata.org/w/api.php', qids, deadline)
+
+def _load_wc_entities(pageids, deadline):
+  entities = _wbgetentities('https://commons.wikimedia.org/w/api.php', [f'M{pageid}' for pageid in pageids], deadline)
+  return {pageid: entities.get(f'M{pageid}') for pageid in pageids}
+
+def _load_wd_revisions(qids, deadline):
+  '''Current lastrevid of Wikidata entities, props=info leaves out claims, labels and sitelinks'''
+  entities = _wbgetentities('https://www.wikidata.org/w/api.php', qids, deadline, props='info')
+  return dict([(qid, str(entity['lastrevid'])) for qid, entity in entities.items() if 'lastrevid' in entity])
+
+def _normalize_title(title):
+  title = title.replace('_', ' ').strip()
+  return title[:1].upper() + title[1:]
+
+def _load_wc_entities_by_title(titles, deadline):
+  '''Commons MediaInfo entities looked up by file title, without first resolving the page id'''
+  entities = {}
+  for start in range(0, len(titles), WIKIBASE_MAX_IDS):
+    chunk = titles[start:start+WIKIBASE_MAX_IDS]
+    files = '|'.join([f'File:{title}' for title in chunk])
+    resp = http_client.get(f'https://commons.wikimedia.org/w/api.php?action=wbgetentities&format=json&sites=commonswiki&titles={quote(files)}', deadline=deadline)
+    if resp.status_code == 200:
+      for entity in resp.json().get('entities', {}).values():
+        if 'missing' not in entity and 'title' in entity:
+          entities[_normalize_title(entity['title'].split(':', 1)[-1])] = entity
+  return dict([(title, entities.get(_normalize_title(title))) for title in titles])
+
+def _load_wc_revisions(titles, deadline):
+  '''Current revision id of Commons file pages looked up by file title'''
+  revisions = {}
+  for start in range(0, len(titles), WIKIBASE_MAX_IDS):
+    chunk = titles[start:start+WIKIBASE_MAX_IDS]
+    files = '|'.join([f'File:{title}' for title in chunk])
+    resp = http_client.get(f'https://commons.wikimedia.org/w/api.php?action=query&format=json&prop=info&titles={quote(files)}', deadline=deadline)
+    if resp.status_code == 200:
+      for page in resp.json().get('query', {}).get('pages', {}).values():
+        if 'lastrevid' in page:
+          revisions[_normalize_title(page['title'].split(':', 1)[-1])] = str(page['lastrevid'])
+  return dict([(title, revisions.get(_normalize_title(title))) for title in titles])
+
+def _load_entity_labels(keys, deadline):
+  '''keys are (qid, lang) tuples, one SPARQL VALUES query is sent per language'''
+  by_lang = {}
+  for qid, lang in keys:
+    by_lang.setdefault(lang, []).append(qid)
+  labels = {}
+  for lang, qids in by_lang.items():
+    for start in range(0, len(qids), SPARQL_MAX_VALUES):
+      chunk = qids[start:start+SPARQL_MAX_VALUES]
+      values = ' '.join([f'(<http://www.wikidata.org/entity/{qid}>)' for qid in chunk])
+      query = f'SELECT ?item ?label WHERE {{ VALUES (?item) {{ {values} }} ?item rdfs:label ?label . FILTER (LANG(?label) = "{lang}" || LANG(?label) = "en") .}}'
+      resp = http_client.get(
+        f'https://query.wikidata.org/sparql?query={quote(query)}',
+        headers={'Content-Type': 'application/x-www-form-urlencoded', 'Accept': 'application/sparql-results+json'},
+        deadline=deadline
+      )
+      if resp.status_code == 200:
+        for rec in resp.json()['results']['bindings']:
+          labels[(rec['item']['value'].split('/')[-1], lang)] = rec['label']['value']
+  return labels
+
+wd_entity_loader = BatchLoader('wd_entities', _load_wd_entities)
+wc_entity_loader = BatchLoader('wc_entities', _load_wc_entities)
+wc_title_entity_loader = BatchLoader('wc_title_entities', _load_wc_entities_by_title)
+entity_label_loader = BatchLoader('entity_labels', _load_entity_labels, max_batch=SPARQL_MAX_VALUES)
+wd_revision_loader = BatchLoader('wd_revisions', _load_wd_revisions)
+wc_revision_loader = BatchLoader('wc_revisions', _load_wc_revisions)
+
+def stats():
+  return {loader.name: loader.stats() for loader in (wd_entity_loader, wc_entity_loader, wc_title_entity_loader, entity_label_loader, wd_revision_loader, wc_revision_loader)}
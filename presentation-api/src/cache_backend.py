@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+from time import time as now
+
+from expiringdict import ExpiringDict
+
+from shared_cache import SharedCache, SHARED_CACHE_DIR
+import redis_cache
+import snapshot
+
+# warm start entries for a cold process, a read-only last tier of the caches it covers
+_snapshot = snapshot.load()
+
+def _warm(tier, key, value, expires):
+  '''Copies an entry read from a slower tier, it expires when the copy it was read from does'''
+  if expires is None:
+    tier[key] = value
+  elif isinstance(tier, ExpiringDict):
+    # backdated, an entry older than the tier's max age is dropped at its next read
+    tier.__setitem__(key, value, set_time=min(now(), expires - tier.max_age))
+  elif hasattr(tier, 'put'):
+    tier.put(key, value, expires)
+  else:
+    tier[key] = value
+
+class TieredCache(object):
+  '''In-process cache in front of slower shared tiers, the node cache shared by the worker processes
+  and the distributed cache shared by all instances. Reads stop at the first tier holding the key
+  and copy it into the tiers before it with the time left on it, writes go to every tier.
+  Tiers behind local return (value, expires) from get_entry, expires is a unix time.'''
+
+  def __init__(self, local, *tiers):
+    self.local = local
+    self.tiers = (local,) + tiers
+
+  def get(self, key, default=None):
+    value = self.local.get(key)
+    if value is not None:
+      return value
+    for idx, tier in enumerate(self.tiers[1:], 1):
+      value, expires = tier.get_entry(key)
+      if value is not None:
+        for warmer in self.tiers[:idx]:
+          _warm(warmer, key, value, expires)
+        return value
+    return default
+
+  def __getitem__(self, key):
+    value = self.get(key)
+    if value is None:
+      raise KeyError(key)
+    return value
+
+  def __contains__(self, key):
+    return any(key in tier for tier in self.tiers)
+
+  def __setitem__(self, key, value):
+    for tier in self.tiers:
+      tier[key] = value
+
+  def update(self, items):
+    items = dict(items)
+    for key, value in items.items():
+      self.local[key] = value
+    for tier in self.tiers[1:]:
+      tier.update(items)
+
+  def pop(self, key, default=None):
+    values = [tier.pop(key, None) for tier in self.tiers]
+    return next((value for value in values if value is not None), default)
+
+  def __delitem__(self, key):
+    if self.pop(key) is None:
+      raise KeyError(key)
+
+  def __len__(self):
+    return len(self.local)
+
+  def stats(self):
+    stats = self.local.stats() if hasattr(self.local, 'stats') else {'entries': len(self.local)}
+    return dict(stats, tiers=[tier.stats() for tier in self.tiers[1:]])
+
+def make_cache(name, local, max_bytes, max_age_seconds=3600, distributed=False):
+  '''Puts the node shared tier, with distributed=True the Redis tier, and the warm start snapshot behind local.
+  Tiers that are disabled or unusable are left out, local is returned as is when none remain.'''
+  tiers = []
+  if SHARED_CACHE_DIR:
+    try:
+      tiers.append(SharedCache(name, max_bytes, max_age_seconds))
+    except Exception as exc:
+      logger.warning(f'cache_backend: shared cache {name} unavailable, using the in-process cache only: {exc}')
+  if distributed and redis_cache.client() is not None:
+    tiers.append(redis_cache.RedisCache(name, redis_cache.client(), max_bytes, max_age_seconds))
+  if _snapshot is not None and name in _snapshot.caches:
+    tiers.append(snapshot.SnapshotTier(_snapshot, name))
+  return TieredCache(local, *tiers) if tiers else local
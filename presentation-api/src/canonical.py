@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Canonical manifest ids. Variants of the same source item, spelled with spaces or underscores,
+percent-encoded or not, or given as a page or file url, map to one id and so to one cache key.
+
+  python canonical.py report [-p prefix]   duplicate keys in the manifest cache bucket
+'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import re
+import argparse
+import threading
+from urllib.parse import unquote
+
+from expiringdict import ExpiringDict
+from cache_backend import make_cache
+
+import handlers.github
+import handlers.wikimedia_commons
+
+MAX_TRACKED_VARIANTS = 10000
+
+# ids only known to be equivalent after a build, such as gh paths given without a file extension
+aliases = make_cache('manifest_aliases', ExpiringDict(max_len=10000, max_age_seconds=86400), 8 * 1024 * 1024, max_age_seconds=7 * 86400, distributed=True)
+
+def _unquote(sourceid):
+  # ids arrive encoded once, twice or not at all
+  while '%' in sourceid and unquote(sourceid) != sourceid:
+    sourceid = unquote(sourceid)
+  return sourceid
+
+def _wc(sourceid):
+  if sourceid.startswith('http'):
+    sourceid = _unquote(handlers.wikimedia_commons.Handler.sourceid_from_url(sourceid))
+  sourceid = re.sub(r'^(File|Image):', '', sourceid.strip(), flags=re.IGNORECASE)
+  # MediaWiki titles use underscores and spaces interchangeably and always capitalize the first letter
+  sourceid = re.sub(r'[ _]+', '_', sourceid).strip('_')
+  return sourceid[:1].upper() + sourceid[1:]
+
+def _gh(sourceid):
+  if sourceid.startswith('http'):
+    sourceid = handlers.github.Handler.sourceid_from_url(sourceid)
+  return '/'.join([elem for elem in sourceid.split('/') if elem])
+
+def _wd(sourceid):
+  return sourceid.strip().rstrip('/').split('/')[-1].upper()
+
+def _digits(sourceid):
+  return sourceid.strip().rstrip('/').split('/')[-1].split('_')[0]
+
+_normalizers = {
+  'wc': _wc,
+  'gh': _gh,
+  'wd': _wd,
+  'flickr': _digits,
+  'met': _digits
+}
+
+def normalize(mid):
+  '''mid with its sourceid spelled the one way each source accepts, learned aliases are not applied'''
+  source, sourceid = mid.split(':', 1) if ':' in mid else (None, mid)
+  normalizer = _normalizers.get(source)
+  return f'{source}:{normalizer(_unquote(sourceid))}' if normalizer else mid
+
+class CanonicalIds(object):
+  '''Maps manifest ids to canonical ids and counts the requests that arrived as a variant'''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.variants = {} # canonical id -> variants seen, for the most recently requested ids
+    self.requests = self.rewritten = self.aliased = 0
+
+  def canonical_id(self, mid, count=True):
+    '''The id mid is cached under, sourceids are returned unquoted as handlers expect them'''
+    canonical = normalize(mid)
+    alias = aliases.get(canonical)
+    if alias:
+      canonical = alias
+    if count:
+      self._count(mid, canonical, alias is not None)
+    return canonical
+
+  def _count(self, mid, canonical, aliased):
+    with self.lock:
+      self.requests += 1
+      self.aliased += int(aliased)
+      if mid == canonical:
+        return
+      self.rewritten += 1
+      variants = self.variants.pop(canonical, set())
+      variants.add(mid)
+      self.variants[canonical] = variants
+      if len(self.variants) > MAX_TRACKED_VARIANTS:
+        del self.variants[next(iter(self.variants))]
+
+  def learn(self, mid, resolved):
+    '''Records that mid was built as resolved, later requests for mid go straight to resolved'''
+    if resolved != mid and aliases.get(mid) != resolved:
+      logger.info(f'canonical: alias {mid} -> {resolved}')
+      aliases[mid] = resolved
+
+  def stats(self):
+    duplicated = sorted(self.variants.items(), key=lambda item: len(item[1]), reverse=True)[:10]
+    return {
+      'requests': self.requests,
+      'rewritten': self.rewritten,
+      'aliased': self.aliased,
+      'rewrite_ratio': round(self.rewritten / self.requests, 3) if self.requests else None,
+      'top_duplicates': dict([(canonical, len(variants)) for canonical, variants in duplicated])
+    }
+
+canonical_ids = CanonicalIds()
+
+def report(prefix=''):
+  '''Groups the keys in the manifest cache bucket by canonical id, every key past the first in a group was a separate build'''
+  from s3 import Bucket
+  groups = {}
+  for key in Bucket('iiif-manifest-cache').keys(prefix):
+    canonical = aliases.get(normalize(key)) or normalize(key)
+    groups.setdefault(canonical, []).append(key)
+  duplicates = dict([(canonical, keys) for canonical, keys in groups.items() if len(keys) > 1])
+  return {
+    'keys': sum([len(keys) for keys in groups.values()]),
+    'canonical_ids': len(groups),
+    'duplicate_keys': sum([len(keys) - 1 for keys in duplicates.values()]),
+    'duplicates': duplicates
+  }
+
+if __name__ == '__main__':
+  import json
+  logger.setLevel(logging.WARNING)
+  parser = argparse.ArgumentParser(description='Report manifest cache keys that share a canonical id')
+  parser.add_argument('command', choices=('report',))
+  parser.add_argument('-p', '--prefix', default='', help='key prefix, e.g. wc:')
+  args = parser.parse_args()
+  print(json.dumps(report(args.prefix), indent=2))
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+from time import monotonic
+
+REQUEST_BUDGET = float(os.environ.get('REQUEST_BUDGET', 25))       # seconds a request may spend upstream
+ENRICHMENT_BUDGET = float(os.environ.get('ENRICHMENT_BUDGET', 3))  # minimum left to attempt optional lookups
+
+class DeadlineExceeded(Exception):
+  pass
+
+class Deadline(object):
+
+  def __init__(self, budget=REQUEST_BUDGET):
+    self.budget = budget
+    self.expires = monotonic() + budget
+
+  def remaining(self):
+    return max(0.0, self.expires - monotonic())
+
+  @property
+  def expired(self):
+    return self.remaining() <= 0
+
+  def allows(self, seconds=ENRICHMENT_BUDGET):
+    return self.remaining() >= seconds
+
+  def timeout(self, connect, read):
+    remaining = self.remaining()
+    if remaining <= 0:
+      raise DeadlineExceeded(f'request budget of {self.budget}s exhausted')
+    return (min(connect, remaining), min(read, remaining))
+
+  def __repr__(self):
+    return f'Deadline(budget={self.budget}, remaining={round(self.remaining(),3)})'
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import asyncio
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+IO_WORKERS = int(os.environ.get('IO_WORKERS', 32))      # blocking network calls (S3, SQS, requests)
+MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS', 4)) # downloads probed with ffmpeg/PIL, CPU and memory heavy
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 2)) # work no reader waits on, e.g. rebuilding stale manifests
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='iiif-io')
+media_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix='iiif-media')
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix='iiif-background')
+_background = set()
+_background_lock = threading.Lock()
+
+async def _run(executor, fn, *args, **kwargs):
+  loop = asyncio.get_running_loop()
+  # run in a copy of the caller's context so request scoped context variables reach the worker thread
+  ctx = contextvars.copy_context()
+  return await loop.run_in_executor(executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+async def run_io(fn, *args, **kwargs):
+  return await _run(io_executor, fn, *args, **kwargs)
+
+async def run_media(fn, *args, **kwargs):
+  return await _run(media_executor, fn, *args, **kwargs)
+
+def run_background(key, fn, *args, **kwargs):
+  '''Runs fn off the request path, at most one run per key is scheduled at a time. Returns False if key already is.'''
+  with _background_lock:
+    if key in _background:
+      return False
+    _background.add(key)
+  def run():
+    try:
+      fn(*args, **kwargs)
+    except Exception:
+      logger.exception(f'background task failed: key={key}')
+    finally:
+      with _background_lock:
+        _background.discard(key)
+  background_executor.submit(run)
+  return True
+
+def stats():
+  return {
+    'io': {'workers': IO_WORKERS, 'queued': io_executor._work_queue.qsize()},
+    'media': {'workers': MEDIA_WORKERS, 'queued': media_executor._work_queue.qsize()},
+    'background': {'workers': BACKGROUND_WORKERS, 'queued': background_executor._work_queue.qsize(), 'scheduled': len(_background)}
+  }
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import asyncio
+import contextvars
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from deadline import DeadlineExceeded
+from executors import run_io
+
+# separate from the io executor, sync plans are often run from inside it
+plan_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('PLAN_WORKERS', 32)), thread_name_prefix='iiif-plan')
+
+class Step(object):
+
+  def __init__(self, name, fn, deps=(), afn=None, inline=False):
+    self.name = name
+    self.fn = fn     # called with the results of deps, in order
+    self.deps = tuple(deps)
+    self.afn = afn   # optional coroutine function used by arun, fn is run in the io executor otherwise
+    self.inline = inline # cheap steps that only reshape other results are called directly
+
+class FetchPlan(object):
+  '''Dependency graph of upstream fetches. Every step whose dependencies are met runs at once,
+  results are returned by step name, names starting with "_" are intermediate and left out.'''
+
+  def __init__(self, name):
+    self.name = name
+    self.steps = {}
+    self.timings = {}
+
+  def step(self, name, fn, *deps, afn=None, inline=False):
+    for dep in deps:
+      if dep not in self.steps:
+        raise ValueError(f'fetch plan {self.name}: step {name} depends on undeclared step {dep}')
+    self.steps[name] = Step(name, fn, deps, afn, inline)
+    return self
+
+  def _ready(self, done, started):
+    return [step for name, step in self.steps.items() if name not in started and all(dep in done for dep in step.deps)]
+
+  def _props(self, results):
+    return dict([(name, value) for name, value in results.items() if not name.startswith('_') and value is not None])
+
+  def run(self, deadline=None):
+    start = perf_counter()
+    results, futures = {}, {}
+    while len(results) < len(self.steps):
+      ready = self._ready(results, set(results) | set(futures.values()))
+      while ready:
+        for step in ready:
+          if step.inline:
+            results[step.name] = self._timed(step, start, *[results[dep] for dep in step.deps])
+          else:
+            ctx = contextvars.copy_context()
+            futures[plan_executor.submit(ctx.run, self._timed, step, start, *[results[dep] for dep in step.deps])] = step.name
+        ready = self._ready(results, set(results) | set(futures.values()))
+      if not futures:
+        break
+      finished, _ = wait(list(futures), timeout=deadline.remaining() if deadline else None, return_when=FIRST_COMPLETED)
+      if not finished:
+        raise DeadlineExceeded(f'fetch plan {self.name}')
+      for future in finished:
+        name = futures.pop(future)
+        try:
+          results[name] = future.result()
+        except BaseException:
+          for pending in futures:
+            pending.cancel()
+          raise
+    self._log(start)
+    return self._props(results)
+
+  async def arun(self, deadline=None):
+    start = perf_counter()
+    results, tasks = {}, {}
+    try:
+      while len(results) < len(self.steps):
+        ready = self._ready(results, set(results) | set(tasks.values()))
+        while ready:
+          for step in ready:
+            if step.inline:
+              results[step.name] = self._timed(step, start, *[results[dep] for dep in step.deps])
+            else:
+              tasks[asyncio.ensure_future(self._atimed(step, start, *[results[dep] for dep in step.deps]))] = step.name
+          ready = self._ready(results, set(results) | set(tasks.values()))
+        if not tasks:
+          break
+        finished, _ = await asyncio.wait(list(tasks), timeout=deadline.remaining() if deadline else None, return_when=asyncio.FIRST_COMPLETED)
+        if not finished:
+          raise DeadlineExceeded(f'fetch plan {self.name}')
+        for task in finished:
+          results[tasks.pop(task)] = task.result()
+    finally:
+      for task in tasks:
+        task.cancel()
+    self._log(start)
+    return self._props(results)
+
+  def _timed(self, step, start, *args):
+    began = perf_counter()
+    try:
+      return step.fn(*args)
+    finally:
+      self.timings[step.name] = (began - start, perf_counter() - began)
+
+  async def _atimed(self, step, start, *args):
+    began = perf_counter()
+    try:
+      return await (step.afn(*args) if step.afn else run_io(step.fn, *args))
+    finally:
+      self.timings[step.name] = (began - start, perf_counter() - began)
+
+  def critical_path(self):
+    '''Steps on the longest chain of dependencies, by finish time'''
+    finish = dict([(name, began + elapsed) for name, (began, elapsed) in self.timings.items()])
+    path, name = [], max(finish, key=finish.get) if finish else None
+    while name:
+      path.insert(0, name)
+      deps = [dep for dep in self.steps[name].deps if dep in finish]
+      name = max(deps, key=finish.get) if deps else None
+    return path
+
+  def _log(self, start):
+    steps = ' '.join([f'{name}={round(elapsed,3)}@{round(began,3)}' for name, (began, elapsed) in self.timings.items()])
+    logger.info(f'fetch_plan: name={self.name} elapsed={round(perf_counter()-start,3)} critical_path={">".join(self.critical_path())} {steps}')
@@ -12,19 +12,19 @@ import json
 from time import time as now
 import datetime
 
-import requests
-logging.getLogger('requests').setLevel(logging.INFO)
+import http_client
 
 GH_ACCESS_TOKEN = os.environ.get('GH_ACCESS_TOKEN')
 
-def get_gh_file_by_url(url):
-    start = now()
+GH_HEADERS = {
+    'Authorization': f'Token {GH_ACCESS_TOKEN}',
+    'Accept': 'application/vnd.github.v3+json'
+}
+
+# each lookup has one function parsing the response, the sync and async versions only differ in how it is fetched
+
+def _gh_file(resp, url, start):
     content = sha = None
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {GH_ACCESS_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
     logger.debug(f'get_gh_file_by_url: url={url} resp={resp.status_code}')
     if resp.status_code == 200:
         resp = resp.json()
@@ -33,69 +33,104 @@ def get_gh_file_by_url(url):
     logger.info(f'get_gh_file_by_url: url={url} elapsed={round(now()-start,3)}')
     return content, url, sha
 
-def get_gh_file(acct, repo, ref, path):
+def get_gh_file_by_url(url, deadline=None):
+    start = now()
+    return _gh_file(http_client.get(url, headers=GH_HEADERS, deadline=deadline), url, start)
+
+async def aget_gh_file_by_url(url, deadline=None):
     start = now()
-    url = f'https://api.github.com/repos/{acct}/{repo}/contents{path}?ref={ref}'
-    logger.info(f'get_gh_file: acct={acct} repo={repo} ref={ref} path={path} elapsed={round(now()-start,3)}')
-    return get_gh_file_by_url(url)[0]
+    return _gh_file(await http_client.aget(url, headers=GH_HEADERS, deadline=deadline), url, start)
+
+def _contents_url(acct, repo, ref, path):
+    # without a ref GitHub serves the default branch, saving a repo lookup before the fetch
+    return f'https://api.github.com/repos/{acct}/{repo}/contents{path}{"?ref="+ref if ref else ""}'
+
+def get_gh_file(acct, repo, ref, path, deadline=None):
+    logger.info(f'get_gh_file: acct={acct} repo={repo} ref={ref} path={path}')
+    return get_gh_file_by_url(_contents_url(acct, repo, ref, path), deadline=deadline)[0]
+
+async def aget_gh_file(acct, repo, ref, path, deadline=None):
+    logger.info(f'get_gh_file: acct={acct} repo={repo} ref={ref} path={path}')
+    return (await aget_gh_file_by_url(_contents_url(acct, repo, ref, path), deadline=deadline))[0]
 
-def get_gh_last_commit(acct, repo, ref, path=None):
+def get_gh_last_commit(acct, repo, ref, path=None, deadline=None):
     start = now()
     url = f'https://api.github.com/repos/{acct}/{repo}/commits?sha={ref}&page=1&per_page=1{"&path="+path if path else ""}'
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {GH_ACCESS_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
+    resp = http_client.get(url, headers=GH_HEADERS, deadline=deadline)
     commits = resp.json() if resp.status_code == 200 else []
     last_commit_date = datetime.datetime.strptime(commits[0]['commit']['author']['date'], '%Y-%m-%dT%H:%M:%SZ') if len(commits) > 0 else None
     logger.info(f'get_gh_last_commit: acct={acct} repo={repo} ref={ref} path={path} resp={resp.status_code} last_commit_date={last_commit_date} elapsed={round(now()-start,3)}')
     return last_commit_date
 
-def gh_dir_list(acct, repo, path=None, ref=None):
-    start = now()
+def _dir_list_url(acct, repo, path, ref):
     url = f'https://api.github.com/repos/{acct}/{repo}/contents/{path if path else ""}'
-    if ref:
-        url += f'?ref={ref}'
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {GH_ACCESS_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
-    # logger.info(json.dumps(resp.json(),indent=2))
+    return f'{url}?ref={ref}' if ref else url
+
+def _dir_list(resp, acct, repo, path, start):
     logger.info(f'gh_dir_list: acct={acct} repo={repo} path={path} elapsed={round(now()-start,3)}')
     return [item['name'] for item in resp.json()] if resp.status_code == 200 else []
 
-def gh_repo_info(acct, repo):
+def gh_dir_list(acct, repo, path=None, ref=None, deadline=None):
+    start = now()
+    return _dir_list(http_client.get(_dir_list_url(acct, repo, path, ref), headers=GH_HEADERS, deadline=deadline), acct, repo, path, start)
+
+async def agh_dir_list(acct, repo, path=None, ref=None, deadline=None):
     start = now()
-    url = f'https://api.github.com/repos/{acct}/{repo}'
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {GH_ACCESS_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
+    return _dir_list(await http_client.aget(_dir_list_url(acct, repo, path, ref), headers=GH_HEADERS, deadline=deadline), acct, repo, path, start)
+
+def _dir_shas(resp, acct, repo, path, start):
+    shas = None # unknown, the listing failed
+    if resp.status_code == 200:
+        items = resp.json()
+        # the contents of a file path are an object, it has no entries
+        shas = dict([(item['name'], item['sha']) for item in items]) if isinstance(items, list) else {}
+    elif resp.status_code == 404:
+        shas = {}
+    logger.info(f'gh_dir_shas: acct={acct} repo={repo} path={path} status={resp.status_code} elapsed={round(now()-start,3)}')
+    return shas
+
+def gh_dir_shas(acct, repo, path=None, ref=None, deadline=None):
+    '''Blob or tree SHA of each entry of a directory by name, None when the listing failed. No content is fetched.'''
+    start = now()
+    return _dir_shas(http_client.get(_dir_list_url(acct, repo, path, ref), headers=GH_HEADERS, deadline=deadline), acct, repo, path, start)
+
+async def agh_dir_shas(acct, repo, path=None, ref=None, deadline=None):
+    start = now()
+    return _dir_shas(await http_client.aget(_dir_list_url(acct, repo, path, ref), headers=GH_HEADERS, deadline=deadline), acct, repo, path, start)
+
+def _repo_info(resp, acct, repo, start):
     repo_info = resp.json() if resp.status_code == 200 else {}
     logger.debug(json.dumps(repo_info, indent=2))
     logger.info(f'gh_repo_info: acct={acct} repo={repo} elapsed={round(now()-start,3)}')
     return repo_info
 
-def gh_user_info(login=None, acct=None, repo=None):
+def gh_repo_info(acct, repo, deadline=None):
     start = now()
-    if not login:
-        login = gh_repo_info(acct, repo)['owner']['login']
-    url = f'https://api.github.com/users/{login}'
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {GH_ACCESS_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
+    return _repo_info(http_client.get(f'https://api.github.com/repos/{acct}/{repo}', headers=GH_HEADERS, deadline=deadline), acct, repo, start)
+
+async def agh_repo_info(acct, repo, deadline=None):
+    start = now()
+    return _repo_info(await http_client.aget(f'https://api.github.com/repos/{acct}/{repo}', headers=GH_HEADERS, deadline=deadline), acct, repo, start)
+
+def _user_info(resp, login, acct, repo, start):
     user_info = resp.json() if resp.status_code == 200 else {}
-    # logger.debug(json.dumps(user_info, indent=2))
     logger.info(f'gh_user_info: login={login} acct={acct} repo={repo} elapsed={round(now()-start,3)}')
     return user_info
 
-def get_default_branch(acct, repo):
+def gh_user_info(login=None, acct=None, repo=None, deadline=None):
+    start = now()
+    if not login:
+        login = gh_repo_info(acct, repo, deadline=deadline)['owner']['login']
+    return _user_info(http_client.get(f'https://api.github.com/users/{login}', headers=GH_HEADERS, deadline=deadline), login, acct, repo, start)
+
+async def agh_user_info(login=None, acct=None, repo=None, deadline=None):
+    start = now()
+    if not login:
+        login = (await agh_repo_info(acct, repo, deadline=deadline))['owner']['login']
+    return _user_info(await http_client.aget(f'https://api.github.com/users/{login}', headers=GH_HEADERS, deadline=deadline), login, acct, repo, start)
+
+def get_default_branch(acct, repo, deadline=None):
     start = now()
-    repo_info = gh_repo_info(acct, repo)
+    repo_info = gh_repo_info(acct, repo, deadline=deadline)
     logger.info(f'get_default_branch: acct={acct} repo={repo} elapsed={round(now()-start,3)}')
     return repo_info['default_branch'] if repo_info else None
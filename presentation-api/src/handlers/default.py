@@ -13,11 +13,10 @@ from urllib.parse import quote, unquote
 
 from handlers.handler_base import HandlerBase
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
 
 def is_image(url):
-  return requests.head(url).headers.get('Content-Type','').startswith('image')
+  return http_client.head(url).headers.get('Content-Type','').startswith('image')
 
 class Handler(HandlerBase):
 
@@ -9,6 +9,8 @@ from handlers.handler_base import HandlerBase
 
 class Handler(HandlerBase):
 
+  builds_from_sourceid = False
+
   @staticmethod
   def can_handle(url):
     path_elems = url.split('/')
@@ -9,11 +9,12 @@ import os
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 BASEDIR = os.path.dirname(SCRIPT_DIR)
 
+
 from handlers.handler_base import HandlerBase
 from licenses import CreativeCommonsLicense, RightsStatement
+from fetch_plan import FetchPlan
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
 
 FLICKR_API_KEY = os.environ.get('FLICKR_API_KEY')
 
@@ -51,6 +52,7 @@ class Handler(HandlerBase):
   }
 
   def __init__(self, sourceid, **kwargs):
+    self._raw_props = None
     super().__init__('flickr', sourceid, **kwargs)
 
   def init_manifest(self):
@@ -106,13 +108,52 @@ class Handler(HandlerBase):
     if tags:
       self.add_metadata('tags', tags)
 
+  def _api_url(self, method):
+    return f'https://www.flickr.com/services/rest/?method={method}&api_key={FLICKR_API_KEY}&photo_id={self.sourceid}&format=json&nojsoncallback=1'
+
+  def _photo(self, resp):
+    if resp.status_code != 200:
+      return {}
+    if 'photo' not in resp.json():
+      raise self._source_not_found(f'flickr:{self.sourceid}', resp.json().get('message', 'photo not found'))
+    return resp.json()['photo']
+
+  def _largest_size(self, resp):
+    return sorted(resp.json()['sizes']['size'], key = lambda i: i['width'])[-1] if resp.status_code == 200 and 'sizes' in resp.json() else None
+
+  def _fetch_plan(self):
+    # getInfo and getSizes are independent and fetched together
+    return FetchPlan(self.manifestid) \
+      .step('_info', lambda: http_client.get(self._api_url('flickr.photos.getInfo'), deadline=self.deadline),
+        afn=lambda: http_client.aget(self._api_url('flickr.photos.getInfo'), deadline=self.deadline)) \
+      .step('_sizes', lambda: http_client.get(self._api_url('flickr.photos.getSizes'), deadline=self.deadline),
+        afn=lambda: http_client.aget(self._api_url('flickr.photos.getSizes'), deadline=self.deadline)) \
+      .step('photo', self._photo, '_info', inline=True) \
+      .step('size', self._largest_size, '_sizes', inline=True)
+
+  def _props(self, results):
+    props = results.get('photo', {})
+    if props and 'size' in results:
+      props['size'] = results['size']
+    return props
+
+  def change_token(self):
+    return self.raw_props.get('dates', {}).get('lastupdate')
+
+  def upstream_change_token(self, deadline):
+    resp = http_client.get(self._api_url('flickr.photos.getInfo'), deadline=deadline)
+    return resp.json().get('photo', {}).get('dates', {}).get('lastupdate') if resp.status_code == 200 else None
+
   @property
   def raw_props(self):
-    props = {}
-    url = f'https://www.flickr.com/services/rest/?method=flickr.photos.getInfo&api_key={FLICKR_API_KEY}&photo_id={self.sourceid}&format=json&nojsoncallback=1'
-    resp = requests.get(url)
-    if resp.status_code == 200:
-      props = resp.json()['photo']
-      resp = requests.get(f'https://www.flickr.com/services/rest/?method=flickr.photos.getSizes&api_key={FLICKR_API_KEY}&photo_id={self.sourceid}&format=json&nojsoncallback=1')
-      props['size'] = sorted(resp.json()['sizes']['size'], key = lambda i: i['width'])[-1]
-    return props    
+    if self._raw_props is None:
+      self._check_negative(f'flickr:{self.sourceid}')
+      self._raw_props = self._props(self._fetch_plan().run(self.deadline))
+    return self._raw_props
+
+  async def araw_props(self):
+    if self._raw_props is None:
+      self._check_negative(f'flickr:{self.sourceid}')
+      self._raw_props = self._props(await self._fetch_plan().arun(self.deadline))
+    return self._raw_props
+
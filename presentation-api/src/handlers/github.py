@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
 import logging
 logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
 logger = logging.getLogger()
@@ -12,17 +11,22 @@ SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 import traceback
 import yaml
 import json
-from datetime import datetime
+import hashlib
 
-from gh import gh_repo_info, get_gh_file, get_gh_last_commit, gh_user_info, get_default_branch, gh_dir_list
+from gh import gh_repo_info, get_gh_file, gh_user_info, get_default_branch, gh_dir_list, gh_dir_shas
+from gh import agh_repo_info, aget_gh_file, agh_user_info, agh_dir_list, agh_dir_shas
 
 from handlers.handler_base import HandlerBase
+from fetch_plan import FetchPlan
 
-from time import time as now
+import asyncio
 import concurrent.futures
 
 class Handler(HandlerBase):
 
+  # images and their metadata files are edited in place
+  cache_max_age = 300
+
   rights = {
     # Creative Commons Licenses
     'CC0': {'label': 'Public Domain Dedication', 'url': 'http://creativecommons.org/publicdomain/zero/1.0/'},
@@ -53,17 +57,30 @@ class Handler(HandlerBase):
     return url.startswith('https://github.com') or url.startswith('https://raw.githubusercontent.com')
 
   @staticmethod
-  def _fix_sourceid(sourceid):
-    fname = sourceid.split('/')[-1]
-    if '.' not in fname:
+  def _dir_to_list(sourceid):
+    '''(acct, repo, dir) to look up the file extension of a sourceid given without one, None when it has one'''
+    if '.' not in sourceid.split('/')[-1]:
       acct, repo = sourceid.split('/')[:2]
-      _dir = '/'.join(sourceid.split('/')[2:-1])
-      for _file in gh_dir_list(acct, repo, _dir):
-        if '.' in _file and _file.split('.')[0] == fname:
-          sourceid += f'.{_file.split(".")[1]}'
-          break
+      return acct, repo, '/'.join(sourceid.split('/')[2:-1])
+
+  @staticmethod
+  def _with_extension(sourceid, files):
+    fname = sourceid.split('/')[-1]
+    for _file in files:
+      if '.' in _file and _file.split('.')[0] == fname:
+        return sourceid + f'.{_file.split(".")[1]}'
     return sourceid
 
+  @staticmethod
+  def _fix_sourceid(sourceid, deadline=None):
+    listing = Handler._dir_to_list(sourceid)
+    return Handler._with_extension(sourceid, gh_dir_list(*listing, deadline=deadline)) if listing else sourceid
+
+  @staticmethod
+  async def _afix_sourceid(sourceid, deadline=None):
+    listing = Handler._dir_to_list(sourceid)
+    return Handler._with_extension(sourceid, await agh_dir_list(*listing, deadline=deadline)) if listing else sourceid
+
   @staticmethod
   def sourceid_from_url(url):
     path = [elem for elem in url.split('/') if elem != ''][2:]
@@ -79,7 +96,12 @@ class Handler(HandlerBase):
     return f'gh:{sourceid.replace("?","%3F").replace("&","%26")}'
   
   def __init__(self, sourceid, **kwargs):
-    super().__init__('gh', Handler._fix_sourceid(sourceid), **kwargs)
+    self._raw_props = None
+    super().__init__('gh', sourceid if kwargs.get('defer_build') else Handler._fix_sourceid(sourceid, kwargs.get('deadline')), **kwargs)
+
+  @classmethod
+  async def create(cls, sourceid, **kwargs):
+    return await super().create(await cls._afix_sourceid(sourceid, kwargs.get('deadline')), **kwargs)
 
   def init_manifest(self):
     props = self.raw_props
@@ -93,7 +115,7 @@ class Handler(HandlerBase):
     label = props['gh_props'].get('label') or last_sourceid_elem.split('-')[0].split('__')[0].split('.')[0].replace('_', ' ')
     self.set_label(label)
 
-    self.image_url = props['gh_props'].get('image_url') or self._image_url_from_sourceid()
+    self.image_url = props['gh_props'].get('image_url') or self._image_url_from_sourceid(ref)
     image_url_elems = self.image_url.split('/')
     self.source_url =  f'https://github.com/{sourceid_elems[0]}/{sourceid_elems[1]}/blob/{ref}/{"/".join(image_url_elems[6:])}'
 
@@ -140,7 +162,7 @@ class Handler(HandlerBase):
   def _image_url_from_sourceid(self, ref=None):
     sourceid_elems = self.sourceid.split('/')
     acct, repo = sourceid_elems[:2]
-    ref = ref if ref else get_default_branch(acct, repo)
+    ref = ref if ref else get_default_branch(acct, repo, deadline=self.deadline)
     path = '/'.join(sourceid_elems[2:])
     return f'https://raw.githubusercontent.com/{acct}/{repo}/{ref}/{path}'
 
@@ -175,74 +197,108 @@ class Handler(HandlerBase):
     if 'requiredStatement' in image_props: merged['requiredStatement_defined_for_image'] = True
     return merged
 
-  def _get_gh_props(self, acct, repo, ref, image_path):
+  def _props_paths(self, image_path):
     path_elems = image_path.split('/')[2:]
+    return [f'/{"/".join(path_elems).split(".")[0]}.yaml'] + [f'/{"/".join(path_elems[:-(i+1)])}{"/" if i < len(path_elems)-1 else ""}iiif-props.yaml' for i in range(len(path_elems))]
 
-    props_paths = [f'/{"/".join(path_elems).split(".")[0]}.yaml'] + [f'/{"/".join(path_elems[:-(i+1)])}{"/" if i < len(path_elems)-1 else ""}iiif-props.yaml' for i in range(len(path_elems))]
+  def _parse_gh_props(self, props_paths, files):
+    '''Merged props from the contents of the props files, files holds the exception for a failed fetch'''
     results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(props_paths)) as executor:
-      futures = {}
-      for idx, path in enumerate(props_paths):
-        futures[executor.submit(get_gh_file, acct, repo, ref, path)] = idx
-      
-      for future in concurrent.futures.as_completed(futures):
-        idx = futures[future]
-        try:
-          logger.info(future.result())
-          results[idx] = yaml.load(future.result(), Loader=yaml.FullLoader) or {}
-        except Exception as exc:
-          logger.info('%r generated an exception: %s' % (props_paths[idx], exc))
-          logger.debug(traceback.format_exc())
-    logger.info(json.dumps(results,indent=2))
+    for idx, content in enumerate(files):
+      try:
+        if isinstance(content, Exception): raise content
+        results[idx] = yaml.load(content, Loader=yaml.FullLoader) or {}
+      except Exception as exc:
+        logger.info('%r generated an exception: %s' % (props_paths[idx], exc))
+        logger.debug(traceback.format_exc())
+    logger.debug(json.dumps(results,indent=2))
     return self._merge_gh_props(results)
 
+  def _get_gh_props(self, acct, repo, ref, image_path):
+    props_paths = self._props_paths(image_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(props_paths)) as executor:
+      futures = [executor.submit(get_gh_file, acct, repo, ref, path, deadline=self.deadline) for path in props_paths]
+    return self._parse_gh_props(props_paths, [future.exception() or future.result() for future in futures])
+
+  async def _aget_gh_props(self, acct, repo, ref, image_path):
+    props_paths = self._props_paths(image_path)
+    files = await asyncio.gather(*[aget_gh_file(acct, repo, ref, path, deadline=self.deadline) for path in props_paths], return_exceptions=True)
+    return self._parse_gh_props(props_paths, files)
+
+  def _checked_repo_info(self, repo_info):
+    acct, repo = self.sourceid.split('/')[:2]
+    if 'default_branch' not in repo_info:
+      raise self._source_not_found(f'gh:{acct}/{repo}', 'repository not found')
+    return repo_info
+
+  def _owner_login(self, repo_info, user_info):
+    # the owner is fetched by account name up front, it only differs when the repo has been transferred
+    login = repo_info.get('owner', {}).get('login')
+    return login if login and login.lower() != user_info.get('login', '').lower() else None
+
+  def _user_info(self, repo_info, user_info):
+    login = self._owner_login(repo_info, user_info)
+    return gh_user_info(login=login, deadline=self.deadline) if login else user_info
+
+  async def _auser_info(self, repo_info, user_info):
+    login = self._owner_login(repo_info, user_info)
+    return await agh_user_info(login=login, deadline=self.deadline) if login else user_info
+
+  def _fetch_plan(self):
+    acct, repo = self.sourceid.split('/')[:2]
+    return FetchPlan(self.manifestid) \
+      .step('_repo_info', lambda: gh_repo_info(acct, repo, deadline=self.deadline), afn=lambda: agh_repo_info(acct, repo, deadline=self.deadline)) \
+      .step('repo_info', self._checked_repo_info, '_repo_info', inline=True) \
+      .step('_user_info', lambda: gh_user_info(login=acct, deadline=self.deadline), afn=lambda: agh_user_info(login=acct, deadline=self.deadline)) \
+      .step('user_info', self._user_info, 'repo_info', '_user_info', afn=self._auser_info) \
+      .step('gh_props', lambda: self._get_gh_props(acct, repo, None, self.sourceid), afn=lambda: self._aget_gh_props(acct, repo, None, self.sourceid)) \
+      .step('_dir_shas', lambda: self._dir_shas(self.deadline), afn=lambda: self._adir_shas(self.deadline)) \
+      .step('change_token', self._change_token, '_dir_shas', inline=True)
+
+  def _token_paths(self):
+    # the image and the props files that apply to it, as (directory, name)
+    paths = ['/'.join(self.sourceid.split('/')[2:])] + [path[1:] for path in self._props_paths(self.sourceid)]
+    return [tuple(path.rpartition('/')[::2]) for path in paths]
+
+  def _token_dirs(self):
+    return sorted(set([directory for directory, _ in self._token_paths()]))
+
+  def _dir_shas(self, deadline):
+    acct, repo = self.sourceid.split('/')[:2]
+    dirs = self._token_dirs()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(dirs)) as executor:
+      return dict(zip(dirs, executor.map(lambda directory: gh_dir_shas(acct, repo, directory, deadline=deadline), dirs)))
+
+  async def _adir_shas(self, deadline):
+    acct, repo = self.sourceid.split('/')[:2]
+    dirs = self._token_dirs()
+    return dict(zip(dirs, await asyncio.gather(*[agh_dir_shas(acct, repo, directory, deadline=deadline) for directory in dirs])))
+
+  def _change_token(self, dir_shas):
+    '''Digest of the blob SHAs of the image and its props files, taken from listings of their directories.
+    Commits to other files of the repo leave it unchanged, None when a listing failed.'''
+    if any(shas is None for shas in dir_shas.values()):
+      return None
+    shas = [dir_shas[directory].get(name) for directory, name in self._token_paths()]
+    return hashlib.sha1(json.dumps(shas).encode('utf-8')).hexdigest()
+
+  def change_token(self):
+    return self.raw_props.get('change_token')
+
+  def upstream_change_token(self, deadline):
+    return self._change_token(self._dir_shas(deadline))
+
   @property
   def raw_props(self):
-    props = {}
-    acct, repo = self.sourceid.split('/')[:2]
-    props['repo_info'] = gh_repo_info(acct, repo)
-    if 'owner' in props['repo_info']: props['user_info'] = gh_user_info(login=props['repo_info']['owner']['login'])
-    ref = props['repo_info']['default_branch']
-    props['gh_props'] = self._get_gh_props(acct, repo, ref, self.sourceid)
-    return props
-
-  def _last_updated(self):
-    start = now()
-    sourceid_path_elems = [elem for elem in self.sourceid.split('/') if elem.strip()]
-    acct, repo = sourceid_path_elems[:2]
-    repo_info = gh_repo_info(acct, repo)
-    ref = repo_info['default_branch']
-
-    # List of GH files to check
-    file_path_elems =  sourceid_path_elems[2:]
-    gh_paths = [f'{"/".join(file_path_elems).split(".")[0]}.yaml'] + [f'{"/".join(file_path_elems[:-(i+1)])}{"/" if i < len(file_path_elems)-1 else ""}iiif-props.yaml' for i in range(len(file_path_elems))]
-    #if '.' in file_path_elems[-1] and file_path_elems[-1].split('.')[-1].lower() in ('jpg', 'jp2', 'jpeg', 'png'):
-    #  gh_paths.append('/'.join(file_path_elems))
+    if self._raw_props is None:
+      acct, repo = self.sourceid.split('/')[:2]
+      self._check_negative(f'gh:{acct}/{repo}')
+      self._raw_props = self._fetch_plan().run(self.deadline)
+    return self._raw_props
 
-    results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(gh_paths)) as executor:
-      futures = {}
-      for path in gh_paths:
-        futures[executor.submit(get_gh_last_commit, acct, repo, ref, path)] = path
-      
-      for future in concurrent.futures.as_completed(futures):
-        path = futures[future]
-        try:
-          results[path] = future.result()
-        except Exception as exc:
-          logger.debug('%r generated an exception: %s' % (path, exc))
-
-    dates = sorted([date for date in results.values() if date], reverse=True) if results else []
-    last_update = dates[0].strftime('%Y-%m-%dT%H:%M:%SZ') if dates else None 
-    logger.debug(f'_last_updated: last_update={last_update} elapsed={round(now()-start,3)}')
-    return last_update
-    
-  def _is_current(self, m):
-    sourceid = '/'.join(m['id'].split('/')[1:-1]).split(':',1)[1]
-    manifest_last_updated = next(iter([list(md['value'].values())[0][0] for md in m.get('metadata',[]) if 'updated' in [list(md['label'].values())[0][0]]]), None)
-    if manifest_last_updated:
-      manifest_last_updated = datetime.strptime(manifest_last_updated, '%Y-%m-%dT%H:%M:%SZ')
-      gh_last_updated = datetime.strptime(self._last_updated(), '%Y-%m-%dT%H:%M:%SZ')
-    is_current = manifest_last_updated and gh_last_updated == manifest_last_updated
-    logger.debug(f'_is_current: sourceid={sourceid} manifest_last_updated={manifest_last_updated} gh_last_updated={gh_last_updated} is_current={is_current}')
-    return is_current
+  async def araw_props(self):
+    if self._raw_props is None:
+      acct, repo = self.sourceid.split('/')[:2]
+      self._check_negative(f'gh:{acct}/{repo}')
+      self._raw_props = await self._fetch_plan().arun(self.deadline)
+    return self._raw_props
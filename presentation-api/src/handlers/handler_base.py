@@ -2,38 +2,63 @@ import logging
 logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
 logger = logging.getLogger()
 
+import os
 import json
+import asyncio
 import hashlib
-from urllib.parse import quote
+from urllib.parse import quote, unquote
 from time import time as now
-from datetime import datetime
+from datetime import datetime, timedelta
 from hashlib import sha256
 
 # from image_info import ImageInfo
 from media_info import MediaInfo
+from executors import run_io, run_media, run_background
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
+from http_cache import revalidating
+from batch_loader import wd_entity_loader, wc_entity_loader, wc_title_entity_loader, entity_label_loader, wd_revision_loader, wc_revision_loader
+from deadline import Deadline, DeadlineExceeded
+from negative_cache import negative_cache, SourceNotFound
 
 from bs4 import BeautifulSoup
 
 from s3 import Bucket
+import rendition
+from rendition import Rendition, Template, PUBLIC_BASE_URL
+import manifest_v2
+from summaries import summaries, summarize
 
 import boto3
 SQS_URL = 'https://sqs.us-east-1.amazonaws.com/804803416183/iiif-convert'
 
-entity_labels = {}
+# cached manifests older than the soft TTL are served while a background rebuild refreshes them,
+# past the hard TTL they are rebuilt before responding
+SOFT_TTL_DAYS = int(os.environ.get('MANIFEST_SOFT_TTL_DAYS', 30))
+HARD_TTL_DAYS = int(os.environ.get('MANIFEST_HARD_TTL_DAYS', 365))
+# manifests saved with a change token are checked against upstream this often, and only rebuilt when the token moved
+CHANGE_CHECK_HOURS = float(os.environ.get('MANIFEST_CHANGE_CHECK_HOURS', 1))
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
 manifest_cache = Bucket('iiif-manifest-cache')
 
+# in-process caches backed by a cache shared by the worker processes of the node, entities also by the distributed cache
 from expiringdict import ExpiringDict
-wd_entities = ExpiringDict(max_len=100, max_age_seconds=1800) # cache entities for 30 minutes
-wc_entities = ExpiringDict(max_len=100, max_age_seconds=1800)
-external_manifests = ExpiringDict(max_len=100, max_age_seconds=1800)
+from cache_backend import make_cache
+entity_labels = make_cache('entity_labels', {}, 16 * 1024 * 1024, max_age_seconds=86400, distributed=True)
+wd_entities = make_cache('wd_entities', ExpiringDict(max_len=100, max_age_seconds=1800), 64 * 1024 * 1024, max_age_seconds=1800, distributed=True) # cache entities for 30 minutes
+wc_entities = make_cache('wc_entities', ExpiringDict(max_len=100, max_age_seconds=1800), 64 * 1024 * 1024, max_age_seconds=1800, distributed=True)
+# info.json urls of images already converted for the image service, misses are not cached, a conversion may be queued
+image_service_states = make_cache('image_service_states', ExpiringDict(max_len=10000, max_age_seconds=3600), 8 * 1024 * 1024, max_age_seconds=86400)
+external_manifests = make_cache('external_manifests', ExpiringDict(max_len=100, max_age_seconds=1800), 32 * 1024 * 1024, max_age_seconds=1800)
 
 class HandlerBase(object):
+  # seconds clients may reuse a manifest before revalidating it, sources edited often use less
+  cache_max_age = 3600
+  # False for handlers constructed from a source url, they cannot be refreshed ahead from the manifest id alone
+  builds_from_sourceid = True
 
   def __init__(self, source, sourceid, **kwargs):
-    start = now()
     self.source = source
     self.sourceid = sourceid
     self.baseurl = kwargs.get('baseurl')
@@ -43,59 +68,286 @@ class HandlerBase(object):
     self._image_url = None
     self._source_url = None
     self.external_manifest_url = False
-  
-    self.m = manifest_cache.get(self.manifestid) if not self.refresh else None
-
-    logger.info(f'HandlerBase: source={self.source} sourceid={self.sourceid} baseurl={self.baseurl} cached={self.m is not None} refresh={self.refresh}')
-
-    if self.m:
-      self.m = json.loads(self.m.decode('utf-8') if isinstance(self.m, bytes) else self.m)
-      days_since_last_update = None
-      manifest_last_updated = next(iter([list(md['value'].values())[0][0] for md in self.m.get('metadata',[]) if 'updated' in [list(md['label'].values())[0][0]]]), None)
-      if manifest_last_updated:
-        manifest_last_updated = datetime.strptime(manifest_last_updated, '%Y-%m-%dT%H:%M:%SZ')
-        days_since_last_update = (datetime.now() - manifest_last_updated).days
-        logger.debug(f'manifest_last_updated={manifest_last_updated} days_since_last_update={days_since_last_update}')
-      if days_since_last_update is None or days_since_last_update > 30:
-        self.m = None
-
-    if not self.m:
-      self.m = {
-        '@context': 'http://iiif.io/api/presentation/3/context.json',
-        'id': f'{{BASE_URL}}/{self.manifestid}/manifest.json',
-        'type': 'Manifest',
+    self._info_json_status = None
+    self._labels_looked_up = set() # qids already looked up for this build, found or not
+    self.deadline = kwargs.get('deadline') or Deadline()
+    self.degraded = False
+    self._m = None
+    self.template = None
+    self.stale = False
+    self.change_check = False
+    self.stale_in = None
+
+    if not kwargs.get('defer_build', False):
+      self._build()
+
+  @classmethod
+  async def create(cls, sourceid, **kwargs):
+    '''Async counterpart of the constructor, builds the manifest without blocking the event loop'''
+    handler = cls(sourceid, defer_build=True, **kwargs)
+    await handler._abuild()
+    return handler
+
+  # the sync and async builds share every step but the fetches, which the async build awaits concurrently
+
+  def _load_cached(self):
+    '''Reads the cached manifest into the template, True when there is one. Reading warms the faster
+    cache tiers and loading records the digest and summary, async builds call this in an io worker.'''
+    cached, cache_metadata = self._read_cache() if not self.refresh else (None, None)
+    self.template = self._from_cache(cached, cache_metadata)
+    if self.stale:
+      self._schedule_revalidate(cached, cache_metadata)
+    return self.template is not None
+
+  def _stamp_updated(self):
+    '''Adds the build time to a manifest built here, False for external manifests which are served as is'''
+    if self.external_manifest_url:
+      return False
+    self.add_metadata(self._language_map('updated', datetime.now().strftime(TIMESTAMP_FORMAT)))
+    return True
+
+  def _finish_build(self, related):
+    if self.image_url:
+      self._add_related_entities(related)
+      self._save()
+
+  def _build(self):
+    start = now()
+    if not self._load_cached():
+      # a refresh rebuild revalidates upstream responses held in the http cache
+      with revalidating(self.refresh):
+        self.m = self._new_manifest()
+        self.init_manifest()
+        if self._stamp_updated():
+          self.set_service()
+          self._finish_build(self._enrich(self._get_related_entities) if self.image_url else None)
+    logger.debug(f'HandlerBase: elapsed={round(now()-start,3)}')
+
+  async def _abuild(self):
+    start = now()
+    if not await run_io(self._load_cached):
+      with revalidating(self.refresh):
+        self.m = self._new_manifest()
+        await self.araw_props()
+        await run_io(self.init_manifest)
+        if self._stamp_updated():
+          related = None
+          if self.image_url:
+            # independent lookups for the image are awaited together
+            related, _, _ = await asyncio.gather(
+              self._aenrich(self._aget_related_entities),
+              self._ainfo_json_exists(),
+              run_media(self._media_info, self.image_url)
+            )
+            if related and 'P180' in related:
+              await self._aprefetch_entity_labels([item['id'] for item in related['P180']])
+          await run_io(self.set_service)
+          await run_io(self._finish_build, related)
+    logger.debug(f'HandlerBase: async elapsed={round(now()-start,3)}')
+
+  def _save(self):
+    if self.degraded:
+      # manifests missing optional enrichment are served but not cached, the next request rebuilds them
+      logger.warning(f'HandlerBase: not caching degraded manifest {self.manifestid} {self.deadline}')
+      return
+    stored, self.template = rendition.store(json.dumps(self.m), self._template_facts(self.m))
+    cache_metadata = self._cache_metadata(self.change_token())
+    manifest_cache.put(self.manifestid, stored, metadata=rendition.stored_metadata(stored, cache_metadata))
+    rendition.precompress(self.template, (self.baseurl, PUBLIC_BASE_URL))
+    rendition.stored_as(self.manifestid, self.template)
+    self._check_ttls(self.template, cache_metadata)
+    # the v2 manifest is rewritten with every save, a v2 manifest made from another v3 template is never served
+    manifest_v2.save_v2(self.manifestid, self.m, self.template, (self.baseurl, PUBLIC_BASE_URL))
+
+  def _cache_metadata(self, token):
+    return {'change-token': str(token), 'checked': datetime.now().strftime(TIMESTAMP_FORMAT)} if token else None
+
+  def change_token(self):
+    '''Value that moves whenever the upstream source changes, taken from the props the manifest was built from.
+    Handlers without one are rebuilt when the soft TTL expires.'''
+    return None
+
+  def upstream_change_token(self, deadline):
+    '''Current change token, fetched with the cheapest upstream request available'''
+    return None
+
+  def _enrich(self, fn, *args):
+    if not self.deadline.allows():
+      self.degraded = True
+      return None
+    try:
+      return fn(*args)
+    except DeadlineExceeded:
+      logger.warning(f'HandlerBase: skipped {fn.__name__} for {self.manifestid}, request budget exhausted')
+      self.degraded = True
+      return None
+
+  async def _aenrich(self, fn, *args):
+    if not self.deadline.allows():
+      self.degraded = True
+      return None
+    try:
+      return await fn(*args)
+    except DeadlineExceeded:
+      logger.warning(f'HandlerBase: skipped {fn.__name__} for {self.manifestid}, request budget exhausted')
+      self.degraded = True
+      return None
+
+  def _read_cache(self):
+    cached = manifest_cache.get(self.manifestid)
+    return cached, (manifest_cache.metadata(self.manifestid) or {}) if cached else None
+
+  def _from_cache(self, cached, cache_metadata=None, ahead=0):
+    '''Template of a cached manifest, sets stale and stale_in as seen ahead seconds from now, None past the hard TTL'''
+    logger.info(f'HandlerBase: source={self.source} sourceid={self.sourceid} baseurl={self.baseurl} cached={cached is not None} refresh={self.refresh}')
+    if not cached:
+      return None
+    template = rendition.load(cached, self._template_facts)
+    rendition.stored_as(self.manifestid, template)
+    return template if self._check_ttls(template, cache_metadata, ahead) else None
+
+  def _check_ttls(self, template, cache_metadata, ahead=0):
+    '''Sets stale and stale_in for a stored template as seen ahead seconds from now, False past the hard TTL.
+    The summary of the template is recorded with the times, so summary lookups honour them too.'''
+    at = datetime.now() + timedelta(seconds=ahead)
+    soft_ttl_in = 0
+    expires = None
+    manifest_last_updated = template.facts.get('updated')
+    if manifest_last_updated:
+      manifest_last_updated = datetime.strptime(manifest_last_updated, TIMESTAMP_FORMAT)
+      if (at - manifest_last_updated).days > HARD_TTL_DAYS:
+        return False
+      expires = (manifest_last_updated + timedelta(days=HARD_TTL_DAYS + 1)).timestamp()
+      soft_ttl_in = (manifest_last_updated + timedelta(days=SOFT_TTL_DAYS) - at).total_seconds()
+      logger.debug(f'manifest_last_updated={manifest_last_updated} soft_ttl_in={soft_ttl_in}')
+    change_check_in = self._change_check_in(cache_metadata, at)
+    # past the soft TTL the manifest is rebuilt whatever its change token says, the token may not cover every input
+    self.change_check = soft_ttl_in > 0 and change_check_in is not None and change_check_in <= 0
+    self.stale = soft_ttl_in <= 0 or self.change_check
+    self.stale_in = ahead + min(soft_ttl_in, soft_ttl_in if change_check_in is None else change_check_in)
+    summaries.record(self.manifestid, template, due=now() + self.stale_in, expires=expires)
+    return True
+
+  @property
+  def m(self):
+    # cache hits are served from the template, the manifest is only parsed when a handler works on it
+    if self._m is None and self.template is not None:
+      self._m = self.template.manifest()
+    return self._m
+
+  @m.setter
+  def m(self, m):
+    self._m = m
+
+  def _template_facts(self, m):
+    '''Values checked on a cache hit, taken from the manifest when it is saved or first loaded'''
+    canvas = self._find_item('Canvas', obj=m) or {}
+    body = self._find_item(type='Annotation', attr='motivation', attr_val='painting', sub_attr='body', obj=m) or {}
+    return {
+      'updated': next(iter([list(md['value'].values())[0][0] for md in m.get('metadata',[]) if 'updated' in [list(md['label'].values())[0][0]]]), None),
+      'format': canvas.get('format'),
+      'body_id': body.get('id'),
+      'body_type': body.get('type'),
+      'body_format': body.get('format'),
+      'service_id': body['service'][0].get('id') if body.get('service') else None,
+      'thumbnail': 'thumbnail' in m,
+      'summary': summarize(m)
+    }
+
+  def _facts(self):
+    return self._template_facts(self._m) if self._m is not None else self.template.facts
+
+  def _change_check_in(self, cache_metadata, at):
+    '''Seconds from at until the change token is due for a check, None for manifests saved without one'''
+    if not cache_metadata or 'change-token' not in cache_metadata:
+      return None
+    if 'checked' not in cache_metadata:
+      return 0
+    return (datetime.strptime(cache_metadata['checked'], TIMESTAMP_FORMAT) + timedelta(hours=CHANGE_CHECK_HOURS) - at).total_seconds()
+
+  def refresh_ahead(self, lead):
+    '''Revalidates the cached manifest now if it would go stale within lead seconds, for use off the request path.
+    Returns the seconds until the manifest is next due, None when that is unknown.'''
+    cached, cache_metadata = self._read_cache()
+    template = self._from_cache(cached, cache_metadata, ahead=lead)
+    if template is not None and not self.stale:
+      return self.stale_in - lead
+    if template is None:
+      self._rebuild()
+    else:
+      self._revalidate(cached, cache_metadata['change-token'] if self.change_check else None)
+    cached, cache_metadata = self._read_cache()
+    return self.stale_in if self._from_cache(cached, cache_metadata) is not None and not self.stale else None
+
+  def _rebuild(self):
+    start = now()
+    # edison and harvard handlers are constructed from the source url rather than the sourceid
+    type(self)(getattr(self, '_url', self.sourceid), baseurl=self.baseurl, language=self.language, refresh=True)
+    logger.info(f'HandlerBase: rebuilt stale manifest {self.manifestid} elapsed={round(now()-start,3)}')
+
+  def _revalidate(self, cached, token):
+    '''Rebuilds a stale manifest unless its change token shows the upstream source is unchanged,
+    an unchanged manifest is saved again with a new check time'''
+    if token:
+      start = now()
+      try:
+        with revalidating(True):
+          current = self.upstream_change_token(Deadline())
+      except Exception as exc:
+        logger.warning(f'HandlerBase: change token lookup failed for {self.manifestid}: {exc}')
+        current = None
+      logger.info(f'HandlerBase: change check {self.manifestid} token={token} current={current} elapsed={round(now()-start,3)}')
+      if current is not None and str(current) == token:
+        manifest_cache.put(self.manifestid, cached, metadata=rendition.stored_metadata(cached, self._cache_metadata(token)))
+        return
+    self._rebuild()
+
+  def _schedule_revalidate(self, cached, cache_metadata):
+    token = cache_metadata['change-token'] if self.change_check else None
+    if run_background(f'rebuild:{self.manifestid}', self._revalidate, cached, token):
+      logger.info(f'HandlerBase: serving stale manifest {self.manifestid}, {"change check" if token else "rebuild"} scheduled')
+
+  def _new_manifest(self):
+    return {
+      '@context': 'http://iiif.io/api/presentation/3/context.json',
+      'id': f'{{BASE_URL}}/{self.manifestid}/manifest.json',
+      'type': 'Manifest',
+      'items': [{
+        'type': 'Canvas',
+        'id': f'{{BASE_URL}}/{self.manifestid}/canvas/p1',
         'items': [{
-          'type': 'Canvas',
-          'id': f'{{BASE_URL}}/{self.manifestid}/canvas/p1',
+          'type': 'AnnotationPage',
+          'id': f'{{BASE_URL}}/{self.manifestid}/p1/1',
           'items': [{
-            'type': 'AnnotationPage',
-            'id': f'{{BASE_URL}}/{self.manifestid}/p1/1',
-            'items': [{
-              'type': 'Annotation',
-              'id': f'{{BASE_URL}}/{self.manifestid}/annotation/p0001-image',
-              'motivation': 'painting',
-              'target': f'{{BASE_URL}}/{self.manifestid}/canvas/p1',
-              'body': {
-                'id': self.image_url,
-                'format': '',
-              } 
-            }]
+            'type': 'Annotation',
+            'id': f'{{BASE_URL}}/{self.manifestid}/annotation/p0001-image',
+            'motivation': 'painting',
+            'target': f'{{BASE_URL}}/{self.manifestid}/canvas/p1',
+            'body': {
+              'id': self.image_url,
+              'format': '',
+            } 
           }]
         }]
-      }
-      self.init_manifest()
-      if not self.external_manifest_url:
-        self.add_metadata(self._language_map('updated', datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')))
-        self.set_service()
+      }]
+    }
 
-        if self.image_url:
-          related = self._get_related_entities()
-          if related and 'P180' in related:
-            self.add_metadata(self._language_map('depicts', [item['id'] for item in related['P180']]))
+  def _add_related_entities(self, related):
+    if related and 'P180' in related:
+      self.add_metadata(self._language_map('depicts', [item['id'] for item in related['P180']]))
 
-          manifest_cache[self.manifestid] = json.dumps(self.m)
+  async def araw_props(self):
+    return {}
 
-    logger.debug(f'HandlerBase: elapsed={round(now()-start,3)}')
+  def _check_negative(self, key):
+    '''Fails fast on an upstream key that recently failed, a refresh clears the entry instead'''
+    if self.refresh:
+      negative_cache.clear(key)
+    else:
+      negative_cache.check(key)
+
+  def _source_not_found(self, key, reason='not found'):
+    return negative_cache.record(key, SourceNotFound(key, reason))
 
   @property
   def canvas(self):
@@ -326,17 +578,22 @@ class HandlerBase(object):
     lm_values = set([val for values in lm['value'].values() for val in values])
     qids = [qid for qid in lm_values if qid[0] == 'Q' and qid[1:].isdigit()]
     if qids:
-      labels_needed = [qid for qid in qids if qid not in entity_labels]
+      # one read per qid, a membership test ahead of the read would go through the cache tiers twice
+      labels = dict([(qid, entity_labels.get(qid)) for qid in qids])
+      labels_needed = [qid for qid, label in labels.items() if label is None and qid not in self._labels_looked_up]
       if labels_needed:
-        entity_labels.update(self.get_entity_labels(labels_needed, self.language))
+        self._labels_looked_up.update(labels_needed)
+        found = self._enrich(self.get_entity_labels, labels_needed, self.language) or {}
+        entity_labels.update(found)
+        labels.update(found)
       for lang in lm['value']:
-        lm['value'][lang] = [f'<a href="https://www.wikidata.org/wiki/{qid}">{entity_labels.get(qid,qid)}</a>' for qid in lm['value'][lang]]
+        lm['value'][lang] = [f'<a href="https://www.wikidata.org/wiki/{qid}">{labels.get(qid) or qid}</a>' for qid in lm['value'][lang]]
     return lm
 
   _cached_media_info = None
   def _media_info(self, url):
     if not self._cached_media_info:
-      self._cached_media_info = MediaInfo()(url=url)
+      self._cached_media_info = MediaInfo()(url=url, deadline=self.deadline)
     return self._cached_media_info
 
   def _find_item(self, type, attr=None, attr_val=None, sub_attr=None, obj=None):
@@ -378,9 +635,27 @@ class HandlerBase(object):
   def _image_id(self):
     return sha256(self.image_url.encode('utf-8')).hexdigest()
 
+  @property
+  def _info_json_url(self):
+    return f'{self._image_service}/{self._image_id}/info.json'
+
+  def _set_info_json_status(self, status):
+    self._info_json_status = status
+    if status == 200:
+      image_service_states[self._info_json_url] = 200
+    return status == 200
+
   def _info_json_exists(self):
-    info_json_url = f'{self._image_service}/{self._image_id}/info.json'
-    return requests.head(info_json_url).status_code == 200
+    if self._info_json_status is None:
+      return self._set_info_json_status(image_service_states.get(self._info_json_url) or http_client.head(self._info_json_url, deadline=self.deadline).status_code)
+    return self._info_json_status == 200
+
+  async def _ainfo_json_exists(self):
+    # fetched ahead of set_service, which does not look the image up on a refresh
+    if self._info_json_status is None and not self.refresh:
+      status = await run_io(image_service_states.get, self._info_json_url) or (await http_client.ahead(self._info_json_url, deadline=self.deadline)).status_code
+      return await run_io(self._set_info_json_status, status)
+    return self._info_json_status == 200
 
   def _service_endpoint(self):
     if self.refresh or not self._info_json_exists():
@@ -425,19 +700,26 @@ class HandlerBase(object):
 
     self.is_updated = True
 
+  # entity and label lookups from concurrent builds are batched into one wbgetentities or SPARQL VALUES request
+  @staticmethod
+  def _labels(labels):
+    return dict([(qid, label) for (qid, _), label in labels.items() if label])
+
   def get_entity_labels(self, qids, lang='en'):
-    values = ' '.join([f'(<http://www.wikidata.org/entity/{qid}>)' for qid in qids])
-    query = f'SELECT ?item ?label WHERE {{ VALUES (?item) {{ {values} }} ?item rdfs:label ?label . FILTER (LANG(?label) = "{lang}" || LANG(?label) = "en") .}}'
-    resp = requests.get(
-      f'https://query.wikidata.org/sparql?query={quote(query)}',
-      headers = {
-        'Content-Type': 'application/x-www-form-urlencoded', 
-        'Accept': 'application/sparql-results+json',
-        'User-Agent': 'Labs Client'
-      }
-    )
-    if resp.status_code == 200:
-      return dict([(rec['item']['value'].split('/')[-1],rec['label']['value']) for rec in resp.json()['results']['bindings']])
+    return self._labels(entity_label_loader.load_many([(qid, lang) for qid in qids], self.deadline))
+
+  async def aget_entity_labels(self, qids, lang='en'):
+    return self._labels(await entity_label_loader.aload_many([(qid, lang) for qid in qids], self.deadline))
+
+  def _labels_needed(self, qids):
+    return [qid for qid in qids if qid[0] == 'Q' and qid[1:].isdigit() and qid not in self._labels_looked_up and entity_labels.get(qid) is None]
+
+  async def _aprefetch_entity_labels(self, qids):
+    # qids without a label are remembered too, so _link_qids does not look them up again with a blocking call
+    labels_needed = await run_io(self._labels_needed, qids)
+    if labels_needed:
+      self._labels_looked_up.update(labels_needed)
+      await run_io(entity_labels.update, await self._aenrich(self.aget_entity_labels, labels_needed, self.language) or {})
   
   def is_attribution_required(self):
     return 'rights' in self.m and 'creativecommons.org/licenses/by' in self.m['rights']
@@ -448,22 +730,29 @@ class HandlerBase(object):
     logger.debug(f'labels={labels} values={values}')
     return 'attribution' in labels
 
-  def _get_related_entities(self):
+  def _related_entities_request(self):
     hash = hashlib.sha256(self.image_url.encode('utf-8')).hexdigest()
     query = f'_id:"{hash}"'
-    resp = requests.post(
-      'https://www.jstor.org/api/labs-search-service/labs/about/',
-      headers = {
-        'User-Agent': 'Labs client',
+    return {
+      'url': 'https://www.jstor.org/api/labs-search-service/labs/about/',
+      'headers': {
         'Content-Type': 'application/json',
         'Accept': 'application/json',
       },
-      json = {'query': {'query_string': {'query': query}}, 'size': 100}
-    )
-    logger.debug(f'get_related_entities: {query} {resp.status_code}')
+      'json': {'query': {'query_string': {'query': query}}, 'size': 100}
+    }
+
+  def _get_related_entities(self):
+    return self._parse_related_entities(http_client.post(**self._related_entities_request(), deadline=self.deadline))
+
+  async def _aget_related_entities(self):
+    return self._parse_related_entities(await http_client.apost(**self._related_entities_request(), deadline=self.deadline))
+
+  def _parse_related_entities(self, resp):
+    logger.debug(f'get_related_entities: {resp.status_code}')
+    results = resp.json() if resp.status_code == 200 else None
     related = {}
-    if resp.status_code == 200:
-      results = resp.json()
+    if results:
       # logger.info(json.dumps(results,indent=2))
       for doc in results.get('hits',{}).get('hits',[]):
         for prop in doc['_source']['statements']:
@@ -484,30 +773,72 @@ class HandlerBase(object):
     _elem = soup.select_one(f'[lang="{lang}"]')
     return (_elem.text if _elem else soup.text).strip()
 
-  def _get_wc_metadata(self, title):
-    url = f'https://commons.wikimedia.org/w/api.php?format=json&action=query&titles=File:{quote(title)}&prop=imageinfo&iiprop=extmetadata|size|mime'
-    resp = requests.get(url)
-    logger.debug(f'{url} {resp.status_code}')
+  # lookups used by the sync and async builds share their urls and parsing, only the fetches differ
+
+  @staticmethod
+  def _wc_metadata_url(title):
+    return f'https://commons.wikimedia.org/w/api.php?format=json&action=query&titles=File:{quote(title)}&prop=imageinfo|info&iiprop=extmetadata|size|mime'
+
+  @staticmethod
+  def _parse_wc_metadata(resp):
+    logger.debug(f'{resp.url} {resp.status_code}')
     if resp.status_code == 200:
       return list(resp.json()['query']['pages'].values())[0]
 
+  @staticmethod
+  def _remember(cache, key, entity):
+    if entity:
+      cache[key] = entity
+    return entity
+
+  @staticmethod
+  def _remember_wc_entity(entity):
+    # entities looked up by title are also found by page id later
+    if entity and 'pageid' in entity:
+      wc_entities[entity['pageid']] = entity
+    return entity
+
+  def _get_wc_metadata(self, title):
+    return self._parse_wc_metadata(http_client.get(self._wc_metadata_url(title), deadline=self.deadline))
+
   def _get_wc_entity(self, pageid):
-    if pageid not in wc_entities:
-      url = f'https://commons.wikimedia.org/wiki/Special:EntityData/M{pageid}.json'
-      resp = requests.get(url)
-      logger.debug(f'get_wc_entity: url={url} status={resp.status_code}')
-      if resp.status_code == 200:
-        wc_entities[pageid] = resp.json()['entities'][f'M{pageid}']
-    return wc_entities.get(pageid)
+    return wc_entities.get(pageid) or self._remember(wc_entities, pageid, wc_entity_loader.load(pageid, self.deadline))
+
+  def _get_wc_entity_by_title(self, title):
+    return self._remember_wc_entity(wc_title_entity_loader.load(unquote(title), self.deadline))
+
+  def _resolve_wc_entity(self, wc_metadata, entity):
+    # the entity is looked up by title alongside the metadata, the page id is only needed as a fallback
+    if entity is None and wc_metadata and 'pageid' in wc_metadata:
+      entity = self._get_wc_entity(wc_metadata['pageid'])
+    return entity
 
   def _get_wd_entity(self, qid):
-    if qid not in wd_entities:
-      resp = requests.get(f'https://www.wikidata.org/wiki/Special:EntityData/{qid}.json')
-      if resp.status_code == 200:
-        results = resp.json()
-        if qid in results['entities']:
-          wd_entities[qid] = results['entities'][qid]
-    return wd_entities.get(qid)
+    return wd_entities.get(qid) or self._remember(wd_entities, qid, wd_entity_loader.load(qid, self.deadline))
+
+  def _get_wd_revision(self, qid, deadline):
+    return wd_revision_loader.load(qid, deadline)
+
+  def _get_wc_revision(self, title, deadline):
+    return wc_revision_loader.load(unquote(title), deadline)
+
+  async def _aget_wc_metadata(self, title):
+    return self._parse_wc_metadata(await http_client.aget(self._wc_metadata_url(title), deadline=self.deadline))
+
+  # the entity caches have shared tiers, they are read and written in io workers
+  async def _aget_wc_entity(self, pageid):
+    return await run_io(wc_entities.get, pageid) or await run_io(self._remember, wc_entities, pageid, await wc_entity_loader.aload(pageid, self.deadline))
+
+  async def _aget_wc_entity_by_title(self, title):
+    return await run_io(self._remember_wc_entity, await wc_title_entity_loader.aload(unquote(title), self.deadline))
+
+  async def _aresolve_wc_entity(self, wc_metadata, entity):
+    if entity is None and wc_metadata and 'pageid' in wc_metadata:
+      entity = await self._aget_wc_entity(wc_metadata['pageid'])
+    return entity
+
+  async def _aget_wd_entity(self, qid):
+    return await run_io(wd_entities.get, qid) or await run_io(self._remember, wd_entities, qid, await wd_entity_loader.aload(qid, self.deadline))
 
   def _digital_representation_of(self, entity):
     if entity:
@@ -531,29 +862,35 @@ class HandlerBase(object):
         val = statements['P1259'][0]['mainsnak']['datavalue']['value']
         return f'{val["latitude"]},{val["longitude"]}'
 
-  def get_manifest(self):
+  def _prepare(self):
+    '''Fixes applied to the manifest before it is served, True when the manifest changed'''
+    facts = self._facts()
+    if not facts['body_type'] and facts['body_id']:
+      self.image_url = facts['body_id']
+      self.set_service(refresh=True)
+      self._save()
+      return True
+    return False
+
+  def rendition(self):
+    '''The manifest as served, a cache hit is spliced from its stored template without parsing it'''
     if self.external_manifest_url:
-      if self.external_manifest_url not in external_manifests:
-        external_manifests[self.external_manifest_url] = requests.get(self.external_manifest_url).json()
-      return external_manifests[self.external_manifest_url]
-    else:
-      manifest = json.loads(json.dumps(self.m).replace('{BASE_URL}', self.baseurl))
-      '''
-      if self.source == 'wc':
-        body = self._find_item(type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
-        if body.get('type') == 'Image' and body.get('format') not in ('image/gif',):
-          if 'service' not in body or 'zoomviewer.toolforge.org' in body['service'][0]['id']:
-            self.image_url = self._image_url_from_sourceid()
-            self.set_service(refresh=True)
-            manifest = json.loads(json.dumps(self.m).replace('{BASE_URL}', self.baseurl))
-      '''
-      body = self._find_item(type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
-      
-      if 'type' not in body and 'id' in body:
-        self.image_url = body['id']
-        self.set_service(refresh=True)
-        manifest = json.loads(json.dumps(self.m).replace('{BASE_URL}', self.baseurl))
-        manifest_cache[self.manifestid] = json.dumps(self.m)
-  
-      # logger.info(json.dumps(manifest, indent=2))
-      return manifest
\ No newline at end of file
+      manifest = external_manifests.get(self.external_manifest_url)
+      if manifest is None:
+        manifest = external_manifests[self.external_manifest_url] = http_client.get(self.external_manifest_url, deadline=self.deadline).json()
+      return Rendition(Template(json.dumps(manifest)), self.baseurl, manifest)
+    if self._prepare() or self.template is None:
+      self.template = Template(json.dumps(self.m))
+    return Rendition(self.template, self.baseurl, manifestid=self.manifestid)
+
+  async def arendition(self):
+    if self.external_manifest_url and await run_io(external_manifests.get, self.external_manifest_url) is None:
+      manifest = (await http_client.aget(self.external_manifest_url, deadline=self.deadline)).json()
+      await run_io(external_manifests.__setitem__, self.external_manifest_url, manifest)
+    return await run_io(self.rendition)
+
+  async def aget_manifest(self):
+    return (await self.arendition()).manifest
+
+  def get_manifest(self):
+    return self.rendition().manifest
\ No newline at end of file
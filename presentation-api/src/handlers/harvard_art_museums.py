@@ -11,14 +11,16 @@ BASEDIR = os.path.dirname(SCRIPT_DIR)
 
 from handlers.handler_base import HandlerBase
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
 
 def is_image(url):
-  return requests.head(url).headers.get('Content-Type','').startswith('image')
+  return http_client.head(url).headers.get('Content-Type','').startswith('image')
 
 class Handler(HandlerBase):
 
+  # collection records rarely change
+  cache_max_age = 86400
+
   @staticmethod
   def can_handle(url):
     path_elems = url.split('?')[0].split('/')
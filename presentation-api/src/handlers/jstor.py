@@ -17,10 +17,13 @@ from handlers.handler_base import HandlerBase
 
 from licenses import CreativeCommonsLicense, RightsStatement
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
 
 JSTOR_API_KEY = os.environ.get('JSTOR_API_KEY')
+JSTOR_HEADERS = {
+  'Content-Type': 'application/json',
+  'Authorization': f'Bearer {JSTOR_API_KEY}'
+}
 
 class Handler(HandlerBase):
 
@@ -101,25 +104,43 @@ class Handler(HandlerBase):
     if self.is_attribution_required and 'ps_source' in props:
       self.set_requiredStatement({'label': 'attribution', 'value': props['ps_source']})
 
+  # the props are parsed by the same functions for the sync and async builds, only the fetches differ
+
+  def _metadata_url(self):
+    return f'https://www.jstor.org/api/labs-search-service/metadata/10.2307/{self.sourceid}'
+
+  @staticmethod
+  def _parse_metadata(resp):
+    props = resp.json() if resp.status_code == 200 else {}
+    logger.debug(json.dumps(props, indent=2))
+    return props
+
+  @staticmethod
+  def _image_info_url(props):
+    iiif_url_fragment = props['iiifUrls'][0].split("/iiif/")[1] if 'iiifUrls' in props and len(props['iiifUrls']) > 0 else None
+    if iiif_url_fragment:
+      info_json_url = f'https://www.jstor.org/iiif/{iiif_url_fragment}/info.json'
+      return f'https://api.juncture-digital.org/image-info/?url={quote(info_json_url)}'
+
+  @staticmethod
+  def _add_image_info(props, resp):
+    if resp is not None:
+      props['iiif_info'] = resp.json() if resp.status_code == 200 else {}
+    return props
+
   @property
   def raw_props(self):
     if self._raw_props is None:
-      resp = requests.get(
-        f'https://www.jstor.org/api/labs-search-service/metadata/10.2307/{self.sourceid}',
-        headers = {
-          'Content-Type': 'application/json',
-          'User-Agent': 'Labs python client',
-          'Authorization': f'Bearer {JSTOR_API_KEY}'
-        }
-      )
-      props = resp.json() if resp.status_code == 200 else {}
-      logger.info(json.dumps(props, indent=2))
-      iiif_url_fragment = props['iiifUrls'][0].split("/iiif/")[1] if 'iiifUrls' in props and len(props['iiifUrls']) > 0 else None
-      if iiif_url_fragment:
-        info_json_url = f'https://www.jstor.org/iiif/{iiif_url_fragment}/info.json'
-        resp = requests.get(f'https://api.juncture-digital.org/image-info/?url={quote(info_json_url)}')
-        props['iiif_info'] = resp.json() if resp.status_code == 200 else {}
-      self._raw_props = props
+      props = self._parse_metadata(http_client.get(self._metadata_url(), headers=JSTOR_HEADERS, deadline=self.deadline))
+      info_url = self._image_info_url(props)
+      self._raw_props = self._add_image_info(props, http_client.get(info_url, deadline=self.deadline) if info_url else None)
+    return self._raw_props
+
+  async def araw_props(self):
+    if self._raw_props is None:
+      props = self._parse_metadata(await http_client.aget(self._metadata_url(), headers=JSTOR_HEADERS, deadline=self.deadline))
+      info_url = self._image_info_url(props)
+      self._raw_props = self._add_image_info(props, await http_client.aget(info_url, deadline=self.deadline) if info_url else None)
     return self._raw_props
   
   def info_json(self):
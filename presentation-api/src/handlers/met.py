@@ -12,11 +12,13 @@ BASEDIR = os.path.dirname(SCRIPT_DIR)
 from handlers.handler_base import HandlerBase
 from licenses import CreativeCommonsLicense, RightsStatement
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
 
 class Handler(HandlerBase):
 
+  # collection records rarely change
+  cache_max_age = 86400
+
   @staticmethod
   def can_handle(url):
     return url.startswith('https://www.metmuseum.org/art/collection/')
@@ -31,6 +33,7 @@ class Handler(HandlerBase):
     return f'met:{sourceid.replace("?","%3F").replace("&","%26")}'
   
   def __init__(self, sourceid, **kwargs):
+    self._raw_props = None
     super().__init__('met', sourceid, **kwargs)
 
   def init_manifest(self):
@@ -86,12 +89,23 @@ class Handler(HandlerBase):
     }
 
   @property
-  def raw_props(self):
-    resp = requests.get(
-      f'https://collectionapi.metmuseum.org/public/collection/v1/objects/{self.sourceid}',
-      headers = {
-          'Content-Type': 'application/json',
-          'User-Agent': 'Labs python client'
-      }
-    )
+  def _object_url(self):
+    return f'https://collectionapi.metmuseum.org/public/collection/v1/objects/{self.sourceid}'
+
+  def _object_props(self, resp):
+    if resp.status_code == 404:
+      raise self._source_not_found(f'met:{self.sourceid}', 'object not found')
     return resp.json() if resp.status_code == 200 else {}
+
+  @property
+  def raw_props(self):
+    if self._raw_props is None:
+      self._check_negative(f'met:{self.sourceid}')
+      self._raw_props = self._object_props(http_client.get(self._object_url, headers = {'Content-Type': 'application/json'}, deadline=self.deadline))
+    return self._raw_props
+
+  async def araw_props(self):
+    if self._raw_props is None:
+      self._check_negative(f'met:{self.sourceid}')
+      self._raw_props = self._object_props(await http_client.aget(self._object_url, headers = {'Content-Type': 'application/json'}, deadline=self.deadline))
+    return self._raw_props
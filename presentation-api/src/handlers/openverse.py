@@ -15,8 +15,7 @@ OPENVERSE_CLIENT_SECRET = os.environ.get('OPENVERSE_CLIENT_SECRET')
 from handlers.handler_base import HandlerBase
 from licenses import CreativeCommonsLicense, RightsStatement
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
 
 access_token = None
 
@@ -40,19 +39,37 @@ class Handler(HandlerBase):
     return f'cc:{sourceid.replace("?","%3F").replace("&","%26")}'
   
   def __init__(self, sourceid, **kwargs):
+    self._raw_props = None
     super().__init__('cc', sourceid, **kwargs)
 
-  def _get_access_token(self):
-    resp = requests.post(
-      f'https://api.openverse.engineering/v1/auth_tokens/token/',
-      data={
-        'client_id': OPENVERSE_CLIENT_ID,
-        'client_secret': OPENVERSE_CLIENT_SECRET,
-        'grant_type': 'client_credentials'
-      }
-    )
+  _token_request = {
+    'url': 'https://api.openverse.engineering/v1/auth_tokens/token/',
+    'data': {
+      'client_id': OPENVERSE_CLIENT_ID,
+      'client_secret': OPENVERSE_CLIENT_SECRET,
+      'grant_type': 'client_credentials'
+    }
+  }
+
+  # responses are parsed by the same functions for the sync and async builds, only the fetches differ
+
+  @staticmethod
+  def _access_token(resp):
     return resp.json()['access_token'] if resp.status_code == 200 else None
 
+  def _get_access_token(self):
+    return self._access_token(http_client.post(**self._token_request, deadline=self.deadline))
+
+  async def _aget_access_token(self):
+    return self._access_token(await http_client.apost(**self._token_request, deadline=self.deadline))
+
+  def _image_request(self):
+    return {'url': f'https://api.openverse.engineering/v1/images/{self.sourceid}', 'headers': {'Authorization': f'Bearer {access_token}'}}
+
+  @staticmethod
+  def _image_props(resp):
+    return resp.json() if resp.status_code == 200 else {}
+
   def init_manifest(self):
     props = self.raw_props
 
@@ -107,10 +124,16 @@ class Handler(HandlerBase):
   @property
   def raw_props(self):
     global access_token
-    if access_token is None:
-      access_token = self._get_access_token()
-    resp = requests.get(
-      f'https://api.openverse.engineering/v1/images/{self.sourceid}',
-      headers = {'Authorization': f'Bearer {access_token}'}
-    )
-    return resp.json() if resp.status_code == 200 else {}
+    if self._raw_props is None:
+      if access_token is None:
+        access_token = self._get_access_token()
+      self._raw_props = self._image_props(http_client.get(**self._image_request(), deadline=self.deadline))
+    return self._raw_props
+
+  async def araw_props(self):
+    global access_token
+    if self._raw_props is None:
+      if access_token is None:
+        access_token = await self._aget_access_token()
+      self._raw_props = self._image_props(await http_client.aget(**self._image_request(), deadline=self.deadline))
+    return self._raw_props
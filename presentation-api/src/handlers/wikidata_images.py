@@ -15,6 +15,7 @@ from urllib.parse import quote
 
 from handlers.handler_base import HandlerBase
 from licenses import CreativeCommonsLicense, RightsStatement
+from fetch_plan import FetchPlan
 
 class Handler(HandlerBase):
 
@@ -104,21 +105,56 @@ class Handler(HandlerBase):
     _depicts = list(set([self.sourceid] + [item['id'] for item in self._depicts(props['wd_entity'])]))
     self.add_metadata('depicts', _depicts)
   
+  def _checked_wd_entity(self, entity):
+    if not entity:
+      raise self._source_not_found(f'wd:{self.sourceid}', 'entity not found')
+    if 'P6108' in entity['claims']:
+      self.external_manifest_url = entity['claims']['P6108'][0]['mainsnak']['datavalue']['value']
+      logger.info(f'manifest={self.external_manifest_url}')
+    return entity
+
+  def _title(self, wd_entity):
+    if self.external_manifest_url:
+      return None
+    title = self._wc_image_title(wd_entity)
+    if not title:
+      raise self._source_not_found(f'wd:{self.sourceid}', 'no image (P18)')
+    return title
+
+  async def _awd_entity(self):
+    return self._checked_wd_entity(await self._aget_wd_entity(self.sourceid))
+
+  async def _awc_metadata(self, title):
+    return await self._aget_wc_metadata(title) if title else None
+
+  async def _awc_entity_by_title(self, title):
+    return await self._aget_wc_entity_by_title(title) if title else None
+
+  def _fetch_plan(self):
+    return FetchPlan(self.manifestid) \
+      .step('wd_entity', lambda: self._checked_wd_entity(self._get_wd_entity(self.sourceid)), afn=self._awd_entity) \
+      .step('title', self._title, 'wd_entity', inline=True) \
+      .step('wc_metadata', lambda title: self._get_wc_metadata(title) if title else None, 'title', afn=self._awc_metadata) \
+      .step('_wc_entity_by_title', lambda title: self._get_wc_entity_by_title(title) if title else None, 'title', afn=self._awc_entity_by_title) \
+      .step('wc_entity', self._resolve_wc_entity, 'wc_metadata', '_wc_entity_by_title', afn=self._aresolve_wc_entity)
+
+  def change_token(self):
+    return self.raw_props['wd_entity'].get('lastrevid')
+
+  def upstream_change_token(self, deadline):
+    return self._get_wd_revision(self.sourceid, deadline)
+
   @property
   def raw_props(self):
     if not self._raw_props:
-      props = {}
-      props['wd_entity'] = self._get_wd_entity(self.sourceid)
-      if 'P6108' in props['wd_entity']['claims']:
-        self.external_manifest_url = props['wd_entity']['claims']['P6108'][0]['mainsnak']['datavalue']['value']
-        logger.info(f'manifest={self.external_manifest_url}')
-      else:
-        title = self._wc_image_title()
-        if title:
-          props['title'] = title
-          props['wc_metadata'] = self._get_wc_metadata(title)
-          props['wc_entity'] = self._get_wc_entity(props['wc_metadata']['pageid'])
-      self._raw_props = props
+      self._check_negative(f'wd:{self.sourceid}')
+      self._raw_props = self._fetch_plan().run(self.deadline)
+    return self._raw_props
+
+  async def araw_props(self):
+    if not self._raw_props:
+      self._check_negative(f'wd:{self.sourceid}')
+      self._raw_props = await self._fetch_plan().arun(self.deadline)
     return self._raw_props
 
   def _image_url_from_sourceid(self, width=None):
@@ -134,8 +170,8 @@ class Handler(HandlerBase):
       elif extension == 'tif' or extension == 'tiff': img_url += '.jpg'
     return img_url
 
-  def _wc_image_title(self):
-    entity = self._get_wd_entity(self.sourceid)
+  def _wc_image_title(self, entity=None):
+    entity = entity or self._get_wd_entity(self.sourceid)
     image_statement = entity['claims']['P18'] if 'P18' in entity['claims'] else None
     if image_statement:
       image_statement = image_statement[0] if isinstance(image_statement,list) else [image_statement]
@@ -15,6 +15,7 @@ from urllib.parse import quote, unquote
 
 from handlers.handler_base import HandlerBase
 from licenses import CreativeCommonsLicense, RightsStatement
+from fetch_plan import FetchPlan
 
 # import requests
 # logging.getLogger('requests').setLevel(logging.WARNING)
@@ -140,22 +141,66 @@ class Handler(HandlerBase):
   def _service_endpoint(self):
     return f'https://zoomviewer.toolforge.org/proxy.php?iiif={self.sourceid.replace(".tif",".jpg")}' if USE_WC_IIIF else super()._service_endpoint()
 
-  def get_manifest(self):
-    self.image_url = self._image_url_from_sourceid()
+  def _prepare(self):
+    # the image url and service are derived from the title on every request, a cached manifest
+    # that already carries them is served without being parsed or touched
+    url = self._image_url_from_sourceid()
+    if self._m is None and self._serves_as_stored(self.template.facts, url):
+      return False
+    self.image_url = url
     self.set_service(refresh=True)
-    manifest = json.loads(json.dumps(self.m).replace('{BASE_URL}', self.baseurl))
-    # logger.info(json.dumps(manifest, indent=2))
-    return manifest
+    return True
+
+  def _serves_as_stored(self, facts, url):
+    if not facts.get('format') or facts.get('body_id') != url:
+      return False
+    if facts.get('body_type') == 'Image' and facts.get('body_format') not in ('image/gif',):
+      return facts.get('thumbnail') and facts.get('service_id') == self._service_endpoint()
+    return True
+
+  def _checked_wc_metadata(self, wc_metadata):
+    if wc_metadata and 'missing' in wc_metadata:
+      raise self._source_not_found(f'wc:{self.sourceid}', 'file not found')
+    return wc_metadata
+
+  def _wc_metadata(self):
+    return self._checked_wc_metadata(self._get_wc_metadata(self.sourceid))
+
+  async def _awc_metadata(self):
+    return self._checked_wc_metadata(await self._aget_wc_metadata(self.sourceid))
+
+  def _dro_entity(self, wc_entity):
+    dro_qid = self._digital_representation_of(wc_entity)
+    return self._get_wd_entity(dro_qid) if dro_qid else None
+
+  async def _adro_entity(self, wc_entity):
+    dro_qid = self._digital_representation_of(wc_entity)
+    return await self._aget_wd_entity(dro_qid) if dro_qid else None
+
+  def _fetch_plan(self):
+    return FetchPlan(self.manifestid) \
+      .step('wc_metadata', self._wc_metadata, afn=self._awc_metadata) \
+      .step('_wc_entity_by_title', lambda: self._get_wc_entity_by_title(self.sourceid), afn=lambda: self._aget_wc_entity_by_title(self.sourceid)) \
+      .step('wc_entity', self._resolve_wc_entity, 'wc_metadata', '_wc_entity_by_title', afn=self._aresolve_wc_entity) \
+      .step('dro_entity', self._dro_entity, 'wc_entity', afn=self._adro_entity)
+
+  def change_token(self):
+    # the page revision moves with new uploads as well as description and structured data edits
+    return (self.raw_props.get('wc_metadata') or {}).get('lastrevid')
+
+  def upstream_change_token(self, deadline):
+    return self._get_wc_revision(self.sourceid, deadline)
 
   @property
   def raw_props(self):
     if self._raw_props is None:
-      props = {}
-      props['wc_metadata'] = self._get_wc_metadata(self.sourceid )
-      if 'pageid' in props['wc_metadata']:
-        props['wc_entity'] = self._get_wc_entity(props['wc_metadata']['pageid'])
-        dro_qid = self._digital_representation_of(props['wc_entity'])
-        props['dro_entity'] = self._get_wd_entity(dro_qid) if dro_qid else None
-      self._raw_props = props
+      self._check_negative(f'wc:{self.sourceid}')
+      self._raw_props = self._fetch_plan().run(self.deadline)
     logger.debug(json.dumps(self._raw_props, indent=2))
     return self._raw_props
+
+  async def araw_props(self):
+    if self._raw_props is None:
+      self._check_negative(f'wc:{self.sourceid}')
+      self._raw_props = await self._fetch_plan().arun(self.deadline)
+    return self._raw_props
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
+from time import time as now
+from email.utils import parsedate_to_datetime
+
+HTTP_CACHE_BYTES = int(os.environ.get('HTTP_CACHE_BYTES', 64 * 1024 * 1024))          # total size of cached bodies
+HTTP_CACHE_MAX_ENTRY = int(os.environ.get('HTTP_CACHE_MAX_ENTRY', 2 * 1024 * 1024))    # larger bodies are never stored
+HTTP_CACHE_HEURISTIC_MAX = int(os.environ.get('HTTP_CACHE_HEURISTIC_MAX', 3600))      # cap on Last-Modified heuristic freshness
+CACHEABLE_STATUS = (200, 203, 300, 301, 308, 404, 410)
+
+# set while a refresh rebuild is running, fresh entries are revalidated instead of served as is
+_revalidate = contextvars.ContextVar('http_cache_revalidate', default=False)
+
+@contextmanager
+def revalidating(enabled=True):
+  token = _revalidate.set(enabled)
+  try:
+    yield
+  finally:
+    _revalidate.reset(token)
+
+def _http_date(value):
+  if not value:
+    return None
+  try:
+    return parsedate_to_datetime(value).timestamp()
+  except (TypeError, ValueError):
+    return None
+
+def _cache_control(headers):
+  directives = {}
+  for directive in headers.get('cache-control', '').split(','):
+    name, _, value = directive.strip().partition('=')
+    if name:
+      directives[name.lower()] = value.strip('"')
+  return directives
+
+def _freshness(headers, received):
+  '''Seconds the response may be served without revalidation, per RFC 9111 section 4.2.1'''
+  cc = _cache_control(headers)
+  if 'no-cache' in cc:
+    return 0
+  for directive in ('s-maxage', 'max-age'):
+    if directive in cc:
+      try:
+        lifetime = int(cc[directive])
+      except ValueError:
+        return 0
+      break
+  else:
+    date = _http_date(headers.get('date')) or received
+    expires = _http_date(headers.get('expires'))
+    last_modified = _http_date(headers.get('last-modified'))
+    if expires is not None:
+      lifetime = expires - date
+    elif last_modified is not None:
+      lifetime = min(HTTP_CACHE_HEURISTIC_MAX, (date - last_modified) * 0.1)
+    else:
+      lifetime = 0
+  try:
+    age = int(headers.get('age', 0))
+  except ValueError:
+    age = 0
+  return max(0, lifetime - age)
+
+class CacheEntry(object):
+
+  __slots__ = ('url', 'status_code', 'headers', 'content', 'vary', 'stored', 'expires')
+
+  def __init__(self, url, status_code, headers, content, vary):
+    self.url = url
+    self.status_code = status_code
+    self.headers = headers
+    self.content = content
+    self.vary = vary
+    self.refresh(headers)
+
+  def refresh(self, headers):
+    self.stored = now()
+    self.expires = self.stored + _freshness(headers, self.stored)
+
+  @property
+  def fresh(self):
+    return now() < self.expires
+
+  @property
+  def size(self):
+    return len(self.content)
+
+  def conditional_headers(self):
+    headers = {}
+    if self.headers.get('etag'):
+      headers['If-None-Match'] = self.headers['etag']
+    if self.headers.get('last-modified'):
+      headers['If-Modified-Since'] = self.headers['last-modified']
+    return headers
+
+  def response(self, method, httpx_response=False):
+    headers = dict(self.headers)
+    headers['age'] = str(int(now() - self.stored))
+    if httpx_response:
+      import httpx
+      return httpx.Response(self.status_code, headers=headers, content=self.content, request=httpx.Request(method, self.url))
+    import requests
+    from requests.structures import CaseInsensitiveDict
+    resp = requests.Response()
+    resp.status_code = self.status_code
+    resp.headers = CaseInsensitiveDict(headers)
+    resp._content = self.content
+    resp.url = self.url
+    resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+    return resp
+
+class HttpCache(object):
+  '''Bounded LRU of GET response bodies, freshness and revalidation follow the upstream cache headers'''
+
+  def __init__(self, max_bytes=HTTP_CACHE_BYTES, max_entry=HTTP_CACHE_MAX_ENTRY):
+    self.max_bytes = max_bytes
+    self.max_entry = max_entry
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.lock = threading.Lock()
+    self.hits = self.revalidated = self.misses = self.stores = self.evictions = 0
+
+  @staticmethod
+  def cacheable_request(method, kwargs):
+    headers = kwargs.get('headers') or {}
+    return method == 'GET' and not kwargs.get('stream') and not kwargs.get('params') \
+      and 'If-None-Match' not in headers and 'If-Modified-Since' not in headers
+
+  @staticmethod
+  def _vary(request_headers, response_headers):
+    names = {name.strip().lower() for name in response_headers.get('vary', '').split(',') if name.strip()}
+    names.add('authorization')
+    request_headers = {name.lower(): value for name, value in (request_headers or {}).items()}
+    return {name: request_headers.get(name) for name in sorted(names)}
+
+  def lookup(self, url, request_headers=None):
+    with self.lock:
+      entry = self.entries.get(url)
+      if entry is None:
+        self.misses += 1
+        return None
+      request_headers = {name.lower(): value for name, value in (request_headers or {}).items()}
+      if any(request_headers.get(name) != value for name, value in entry.vary.items()):
+        self.misses += 1
+        return None
+      self.entries.move_to_end(url)
+      return entry
+
+  def serve(self, entry):
+    '''True when the entry can be returned without contacting the upstream'''
+    if entry.fresh and not _revalidate.get():
+      with self.lock:
+        self.hits += 1
+      return True
+    return False
+
+  def revalidate(self, entry, headers):
+    '''Updates a stored entry from a 304 response'''
+    with self.lock:
+      for name in ('cache-control', 'date', 'expires', 'etag', 'last-modified', 'age'):
+        if headers.get(name):
+          entry.headers[name] = headers[name]
+      entry.refresh(entry.headers)
+      self.revalidated += 1
+    return entry
+
+  def store(self, url, resp, request_headers=None):
+    headers = {name.lower(): value for name, value in resp.headers.items()}
+    cc = _cache_control(headers)
+    # shared by every request the service makes, so responses meant for a single user are not stored either
+    if resp.status_code not in CACHEABLE_STATUS or 'no-store' in cc or 'private' in cc or headers.get('vary', '').strip() == '*':
+      return
+    content = resp.content
+    if len(content) > self.max_entry:
+      return
+    entry = CacheEntry(url, resp.status_code, headers, content, self._vary(request_headers, headers))
+    if not entry.fresh and not entry.conditional_headers():
+      # nothing to gain from an entry that is stale on arrival and cannot be revalidated
+      return
+    with self.lock:
+      previous = self.entries.pop(url, None)
+      if previous is not None:
+        self.bytes -= previous.size
+      self.entries[url] = entry
+      self.bytes += entry.size
+      self.stores += 1
+      while self.bytes > self.max_bytes and self.entries:
+        _, evicted = self.entries.popitem(last=False)
+        self.bytes -= evicted.size
+        self.evictions += 1
+
+  def invalidate(self, url):
+    with self.lock:
+      entry = self.entries.pop(url, None)
+      if entry is not None:
+        self.bytes -= entry.size
+
+  def stats(self):
+    return {
+      'entries': len(self.entries),
+      'bytes': self.bytes,
+      'hits': self.hits,
+      'revalidated': self.revalidated,
+      'misses': self.misses,
+      'stores': self.stores,
+      'evictions': self.evictions
+    }
+
+cache = HttpCache()
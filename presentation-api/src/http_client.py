@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import json
+import asyncio
+import threading
+import weakref
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
+from time import time as now, monotonic
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+logging.getLogger('requests').setLevel(logging.WARNING)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+from deadline import DeadlineExceeded
+from rate_limit import limiter
+from http_cache import cache
+
+USER_AGENT = os.environ.get('HTTP_USER_AGENT', 'JSTOR Labs IIIF presentation service (https://iiif.juncture-digital.org)')
+POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 32)) # number of per-host pools kept open
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 16))         # keep-alive connections kept per host
+USE_HTTP2 = os.environ.get('HTTP2', '').lower() in ('1', 'true')
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+HOST_TIMEOUTS = {
+  'query.wikidata.org': (3.05, 10),
+  'www.wikidata.org': (3.05, 6),
+  'commons.wikimedia.org': (3.05, 6),
+  'upload.wikimedia.org': (3.05, 30),
+  'api.github.com': (3.05, 6),
+  'raw.githubusercontent.com': (3.05, 30),
+  'www.jstor.org': (3.05, 8),
+  'api.juncture-digital.org': (3.05, 8),
+  'iiif-image.juncture-digital.org': (3.05, 4),
+  'www.flickr.com': (3.05, 6),
+  'api.openverse.engineering': (3.05, 6),
+  'collectionapi.metmuseum.org': (3.05, 6),
+}
+
+# API hosts where a slow idempotent request is raced by a second copy, cheap lookups only. query.wikidata.org
+# is not hedged, SPARQL queries count against a per IP query time quota and a second copy doubles the cost
+HEDGED_HOSTS = {
+  'www.wikidata.org', 'commons.wikimedia.org', 'api.github.com',
+  'iiif-image.juncture-digital.org', 'www.flickr.com', 'collectionapi.metmuseum.org'
+}
+HEDGE_METHODS = ('GET', 'HEAD')
+HEDGE_AFTER = float(os.environ.get('HEDGE_AFTER', 1.0))          # delay before hedging while latency samples are few
+HEDGE_MIN_AFTER = float(os.environ.get('HEDGE_MIN_AFTER', 0.25)) # never hedge sooner than this
+HEDGE_PERCENTILE = 0.95
+
+_client = None
+_client_lock = threading.Lock()
+_is_httpx = False
+_async_clients = weakref.WeakKeyDictionary() # one httpx.AsyncClient per event loop
+_hedge_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('HEDGE_WORKERS', 32)), thread_name_prefix='iiif-hedge')
+_latencies = defaultdict(lambda: deque(maxlen=200))
+
+def _http2_available():
+  try:
+    import h2
+    return True
+  except ImportError:
+    return False
+
+def _new_client():
+  global _is_httpx
+  if USE_HTTP2:
+    try:
+      import httpx
+      client = httpx.Client(
+        http2=True,
+        follow_redirects=True,
+        headers={'User-Agent': USER_AGENT},
+        limits=httpx.Limits(max_connections=POOL_CONNECTIONS*POOL_MAXSIZE, max_keepalive_connections=POOL_CONNECTIONS*POOL_MAXSIZE)
+      )
+      _is_httpx = True
+      logger.info('http_client: using httpx transport with HTTP/2')
+      return client
+    except ImportError:
+      logger.warning('http_client: HTTP2 requested but httpx[http2] is not installed, using requests')
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  session.headers['User-Agent'] = USER_AGENT
+  return session
+
+def client():
+  global _client
+  if _client is None:
+    with _client_lock:
+      if _client is None:
+        _client = _new_client()
+  return _client
+
+def _httpx_kwargs(kwargs):
+  import httpx
+  if 'allow_redirects' in kwargs:
+    kwargs['follow_redirects'] = kwargs.pop('allow_redirects')
+  if isinstance(kwargs.get('timeout'), tuple):
+    connect, read = kwargs['timeout']
+    kwargs['timeout'] = httpx.Timeout(read, connect=connect)
+  return kwargs
+
+def _timeout(host, deadline, timeout=None):
+  if isinstance(timeout, tuple):
+    connect, read = timeout
+  elif timeout:
+    connect = read = timeout
+  else:
+    connect, read = HOST_TIMEOUTS.get(host, DEFAULT_TIMEOUT)
+  return deadline.timeout(connect, read) if deadline else (connect, read)
+
+def _hedge_after(host):
+  samples = sorted(_latencies[host])
+  if len(samples) < 20:
+    return HEDGE_AFTER
+  return max(HEDGE_MIN_AFTER, samples[int(len(samples) * HEDGE_PERCENTILE) - 1])
+
+def _should_hedge(method, host, hedge):
+  return hedge if hedge is not None else method in HEDGE_METHODS and host in HEDGED_HOSTS
+
+def _is_timeout(exc):
+  if isinstance(exc, requests.exceptions.Timeout):
+    return True
+  return type(exc).__name__ in ('TimeoutException', 'ConnectTimeout', 'ReadTimeout', 'PoolTimeout', 'WriteTimeout')
+
+def is_transport_error(exc):
+  '''Failures of the upstream request or of its response body, as opposed to errors in the calling code'''
+  if isinstance(exc, (requests.RequestException, DeadlineExceeded, ConnectionError, TimeoutError, asyncio.TimeoutError, json.JSONDecodeError)):
+    return True
+  # httpx is only imported when it is used
+  return any(cls.__name__ == 'HTTPError' and cls.__module__.startswith('httpx') for cls in type(exc).__mro__)
+
+def _send(method, url, **kwargs):
+  return client().request(method, url, **(_httpx_kwargs(kwargs) if _is_httpx else kwargs))
+
+def _send_hedged(method, url, hedge_after, budget, **kwargs):
+  start = monotonic()
+  def remaining():
+    # every wait is bounded by what is left of the budget, not by the budget itself
+    return max(0, budget - (monotonic() - start)) if budget is not None else None
+  first = _hedge_executor.submit(_send, method, url, **kwargs)
+  try:
+    return first.result(timeout=min(hedge_after, budget) if budget is not None else hedge_after)
+  except FutureTimeout:
+    if budget is not None and budget <= hedge_after:
+      raise DeadlineExceeded(f'{method} {url}')
+  if not limiter.try_acquire(urlparse(url).hostname):
+    # no spare capacity for the hedge, keep waiting on the original request
+    try:
+      return first.result(timeout=remaining())
+    except FutureTimeout:
+      raise DeadlineExceeded(f'{method} {url}')
+  logger.info(f'http_client: hedging method={method} url={url} after={round(hedge_after,3)}')
+  pending = {first, _hedge_executor.submit(_send, method, url, **kwargs)}
+  error = None
+  while pending:
+    done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+    if not done:
+      raise DeadlineExceeded(f'{method} {url}')
+    for future in done:
+      if future.exception() is None:
+        return future.result()
+      error = future.exception()
+  raise error
+
+def _cache_lookup(url, kwargs):
+  '''Returns (entry, hit) for a GET, adding validators to the request headers when the entry must be revalidated'''
+  entry = cache.lookup(url, kwargs.get('headers'))
+  if entry is None:
+    return None, False
+  if cache.serve(entry):
+    return entry, True
+  kwargs['headers'] = {**(kwargs.get('headers') or {}), **entry.conditional_headers()}
+  return entry, False
+
+def _cache_update(method, url, entry, request_headers, resp, httpx_response):
+  if entry is not None and resp.status_code == 304:
+    logger.debug(f'http_client: revalidated url={url}')
+    return cache.revalidate(entry, resp.headers).response(method, httpx_response)
+  cache.store(url, resp, request_headers)
+  return resp
+
+def request(method, url, deadline=None, hedge=None, **kwargs):
+  start = now()
+  host = urlparse(url).hostname
+  cacheable = cache.cacheable_request(method, kwargs)
+  request_headers = kwargs.get('headers')
+  entry, hit = _cache_lookup(url, kwargs) if cacheable else (None, False)
+  if hit:
+    logger.debug(f'http_client: cache hit url={url}')
+    return entry.response(method, _is_httpx)
+  timeout = kwargs.pop('timeout', None)
+  for attempt in range(2):
+    limiter.acquire(host, deadline)
+    kwargs['timeout'] = _timeout(host, deadline, timeout)
+    try:
+      if _should_hedge(method, host, hedge):
+        resp = _send_hedged(method, url, _hedge_after(host), deadline.remaining() if deadline else None, **kwargs)
+      else:
+        resp = _send(method, url, **kwargs)
+    except Exception as exc:
+      if _is_timeout(exc):
+        raise DeadlineExceeded(f'{method} {url}') from exc
+      raise
+    retry_after = limiter.observe(host, resp)
+    if attempt > 0 or method not in HEDGE_METHODS or not limiter.should_retry(resp, retry_after, deadline):
+      break
+    logger.info(f'http_client: retrying throttled request url={url} status={resp.status_code} retry_after={retry_after}')
+  elapsed = now() - start
+  _latencies[host].append(elapsed)
+  logger.debug(f'http_client: method={method} url={url} status={resp.status_code} elapsed={round(elapsed,3)}')
+  return _cache_update(method, url, entry, request_headers, resp, _is_httpx) if cacheable else resp
+
+def get(url, **kwargs):
+  return request('GET', url, **kwargs)
+
+def head(url, **kwargs):
+  kwargs.setdefault('allow_redirects', False)
+  return request('HEAD', url, **kwargs)
+
+def post(url, **kwargs):
+  return request('POST', url, **kwargs)
+
+def async_client():
+  import httpx
+  loop = asyncio.get_running_loop()
+  client = _async_clients.get(loop)
+  if client is None:
+    client = httpx.AsyncClient(
+      http2=USE_HTTP2 and _http2_available(),
+      follow_redirects=True,
+      headers={'User-Agent': USER_AGENT},
+      limits=httpx.Limits(max_connections=POOL_CONNECTIONS*POOL_MAXSIZE, max_keepalive_connections=POOL_CONNECTIONS*POOL_MAXSIZE)
+    )
+    _async_clients[loop] = client
+  return client
+
+async def _asend(method, url, **kwargs):
+  return await async_client().request(method, url, **_httpx_kwargs(kwargs))
+
+async def _asend_hedged(method, url, hedge_after, **kwargs):
+  tasks = [asyncio.ensure_future(_asend(method, url, **kwargs))]
+  try:
+    done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+    if done or not limiter.try_acquire(urlparse(url).hostname):
+      return await tasks[0]
+    logger.info(f'http_client: hedging method={method} url={url} after={round(hedge_after,3)}')
+    tasks.append(asyncio.ensure_future(_asend(method, url, **kwargs)))
+    pending = set(tasks)
+    error = None
+    while pending:
+      done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        if task.exception() is None:
+          return task.result()
+        error = task.exception()
+    raise error
+  finally:
+    for task in tasks:
+      if not task.done():
+        task.cancel()
+
+async def arequest(method, url, deadline=None, hedge=None, **kwargs):
+  start = now()
+  host = urlparse(url).hostname
+  cacheable = cache.cacheable_request(method, kwargs)
+  request_headers = kwargs.get('headers')
+  entry, hit = _cache_lookup(url, kwargs) if cacheable else (None, False)
+  if hit:
+    logger.debug(f'http_client: cache hit url={url}')
+    return entry.response(method, True)
+  timeout = kwargs.pop('timeout', None)
+  for attempt in range(2):
+    await limiter.aacquire(host, deadline)
+    kwargs['timeout'] = _timeout(host, deadline, timeout)
+    try:
+      if _should_hedge(method, host, hedge):
+        send = _asend_hedged(method, url, _hedge_after(host), **kwargs)
+      else:
+        send = _asend(method, url, **kwargs)
+      resp = await asyncio.wait_for(send, deadline.remaining() if deadline else None)
+    except asyncio.TimeoutError as exc:
+      raise DeadlineExceeded(f'{method} {url}') from exc
+    except Exception as exc:
+      if _is_timeout(exc):
+        raise DeadlineExceeded(f'{method} {url}') from exc
+      raise
+    retry_after = limiter.observe(host, resp)
+    if attempt > 0 or method not in HEDGE_METHODS or not limiter.should_retry(resp, retry_after, deadline):
+      break
+    logger.info(f'http_client: retrying throttled request url={url} status={resp.status_code} retry_after={retry_after}')
+  elapsed = now() - start
+  _latencies[host].append(elapsed)
+  logger.debug(f'http_client: method={method} url={url} status={resp.status_code} elapsed={round(elapsed,3)}')
+  return _cache_update(method, url, entry, request_headers, resp, True) if cacheable else resp
+
+async def aget(url, **kwargs):
+  return await arequest('GET', url, **kwargs)
+
+async def ahead(url, **kwargs):
+  kwargs.setdefault('allow_redirects', False)
+  return await arequest('HEAD', url, **kwargs)
+
+async def apost(url, **kwargs):
+  return await arequest('POST', url, **kwargs)
+
+async def aclose():
+  client = _async_clients.pop(asyncio.get_running_loop(), None)
+  if client is not None:
+    await client.aclose()
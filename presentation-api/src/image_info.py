@@ -14,8 +14,7 @@ import uuid
 from time import time as now
 from hashlib import sha256
 
-import requests
-logging.getLogger('requests').setLevel(logging.INFO)
+import http_client
 
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = 1000000000
@@ -51,10 +50,9 @@ class ImageInfo(object):
 
   def __call__(self, url, **kwargs):
     if url.endswith('/info.json'):
-        resp = requests.get(url,
+        resp = http_client.get(url,
             cookies={'UUID': str(uuid.uuid4())},
             headers={
-                'User-Agent': 'Labs client',
                 'Content-Type': 'application/x-www-form-urlencoded',
                 'Accept': 'application/json'
             }
@@ -64,7 +62,7 @@ class ImageInfo(object):
         info = {}
         start = now()        
         path = f'/tmp/{sha256(url.encode("utf-8")).hexdigest()}'
-        resp = requests.get(url, headers={'User-agent': 'IIIF service'})
+        resp = http_client.get(url)
         logger.info(f'{url} {resp.status_code}')
         if resp.status_code == 200:
             with open (path, 'wb') as fp:
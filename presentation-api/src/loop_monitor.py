@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import asyncio
+from time import perf_counter
+
+LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', 0.5))   # seconds between probes
+LAG_WARN = float(os.environ.get('LOOP_LAG_WARN', 0.1))           # log probes delayed longer than this
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class LoopLagMonitor(object):
+
+  def __init__(self, interval=LAG_INTERVAL, warn=LAG_WARN):
+    self.interval = interval
+    self.warn = warn
+    self.samples = 0
+    self.last = 0.0
+    self.max = 0.0
+    self.ewma = 0.0
+    self.histogram = [0] * (len(LAG_BUCKETS) + 1)
+    self._task = None
+
+  def record(self, lag):
+    self.samples += 1
+    self.last = lag
+    self.max = max(self.max, lag)
+    self.ewma = lag if self.samples == 1 else 0.9 * self.ewma + 0.1 * lag
+    self.histogram[next((idx for idx, bound in enumerate(LAG_BUCKETS) if lag <= bound), len(LAG_BUCKETS))] += 1
+    if lag > self.warn:
+      logger.warning(f'loop_monitor: event loop lag={round(lag,3)}')
+
+  async def _probe(self):
+    while True:
+      start = perf_counter()
+      await asyncio.sleep(self.interval)
+      self.record(max(0.0, perf_counter() - start - self.interval))
+
+  def start(self):
+    if self._task is None:
+      self._task = asyncio.get_running_loop().create_task(self._probe())
+
+  def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      self._task = None
+
+  def stats(self):
+    return {
+      'samples': self.samples,
+      'last': round(self.last, 4),
+      'max': round(self.max, 4),
+      'ewma': round(self.ewma, 4),
+      'histogram': dict(zip([f'le_{bound}' for bound in LAG_BUCKETS] + ['le_inf'], self.histogram))
+    }
+
+monitor = LoopLagMonitor()
@@ -15,22 +15,37 @@ sys.path.append(SCRIPT_DIR)
 from typing import Optional
 
 from fastapi import FastAPI, Request
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from starlette.responses import RedirectResponse
 
 import manifest_v2
 from prezi_upgrader import Upgrader
-from manifest import get_manifest, manifest_url, checkImageData
+from manifest import get_rendition_async, get_summary_async, known_digest, served, cache_control, manifest_url, checkImageData, builds, refresh_ahead
+from handlers.handler_base import manifest_cache
+from media_info import thumbnail_cache
 
 from media_info import MediaInfo
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
+from executors import run_io, run_media
+import executors
+import batch_loader
+from rate_limit import limiter
+from http_cache import cache as http_cache
+from loop_monitor import monitor as loop_monitor
+from deadline import Deadline, DeadlineExceeded
+from negative_cache import negative_cache, SourceNotFound
+from refresh_scheduler import scheduler as refresh_scheduler
+from canonical import canonical_ids
+from write_behind import write_behind
+from summaries import summaries
+import rendition
 
 from expiringdict import ExpiringDict
-_cache = ExpiringDict(max_len=100, max_age_seconds=3600)
+from cache_backend import make_cache
+_cache = make_cache('gp_proxy', ExpiringDict(max_len=100, max_age_seconds=3600), 64 * 1024 * 1024, max_age_seconds=3600)
 
 app = FastAPI(title='Juncture IIIF Presentation API')
 
@@ -42,6 +57,49 @@ app.add_middleware(
   allow_credentials=True,
 )
 
+LEGACY_CACHE_CONTROL = 'public, max-age=86400'
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded(request: Request, exc: DeadlineExceeded):
+  logger.warning(f'deadline exceeded: path={request.url.path} {exc}')
+  return JSONResponse(status_code=504, content={'error': 'upstream timeout', 'detail': str(exc)})
+
+@app.exception_handler(SourceNotFound)
+async def source_not_found(request: Request, exc: SourceNotFound):
+  # SourceUnavailable is a subclass and carries a 502 status
+  return JSONResponse(status_code=exc.status_code, content={'error': exc.reason, 'key': exc.key})
+
+@app.on_event('startup')
+async def startup():
+  loop_monitor.start()
+  refresh_scheduler.start(refresh_ahead)
+
+@app.on_event('shutdown')
+async def shutdown():
+  loop_monitor.stop()
+  refresh_scheduler.stop()
+  # objects queued for S3 are persisted before the worker exits
+  await run_io(write_behind.stop)
+  await http_client.aclose()
+
+@app.get('/metrics')
+async def metrics():
+  return {
+    'event_loop_lag': loop_monitor.stats(),
+    'executors': executors.stats(),
+    'rate_limits': limiter.stats(),
+    'http_cache': http_cache.stats(),
+    'batch_loaders': batch_loader.stats(),
+    'manifest_builds': builds.stats(),
+    'negative_cache': negative_cache.stats(),
+    'refresh_scheduler': refresh_scheduler.stats(),
+    'canonical_ids': canonical_ids.stats(),
+    'write_behind': write_behind.stats(),
+    'renditions': rendition.stats(),
+    'summaries': summaries.stats(),
+    'local_caches': [manifest_cache.stats(), thumbnail_cache.stats()]
+  }
+
 @app.get('/docs/')
 def docs():
   return RedirectResponse(url='/docs')
@@ -49,7 +107,7 @@ def docs():
 @app.get('/{path:path}/manifest.json')
 @app.get('/iiif/{path:path}/manifest.json')
 @app.get('/iiif/{version:int}/{path:path}/manifest.json')
-def manifest(
+async def manifest(
     request: Request, 
     path: str, 
     refresh: Optional[str] = None,
@@ -58,28 +116,57 @@ def manifest(
   start = now()
   refresh = refresh in ('', 'true')
   baseurl = f'{request.base_url.scheme}://{request.base_url.netloc}'
-  manifest = get_manifest(path, baseurl=baseurl, refresh=refresh)
+  # a client revalidating a response that is still current gets its 304 without the manifest being loaded
+  caching, (digest, size) = ('no-cache', (None, None)) if refresh else await run_io(_revalidation, path, baseurl, version)
+  if rendition.etag_matches(request.headers.get('if-none-match'), digest):
+    return _not_modified(digest, rendition.served_encoding(request.headers.get('accept-encoding'), size), caching)
+  source = await get_rendition_async(path, baseurl=baseurl, refresh=refresh, deadline=Deadline())
   logger.info(f'manifest: path={path} baseurl={baseurl} refresh={refresh} elapsed={round(now()-start,3)}')
-  if version == 2:
-    manifest = manifest_v2.convert(manifest, baseurl)
-  return manifest
+  manifest = await run_io(manifest_v2.get_v2_rendition, source, baseurl) if version == 2 else source
+  await run_io(served, path, baseurl, version, manifest, source)
+  return await _manifest_response(manifest, request, caching)
+
+def _revalidation(path, baseurl, version):
+  # both are read from the shared cache tiers, in one io worker
+  return cache_control(path), known_digest(path, baseurl, version)
+
+def _validators(digest, encoding, cache_control):
+  headers = {'Vary': 'Accept-Encoding', 'ETag': rendition.etag(digest, encoding)}
+  if cache_control:
+    headers['Cache-Control'] = cache_control
+  return headers
+
+def _not_modified(digest, encoding, cache_control):
+  # the ETag of a 304 names the encoding the 200 for the same request is sent in
+  return Response(status_code=304, headers=_validators(digest, encoding, cache_control))
+
+async def _manifest_response(manifest, request, cache_control=None):
+  # the body is sent in the precompressed variant the client accepts, nothing is compressed per request
+  if rendition.etag_matches(request.headers.get('if-none-match'), manifest.digest):
+    return _not_modified(manifest.digest, rendition.served_encoding(request.headers.get('accept-encoding'), len(manifest.body)), cache_control)
+  content, encoding = await run_io(manifest.encoded, request.headers.get('accept-encoding'))
+  headers = _validators(manifest.digest, encoding, cache_control)
+  if encoding:
+    headers['Content-Encoding'] = encoding
+  return Response(content=content, media_type='application/json', headers=headers)
 
 @app.post('/manifest/')
 async def get_or_create_manifest(request: Request):
   start = now()
   payload = await request.body()
   payload = json.loads(payload)
-  manifest = manifest_v2.get_manifest(**payload)
+  manifest = await run_io(manifest_v2.get_manifest, **payload)
   logger.info(f'manifest: payload={payload} elapsed={round(now()-start,3)}')
-  return manifest
+  return await _manifest_response(manifest, request)
 
 @app.get('/manifest/{mid}/')
 @app.get('/manifest/{mid}')
 async def get_v2_manifest(
+    request: Request,
     mid: str, 
     refresh: Optional[bool] = False,
   ):
-  v2_manifest = manifest_v2.get_manifest_by_id(mid, refresh)
+  v2_manifest = await run_io(manifest_v2.get_manifest_by_id, mid, refresh)
   '''
   upgrader = Upgrader(flags={
     'crawl': False,        # NOT YET IMPLEMENTED. Crawl to linked resources, such as AnnotationLists from a Manifest
@@ -96,15 +183,16 @@ async def get_v2_manifest(
   v3_manifest = upgrader.reorder(v3_manifest)
   return checkImageData(v3_manifest)
   '''
-  return v2_manifest
+  # legacy manifests do not change once cached
+  return await _manifest_response(rendition.Rendition(rendition.Template(json.dumps(v2_manifest)), baseurl=None), request, 'no-cache' if refresh else LEGACY_CACHE_CONTROL)
 
 @app.get('/gp-proxy/{path:path}')
 async def gh_proxy(request: Request, response: Response, path: str):
   logger.info(f'gh_proxy: path={path} method={request.method}')
   gp_url = f'https://plants.jstor.org/seqapp/adore-djatoka/resolver?url_ver=Z39.88-2004&svc_id=info:lanl-repo/svc/getRegion&svc_val_fmt=info:ofi/fmt:kev:mtx:jpeg2000&svc.format=image/jpeg&rft_id=/{path}'
   if request.method in ('HEAD',):
-    resp = requests.get(gp_url, headers = {'User-Agent': 'JSTOR Labs'})
-    _cache[gp_url] = resp.content
+    resp = await http_client.arequest('GET', gp_url, headers = {'User-Agent': 'JSTOR Labs'})
+    await run_io(_cache.__setitem__, gp_url, resp.content)
     if resp.status_code == 200:
       response.headers['Content-Length'] = str(len(resp.content))
       response.headers['Content_Length'] = str(len(resp.content))
@@ -113,7 +201,7 @@ async def gh_proxy(request: Request, response: Response, path: str):
     '''
     content = _cache.get(gp_url)
     if content is None:
-      resp = requests.get(gp_url, headers = {'User-Agent': 'JSTOR Labs'})
+      resp = await http_client.arequest('GET', gp_url, headers = {'User-Agent': 'JSTOR Labs'})
       if resp.status_code == 200:
         content = resp.content
     if content:
@@ -126,10 +214,13 @@ async def gh_proxy(request: Request, response: Response, path: str):
 @app.post('/prezi2to3/')
 async def prezi2to3(request: Request, manifest: Optional[str] = None):
   if request.method == 'GET':
-    input_manifest = requests.get(manifest).json()
+    input_manifest = (await http_client.aget(manifest)).json()
   else:
     body = await request.body()
     input_manifest = json.loads(body)
+  return await run_io(_prezi2to3, input_manifest)
+
+def _prezi2to3(input_manifest):
   manifest_version = 3 if 'http://iiif.io/api/presentation/3/context.json' in input_manifest.get('@context') else 2
   if manifest_version == 3:
     v3_manifest = input_manifest
@@ -150,16 +241,6 @@ async def prezi2to3(request: Request, manifest: Optional[str] = None):
   
   return checkImageData(v3_manifest)
 
-def _metadata_value(manifest, key):
-  return next(iter([list(md['value'].values())[0][0] for md in manifest.get('metadata',[]) if key in [list(md['label'].values())[0][0]]]), None)
-
-def _find_item(obj, type, attr=None, attr_val=None, sub_attr=None):
-  if 'items' in obj and isinstance(obj['items'], list):
-    for item in obj['items']:
-      if item.get('type') == type and (attr is None or item.get(attr) == attr_val):
-          return item[sub_attr] if sub_attr else item
-      return _find_item(item, type, attr, attr_val, sub_attr)
-
 @app.get('/thumbnail/{path:path}')
 @app.get('/thumbnail/')
 @app.get('/thumbnail')
@@ -186,32 +267,31 @@ async def thumbnail(
   logger.info(f'thumbnail: path={path} url={url} type={_type}')
   if path:
       baseurl = f'{request.base_url.scheme}://{request.base_url.netloc}'
-      manifest = get_manifest(path, baseurl=baseurl, refresh=refresh)
-      logger.info(manifest)
+      # the few values needed here are kept per manifest, the manifest itself is not loaded on a hit
+      summary = await get_summary_async(path, baseurl=baseurl, refresh=refresh, deadline=Deadline())
+      logger.debug(summary)
       if _type == 'thumbnail':
-        image_data = _find_item(manifest, type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
-        if image_data.get('type') == 'Video':
-          video_url = _metadata_value(manifest, 'image_url')
-          thumbnail_url = MediaInfo().poster(url=video_url, time=time, refresh=refresh)
+        if summary['type'] == 'Video':
+          thumbnail_url = await run_media(MediaInfo().poster, url=summary['image_url'], time=time, refresh=refresh)
+        elif not summary['service_id']:
+          # no image service to size the image with, the manifest thumbnail or the image itself is used as is
+          thumbnail_url = summary['thumbnail'] or summary['image_url']
         else:
-          image_data = _find_item(manifest, type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
-          # thumbnail_url = manifest['thumbnail'][0]['id']
           if not width and not height and not size:
             width = 400
           _size = f'{width or size or ""},{height or size or ""}'
-          thumbnail_url = f'{image_data["service"][0]["id"]}/{region}/{_size}/{rotation}/{quality}.{format}'
+          thumbnail_url = f'{summary["service_id"]}/{region}/{_size}/{rotation}/{quality}.{format}'
       else:
-        image_data = _find_item(manifest, type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
-        if 'service' in image_data:
-          thumbnail_url = f'{image_data["service"][0]["id"]}/full/1000,/0/default.jpg'
+        if summary['service_id']:
+          thumbnail_url = f'{summary["service_id"]}/full/1000,/0/default.jpg'
         else: # banner
-          thumbnail_url = manifest['thumbnail'][0]['id']
+          thumbnail_url = summary['thumbnail'] or summary['image_url']
   else:
     ext = [elem for elem in url.split('/') if elem][-1].split('.')[-1]
     if ext in ('mp4', 'webm', 'ogg', 'ogv'): # is video
-      thumbnail_url = MediaInfo().poster(url=url, time=time, refresh=refresh)
+      thumbnail_url = await run_media(MediaInfo().poster, url=url, time=time, refresh=refresh)
     else:
-      thumbnail_url = manifest_v2.thumbnail(**{
+      thumbnail_url = await run_io(manifest_v2.thumbnail, **{
         'url': url,
         'refresh': refresh,
         'region': region,
@@ -228,7 +308,7 @@ async def thumbnail(
 
 @app.get('/mediainfo')
 async def mediainfo(url):
-  content, status_code = MediaInfo()(url=url)
+  content, status_code = await run_media(MediaInfo(), url=url)
   return Response(content=json.dumps(content), status_code=status_code, media_type='application/json')
 
 @app.get('/')
@@ -239,7 +319,7 @@ async def default(
   print("STARTING DEFAULT HANDLER")
   if url:
     baseurl = f'{request.base_url.scheme}://{request.base_url.netloc}'
-    html = manifest_url(url, baseurl)
+    html = await run_io(manifest_url, url, baseurl)
   else:
     html = open(f'{SCRIPT_DIR}/index.html', 'r').read()
   return Response(content=html, media_type='text/html')
@@ -8,10 +8,18 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 import json
-from urllib.parse import urlparse
+from urllib.parse import urlparse, unquote
+from contextlib import contextmanager
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
+from single_flight import SingleFlight
+from negative_cache import negative_cache, SourceNotFound, SourceUnavailable
+from deadline import DeadlineExceeded
+from executors import run_io, run_background
+from refresh_scheduler import scheduler as refresh_scheduler
+from canonical import canonical_ids, normalize
+import rendition
+from summaries import summaries, summarize
 
 import handlers.default
 import handlers.edison_papers
@@ -38,17 +46,147 @@ _handlers = {
   'wd': handlers.wikidata_images.Handler
 }
 
-def get_manifest(mid, **kwargs):
-  source, sourceid = mid.split(':',1) if ':' in mid else (None, mid)
-  if source in _handlers:
-    return _handlers[source](sourceid, **kwargs).get_manifest()
+# concurrent requests for the same manifest share one build, the lock file lease is per manifest id
+builds = SingleFlight('manifest')
+
+def _flight_key(mid, kwargs):
+  return f'{mid}|{kwargs.get("baseurl")}|{bool(kwargs.get("refresh"))}'
+
+def _build_kwargs(kwargs, peer_built):
+  # a refresh that waited on another worker's build picks up that worker's fresh copy from the cache
+  return dict(kwargs, refresh=kwargs.get('refresh', False) and not peer_built)
+
+def _check_negative(mid, kwargs):
+  if kwargs.get('refresh'):
+    negative_cache.clear(mid)
   else:
-    return handlers.default.Handler(sourceid, **kwargs).get_manifest()
+    negative_cache.check(mid)
+
+@contextmanager
+def _record_failures(mid):
+  '''Failed builds are remembered briefly so retries from a broken essay fail fast.
+  Only upstream and transport failures are recorded, errors in the build code propagate as they are.'''
+  try:
+    yield
+  except SourceNotFound as exc:
+    negative_cache.record(mid, exc)
+    raise
+  except DeadlineExceeded as exc:
+    negative_cache.record(mid, SourceUnavailable(mid, f'{type(exc).__name__}: {exc}'))
+    raise
+  except Exception as exc:
+    if not http_client.is_transport_error(exc):
+      raise
+    logger.exception(f'manifest build failed: mid={mid}')
+    raise negative_cache.record(mid, SourceUnavailable(mid, f'{type(exc).__name__}: {exc}')) from exc
+
+def _handler_cls(mid):
+  source, sourceid = mid.split(':',1) if ':' in mid else (None, mid)
+  return _handlers[source] if source in _handlers else handlers.default.Handler, sourceid
+
+def _request_key(manifestid):
+  # requests are counted, and refreshed, by the unquoted id handlers are constructed from, manifestids arrive quoted or not
+  return normalize(unquote(manifestid))
+
+def _count_request(manifestid):
+  request_key = _request_key(manifestid)
+  if _handler_cls(request_key)[0].builds_from_sourceid:
+    refresh_scheduler.record(request_key)
+  return request_key
+
+def _record_request(mid, manifest):
+  # gh ids may be requested without a file extension, the id the manifest is cached under is learned as an alias
+  if manifest.manifestid:
+    canonical_ids.learn(mid, _count_request(manifest.manifestid))
+  return manifest
+
+def get_rendition(mid, **kwargs):
+  '''The manifest with the serialized body it is served as'''
+  mid = canonical_ids.canonical_id(mid)
+  _check_negative(mid, kwargs)
+  handler_cls, sourceid = _handler_cls(mid)
+  def build(peer_built):
+    with _record_failures(mid):
+      return handler_cls(sourceid, **_build_kwargs(kwargs, peer_built)).rendition()
+  return _record_request(mid, builds.do(_flight_key(mid, kwargs), build, lease_key=mid, deadline=kwargs.get('deadline')))
+
+async def get_rendition_async(mid, **kwargs):
+  # aliases and the request counts are kept in the shared cache tiers, they are read and written off the event loop
+  mid = await run_io(canonical_ids.canonical_id, mid)
+  _check_negative(mid, kwargs)
+  handler_cls, sourceid = _handler_cls(mid)
+  async def build(peer_built):
+    with _record_failures(mid):
+      handler = await handler_cls.create(sourceid, **_build_kwargs(kwargs, peer_built))
+      return await handler.arendition()
+  return await run_io(_record_request, mid, await builds.ado(_flight_key(mid, kwargs), build, lease_key=mid, deadline=kwargs.get('deadline')))
+
+def get_manifest(mid, **kwargs):
+  return get_rendition(mid, **kwargs).manifest
+
+async def get_manifest_async(mid, **kwargs):
+  return (await get_rendition_async(mid, **kwargs)).manifest
+
+def _served_summary(summary):
+  # handlers may add the image service to a stored manifest as it is served, a summary without one is
+  # taken from the rendition instead
+  return summary if summary is not None and (summary['service_id'] or summary['type'] == 'Video') else None
+
+def _known_summary(mid):
+  '''Summary of a manifest, None when it has to be loaded. Failed builds fail fast as they do for the manifest,
+  and a summary of a manifest due for revalidation is served while the manifest is revalidated in the background.'''
+  manifestid = canonical_ids.canonical_id(mid, count=False)
+  negative_cache.check(manifestid)
+  summary = _served_summary(summaries.get(manifestid))
+  if summary is not None:
+    _count_request(manifestid)
+    if summaries.due(summary):
+      run_background(f'rebuild:{manifestid}', refresh_ahead, manifestid, 0)
+  return summary
+
+async def get_summary_async(mid, **kwargs):
+  '''Summary of a manifest, see summaries.py, the manifest is only loaded when no current summary is known'''
+  summary = None if kwargs.get('refresh') else await run_io(_known_summary, mid)
+  if summary is None:
+    source = await get_rendition_async(mid, **kwargs)
+    summary = _served_summary(await run_io(summaries.get, source.manifestid) if source.manifestid else None) or summarize(source.manifest)
+  # values are stored with {BASE_URL} placeholders, like the manifest
+  baseurl = kwargs.get('baseurl') or ''
+  return dict([(key, value.replace('{BASE_URL}', baseurl) if isinstance(value, str) else value) for key, value in summary.items()])
+
+def _served_key(mid, baseurl, version):
+  return f'{version}|{baseurl}|{canonical_ids.canonical_id(mid, count=False)}'
+
+def known_digest(mid, baseurl, version=3):
+  '''Digest and body size of the current response for a manifest request, (None, None) when only loading
+  the manifest can tell'''
+  manifestid, digest, size = rendition.known_digest(_served_key(mid, baseurl, version))
+  if manifestid:
+    _count_request(manifestid)
+  return digest, size
+
+def served(mid, baseurl, version, response, source):
+  '''Records the response to a manifest request, later revalidations of it are answered from known_digest'''
+  rendition.remember(_served_key(mid, baseurl, version), response, source)
+
+def cache_control(mid):
+  handler_cls, _ = _handler_cls(canonical_ids.canonical_id(mid, count=False))
+  return f'public, max-age={handler_cls.cache_max_age}'
+
+def refresh_ahead(mid, lead):
+  '''Called by the refresh scheduler for popular manifests, see HandlerBase.refresh_ahead'''
+  handler_cls, sourceid = _handler_cls(_request_key(mid))
+  return handler_cls(sourceid, defer_build=True).refresh_ahead(lead)
+
+def _canonical_url(mid):
+  canonical = canonical_ids.canonical_id(unquote(mid), count=False)
+  return canonical.replace('?','%3F').replace('&','%26')
 
 def manifest_url(url, baseurl):
   for _, handler in _handlers.items():
     if handler.can_handle(url):
-      return handler.manifest_url(url, baseurl)
+      mid = handler.manifest_url(url, baseurl)
+      return _canonical_url(mid) if mid.split(':',1)[0] in _handlers else mid
   if handlers.default.Handler.can_handle(url):
     return handlers.default.Handler.manifest_url(url, baseurl)
   else:
@@ -72,7 +210,7 @@ def checkImageData(manifest):
     image_data = _find_item(manifest, type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
     if image_data:
       svc = image_data['service'][0]
-      resp = requests.get(f'{svc.get("@id", svc.get("id"))}/info.json')
+      resp = http_client.get(f'{svc.get("@id", svc.get("id"))}/info.json')
       if resp.status_code == 200:
         info_json = resp.json()
         width = info_json.get('width')
@@ -15,10 +15,10 @@ from urllib.parse import urlparse
 
 from pymongo import MongoClient
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
+import http_client
 
-from s3 import Bucket
+from s3 import Bucket, presigned_url
+import rendition
 manifest_cache = Bucket('iiif-manifest-cache')
 thumbnail_cache = Bucket('iiif-thumbnail')
 
@@ -46,12 +46,12 @@ def _image_id(image_url):
 def _info_json(image_url):
     info_json_url = f'{_image_service()}/{_image_id(image_url)}/info.json'
     logger.info(f'_info_json: url={info_json_url} id={_image_id(image_url)}')
-    resp = requests.get(info_json_url)
+    resp = http_client.get(info_json_url)
     return resp.json() if resp.status_code == 200 else {}
 
 def _info_json_exists(image_url):
     info_json_url = f'{_image_service()}/{_image_id(image_url)}/info.json'
-    return requests.head(info_json_url).status_code == 200
+    return http_client.head(info_json_url).status_code == 200
 
 def _service_endpoint(image_url):
     if not _info_json_exists(image_url):
@@ -144,29 +144,27 @@ def _get_image_data(image_url):
         _queue_iiif_convert(image_url)
     return image_data
 
+def _template_facts(manifest):
+    return {'service': 'service' in manifest['sequences'][0]['canvases'][0]['images'][0]['resource']}
+
 def get_manifest(**kwargs):
+    '''Rendition of the manifest for an image url, a cached manifest with an image service is served without parsing it'''
     baseurl = 'https://iiif.juncture-digital.org'
     image_url = _image_url(kwargs['url'])
     mid = sha256(image_url.encode()).hexdigest()
-    is_updated = False
 
-    manifest = manifest_cache.get(mid)
-    if manifest:
-        if not isinstance(manifest, str):
-            manifest = manifest.decode('utf-8')
-        manifest = json.loads(manifest)    
-    else:
-        manifest = _make_manifest_v2_1_1(mid, **kwargs)
-        is_updated = True
-    
+    cached = manifest_cache.get(mid)
+    template = rendition.load(cached, _template_facts) if cached else None
+    if template is not None and template.facts['service']:
+        return rendition.Rendition(template, baseurl)
+
+    manifest = template.manifest() if template is not None else _make_manifest_v2_1_1(mid, **kwargs)
     if 'service' not in manifest['sequences'][0]['canvases'][0]['images'][0]['resource']:
         _add_image_data(manifest, _get_image_data(image_url))
-        is_updated = True
 
-    serialized_manifest = json.dumps(manifest)
-    if is_updated:
-        manifest_cache[mid] = serialized_manifest
-    return json.loads(serialized_manifest.replace('{BASE_URL}', baseurl))
+    stored, template = rendition.store(json.dumps(manifest), _template_facts(manifest))
+    manifest_cache.put(mid, stored, metadata=rendition.stored_metadata(stored))
+    return rendition.Rendition(template, baseurl)
 
 _db_connection = None
 def connect_db():
@@ -181,10 +179,9 @@ def connect_db():
 def get_manifest_by_id(id, refresh=False):   
     baseurl = 'https://iiif.juncture-digital.org'
     cached_manifest = manifest_cache.get(id) if not refresh else None
-    if cached_manifest and not isinstance(cached_manifest, str):
-        cached_manifest = cached_manifest.decode('utf-8')
     if cached_manifest:
-       manifest = json.loads(cached_manifest.replace('{BASE_URL}', baseurl))
+        cached_manifest = rendition.unpack(cached_manifest)
+        manifest = json.loads(cached_manifest.replace('{BASE_URL}', baseurl))
     else:
         # try to get manifest from legacy MongoDB database
         mdb = connect_db()
@@ -203,7 +200,8 @@ def get_manifest_by_id(id, refresh=False):
                 }
                 manifest['thumbnail'] = f'{_service_endpoint(image_url)}/full/150,/0/default.jpg'
                 mid = sha256(image_url.encode()).hexdigest()
-                manifest_cache[mid] = json.dumps(manifest)
+                stored = rendition.pack(json.dumps(manifest))
+                manifest_cache.put(mid, stored, metadata=rendition.stored_metadata(stored))
     return manifest
 
 def _calc_region_and_size(**kwargs):
@@ -232,19 +230,8 @@ def _calc_region_and_size(**kwargs):
     return kwargs.get('region', 'full'), size
 
 def _create_presigned_url(bucket_name, object_name, expiration=600):
-  boto3.setup_default_session()
-  # Generate a presigned URL for the S3 object
-  s3_client = boto3.client(
-    's3',
-    region_name='us-east-1',
-    config=boto3.session.Config(signature_version='s3v4',)
-  )
   try:
-    response = s3_client.generate_presigned_url(
-      'get_object',
-      Params={'Bucket': bucket_name, 'Key': object_name},
-      ExpiresIn=expiration
-    )
+    response = presigned_url(bucket_name, object_name, expiration)
   except Exception as e:
       print(e)
       logging.error(e)
@@ -267,7 +254,7 @@ def thumbnail(refresh=False, **kwargs):
         is_placeholder = True
     region, size = _calc_region_and_size(**kwargs)
     thumbnail_url = f'{image_data["service"]}/{region}/{size}/{kwargs["rotation"]}/{kwargs["quality"]}.{kwargs["format"]}'    
-    resp = requests.get(thumbnail_url)
+    resp = http_client.get(thumbnail_url)
     # if resp.status_code == 200:
     #    if not is_placeholder: thumbnail_cache[thumbnail_id] = resp.content
     #    thumbnail_url = _create_presigned_url('iiif-thumbnail', thumbnail_id)
@@ -284,7 +271,11 @@ def _lang_map_value(item):
     return (item['en'] if 'en' in item else item['none'] if 'none' in item else item[list(item.keys())[0]])[0]
 
 def convert(v3_manifest, baseurl, **kwargs):
+    '''Rendition of the v2 manifest for a v3 manifest'''
     mid = '/'.join(v3_manifest['id'].split('/')[3:-1])
+    return rendition.Rendition(rendition.Template(json.dumps(_convert(v3_manifest, mid))), baseurl)
+
+def _convert(v3_manifest, mid):
     label = _lang_map_value(v3_manifest['label'])
     image_info = _find_item(v3_manifest, type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
     manifest = {
@@ -339,9 +330,41 @@ def convert(v3_manifest, baseurl, **kwargs):
     if 'metadata' in v3_manifest and len(v3_manifest['metadata']) > 0:
         manifest['metadata'] = [{'label': _lang_map_value(md['label']), 'value': _lang_map_value(md['value'])} for md in v3_manifest['metadata']]
 
-    manifest = json.loads(json.dumps(manifest).replace('{BASE_URL}', baseurl))
     return manifest
 
+def _v2_key(manifestid):
+    return f'v2/{manifestid}'
+
+def save_v2(manifestid, v3_manifest, v3_template, baseurls=()):
+    '''Stores the v2 manifest for a v3 manifest being saved, tagged with the digest of the v3 template it was made from'''
+    try:
+        manifest = _convert(v3_manifest, manifestid)
+    except (KeyError, IndexError, TypeError, AttributeError) as exc:
+        # manifests without an image service have no v2 form, the v2 route fails for them as before
+        logger.info(f'save_v2: no v2 manifest for {manifestid} {type(exc).__name__}: {exc}')
+        return None
+    stored, template = rendition.store(json.dumps(manifest), None)
+    manifest_cache.put(_v2_key(manifestid), stored, metadata=rendition.stored_metadata(stored, {'v3-digest': v3_template.digest}))
+    rendition.precompress(template, baseurls)
+    return template
+
+def get_v2_rendition(source, baseurl):
+    '''Rendition of the v2 manifest for source, the rendition of a v3 manifest.
+    The stored v2 manifest is used while it was made from the v3 template source was rendered from.'''
+    if not source.manifestid:
+        return convert(source.manifest, baseurl)
+    v2_key = _v2_key(source.manifestid)
+    stored = manifest_cache.get(v2_key)
+    if stored and (manifest_cache.metadata(v2_key) or {}).get('v3-digest') == source.template.digest:
+        return rendition.Rendition(rendition.load(stored, None), baseurl, manifestid=source.manifestid)
+    template = None
+    if rendition.current_digests.get(source.manifestid) == source.template.digest:
+        # v3 manifests saved before v2 manifests were stored with them, or whose v2 manifest was lost
+        template = save_v2(source.manifestid, source.template.manifest(), source.template)
+    if template is None:
+        return convert(source.manifest, baseurl)
+    return rendition.Rendition(template, baseurl, manifestid=source.manifestid)
+
 def usage():
     print('%s [hl:a:d:n:r:b:p:t] url' % sys.argv[0])
     print('   -h --help         Print help message')
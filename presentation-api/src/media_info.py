@@ -15,8 +15,7 @@ import uuid
 from time import time as now
 from hashlib import sha256
 
-import requests
-logging.getLogger('requests').setLevel(logging.INFO)
+import http_client
 
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = 1000000000
@@ -30,8 +29,7 @@ import filetype
 
 import ffmpeg
 
-import boto3
-from s3 import Bucket
+from s3 import Bucket, presigned_url
 thumbnail_cache = Bucket('iiif-thumbnail')
 
 class MediaInfo(object):
@@ -59,21 +57,21 @@ class MediaInfo(object):
       logger.debug(traceback.format_exc())
     return data
 
-  def from_info_json(self, url):
+  def from_info_json(self, url, deadline=None):
     logger.debug(f'from_info_json: url={url}')
-    resp = requests.get(url,
+    resp = http_client.get(url,
+      deadline=deadline,
       cookies={'UUID': str(uuid.uuid4())},
       headers={
-        'User-Agent': 'Labs client',
         'Content-Type': 'application/x-www-form-urlencoded',
         'Accept': 'application/json'
       }
     )
     return resp.json() if resp.status_code == 200 else {}, resp.status_code
 
-  def download(self, url):
+  def download(self, url, deadline=None):
     path = f'/tmp/{sha256(url.encode("utf-8")).hexdigest()}'
-    resp = requests.get(url, headers={'User-agent': 'IIIF service'})
+    resp = http_client.get(url, deadline=deadline)
     if resp.status_code == 200:
       with open (path, 'wb') as fp:
         fp.write(resp.content)
@@ -97,19 +95,19 @@ class MediaInfo(object):
   def av_info(self, path):
     return ffmpeg.probe(path)['streams'][0]
     
-  def __call__(self, url, **kwargs):
+  def __call__(self, url, deadline=None, **kwargs):
     logger.debug(f'media_info: url={url}')
     media_info = {}
     status_code = 200
     if url.endswith('/info.json'):
-      media_info, status_code = self.from_info_json(url)
+      media_info, status_code = self.from_info_json(url, deadline)
     elif url.startswith('https://www.jstor.org/iiif'):
       url = f'{"/".join(url.split("/")[:-4])}/info.json'
-      media_info = self.from_info_json(url)
+      media_info = self.from_info_json(url, deadline)
       logger.debug(media_info)
 
     else:
-      path = self.download(url)
+      path = self.download(url, deadline)
       if path:
         mime = magic.from_file(path, mime=True)
         logger.info(f'path={path} mime={mime}')
@@ -139,23 +137,8 @@ class MediaInfo(object):
     return media_info, status_code
   
   def _create_presigned_url(self, bucket_name, object_name, expiration=600):
-    boto3.setup_default_session()
-    # Generate a presigned URL for the S3 object
-    s3_client = boto3.client(
-      's3',
-      region_name='us-east-1',
-      config=boto3.session.Config(signature_version='s3v4',)
-    )
     try:
-      response = s3_client.generate_presigned_url(
-        'get_object',
-        Params={
-          'Bucket': bucket_name,
-          'Key': object_name,
-          'ResponseContentType': 'image/jpeg'
-        },
-        ExpiresIn=expiration
-      )
+      response = presigned_url(bucket_name, object_name, expiration, ResponseContentType='image/jpeg')
     except Exception as e:
         print(e)
         logging.error(e)
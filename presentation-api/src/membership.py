@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import math
+import struct
+import hashlib
+import threading
+from time import monotonic
+
+from expiringdict import ExpiringDict
+
+MEMBERSHIP_MAX_KEYS = int(os.environ.get('S3_MEMBERSHIP_MAX_KEYS', 100000))        # per bucket and answer
+MEMBERSHIP_POSITIVE_TTL = int(os.environ.get('S3_MEMBERSHIP_POSITIVE_TTL', 3600))  # seconds, cached objects are rarely deleted
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get('S3_MEMBERSHIP_NEGATIVE_TTL', 60))    # seconds, other workers may create the object
+# comma separated buckets whose existence checks also consult a Bloom filter seeded from a listing of the bucket
+MEMBERSHIP_BLOOM_BUCKETS = tuple([name.strip() for name in os.environ.get('S3_MEMBERSHIP_BLOOM_BUCKETS', '').split(',') if name.strip()])
+MEMBERSHIP_BLOOM_CAPACITY = int(os.environ.get('S3_MEMBERSHIP_BLOOM_CAPACITY', 1000000))
+MEMBERSHIP_BLOOM_ERROR_RATE = float(os.environ.get('S3_MEMBERSHIP_BLOOM_ERROR_RATE', 0.01))
+# seconds a listing is trusted to rule keys out, objects created since by other instances are only seen after a reseed
+MEMBERSHIP_BLOOM_REFRESH = int(os.environ.get('S3_MEMBERSHIP_BLOOM_REFRESH', 900))
+
+class BloomFilter(object):
+  '''Bit array membership filter, no false negatives and about error_rate false positives at capacity'''
+
+  def __init__(self, capacity=MEMBERSHIP_BLOOM_CAPACITY, error_rate=MEMBERSHIP_BLOOM_ERROR_RATE):
+    self.size = max(1024, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, round(self.size / capacity * math.log(2)))
+    self.bits = bytearray((self.size + 7) // 8)
+    self.entries = 0
+
+  def _indexes(self, key):
+    # double hashing, two 64 bit halves of one digest give all the indexes
+    h1, h2 = struct.unpack('<QQ', hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest())
+    return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+  def add(self, key):
+    for idx in self._indexes(key):
+      self.bits[idx >> 3] |= 1 << (idx & 7)
+    self.entries += 1
+
+  def __contains__(self, key):
+    return all(self.bits[idx >> 3] & (1 << (idx & 7)) for idx in self._indexes(key))
+
+class Membership(object):
+  '''Existence of the objects of one bucket, from earlier answers and optionally a Bloom filter of the bucket listing.
+  lookup returns True or False when known, None when the bucket has to be asked.'''
+
+  def __init__(self, bucket_name, bloom=False):
+    self.bucket_name = bucket_name
+    self.positive = ExpiringDict(max_len=MEMBERSHIP_MAX_KEYS, max_age_seconds=MEMBERSHIP_POSITIVE_TTL)
+    self.negative = ExpiringDict(max_len=MEMBERSHIP_MAX_KEYS, max_age_seconds=MEMBERSHIP_NEGATIVE_TTL)
+    self.use_bloom = bloom
+    self.bloom = None
+    self.bloom_seeded = 0
+    self.lock = threading.Lock()
+    self._added_while_seeding = None
+    self.positive_hits = self.negative_hits = self.bloom_negatives = self.misses = self.seeds = 0
+
+  def _bloom_current(self):
+    return self.bloom is not None and monotonic() - self.bloom_seeded < MEMBERSHIP_BLOOM_REFRESH
+
+  def lookup(self, key):
+    if key in self.positive:
+      self.positive_hits += 1
+      return True
+    if key in self.negative:
+      self.negative_hits += 1
+      return False
+    if self._bloom_current() and key not in self.bloom:
+      self.bloom_negatives += 1
+      return False
+    self.misses += 1
+    return None
+
+  def record(self, key, exists):
+    if exists:
+      self.added(key)
+    else:
+      self.positive.pop(key, None)
+      self.negative[key] = True
+
+  def added(self, key):
+    self.negative.pop(key, None)
+    self.positive[key] = True
+    with self.lock:
+      if self.bloom is not None:
+        self.bloom.add(key)
+      if self._added_while_seeding is not None:
+        self._added_while_seeding.append(key)
+
+  def removed(self, key):
+    self.record(key, False)
+
+  def needs_seed(self):
+    return self.use_bloom and not self._bloom_current() and self._added_while_seeding is None
+
+  def seed(self, keys):
+    '''Builds a new filter from keys, an iterable over the bucket listing'''
+    start = monotonic()
+    with self.lock:
+      self._added_while_seeding = []
+    bloom = BloomFilter()
+    try:
+      for key in keys:
+        bloom.add(key)
+    finally:
+      with self.lock:
+        # objects put while the listing ran may be missing from it
+        for key in self._added_while_seeding:
+          bloom.add(key)
+        self._added_while_seeding = None
+    with self.lock:
+      self.bloom, self.bloom_seeded = bloom, start
+    self.seeds += 1
+    logger.info(f'membership: seeded bucket={self.bucket_name} keys={bloom.entries} elapsed={round(monotonic()-start, 3)}')
+
+  def stats(self):
+    lookups = self.positive_hits + self.negative_hits + self.bloom_negatives + self.misses
+    return {
+      'positive_hits': self.positive_hits,
+      'negative_hits': self.negative_hits,
+      'bloom_negatives': self.bloom_negatives,
+      'misses': self.misses,
+      'hit_ratio': round((lookups - self.misses) / lookups, 3) if lookups else None,
+      'bloom': {'keys': self.bloom.entries, 'age': round(monotonic() - self.bloom_seeded), 'seeds': self.seeds} if self.bloom is not None else None
+    }
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+NOT_FOUND_TTL = float(os.environ.get('NEGATIVE_CACHE_TTL', 300))            # seconds a missing source is remembered
+UNAVAILABLE_TTL = float(os.environ.get('NEGATIVE_CACHE_ERROR_TTL', 30))     # seconds a failed build is remembered
+NEGATIVE_CACHE_MAX = int(os.environ.get('NEGATIVE_CACHE_MAX', 10000))
+
+class SourceNotFound(Exception):
+  '''The source item does not exist upstream, or has no usable image'''
+  status_code = 404
+
+  def __init__(self, key, reason='not found'):
+    super().__init__(f'{key}: {reason}')
+    self.key = key
+    self.reason = reason
+
+class SourceUnavailable(SourceNotFound):
+  '''Building from the upstream source failed'''
+  status_code = 502
+
+  def __init__(self, key, reason='upstream error'):
+    super().__init__(key, reason)
+
+class NegativeCache(object):
+  '''Short lived record of failed lookups, keyed by manifest id or by upstream key'''
+
+  def __init__(self, max_len=NEGATIVE_CACHE_MAX):
+    self.max_len = max_len
+    self.entries = OrderedDict() # key -> (expires, exception)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.recorded = 0
+
+  def check(self, key):
+    '''Raises the recorded exception while the entry for key is live'''
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return
+      expires, exc = entry
+      if monotonic() >= expires:
+        del self.entries[key]
+        return
+      self.hits += 1
+    logger.info(f'negative_cache: hit key={key} reason={exc.reason}')
+    raise type(exc)(exc.key, exc.reason)
+
+  def record(self, key, exc):
+    ttl = UNAVAILABLE_TTL if isinstance(exc, SourceUnavailable) else NOT_FOUND_TTL
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (monotonic() + ttl, exc)
+      self.recorded += 1
+      while len(self.entries) > self.max_len:
+        self.entries.popitem(last=False)
+    logger.info(f'negative_cache: record key={key} reason={exc.reason} ttl={ttl}')
+    return exc
+
+  def clear(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def stats(self):
+    return {'entries': len(self.entries), 'hits': self.hits, 'recorded': self.recorded}
+
+negative_cache = NegativeCache()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import time
+import asyncio
+import threading
+from time import monotonic
+from email.utils import parsedate_to_datetime
+
+from deadline import DeadlineExceeded
+
+# (sustained requests per second, burst) per upstream host, hosts not listed are not limited
+HOST_RATES = {
+  'query.wikidata.org': (5, 10),
+  'www.wikidata.org': (10, 20),
+  'commons.wikimedia.org': (10, 20),
+  'api.github.com': (10, 30),
+  'www.flickr.com': (1, 10),
+  'api.openverse.engineering': (1, 5),
+  'collectionapi.metmuseum.org': (20, 40),
+  'www.jstor.org': (10, 20),
+}
+MAX_RETRY_AFTER = float(os.environ.get('MAX_RETRY_AFTER', 5)) # longest Retry-After honored without a deadline
+RATE_LIMIT_RESERVE = 5 # requests kept back when an upstream reports its remaining quota
+
+def _retry_after(value):
+  if value is None:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    try:
+      return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+      return None
+
+class TokenBucket(object):
+  '''Reservation based token bucket, callers are granted tokens in arrival order'''
+
+  def __init__(self, rate, burst):
+    self.base_rate = rate
+    self.rate = rate
+    self.capacity = burst
+    self.tokens = float(burst)
+    self.updated = monotonic()
+    self.blocked_until = 0.0
+    self.lock = threading.Lock()
+    self.waits = 0
+    self.throttled = 0
+
+  def _refill(self, now):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def reserve(self, max_wait=None):
+    with self.lock:
+      now = monotonic()
+      self._refill(now)
+      wait = max(self.blocked_until - now, 0.0)
+      self.tokens -= 1
+      if self.tokens < 0:
+        wait = max(wait, -self.tokens / self.rate)
+      if max_wait is not None and wait > max_wait:
+        self.tokens += 1
+        return None
+      if wait > 0:
+        self.waits += 1
+      return wait
+
+  def try_reserve(self):
+    return self.reserve(max_wait=0) is not None
+
+  def observe(self, status_code, headers):
+    now = monotonic()
+    with self.lock:
+      retry_after = _retry_after(headers.get('Retry-After'))
+      if status_code == 429 and retry_after is None:
+        retry_after = 1.0
+      if retry_after is not None and status_code in (429, 503):
+        self.throttled += 1
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.tokens = min(self.tokens, 0.0)
+        logger.warning(f'rate_limit: upstream throttled status={status_code} retry_after={round(retry_after,3)}')
+      remaining = headers.get('X-RateLimit-Remaining')
+      reset = headers.get('X-RateLimit-Reset')
+      if remaining is not None and reset is not None:
+        try:
+          remaining, reset = int(remaining), float(reset)
+        except ValueError:
+          return retry_after
+        # reset is an epoch timestamp on GitHub, a delta in seconds on some other APIs
+        reset_in = max(1.0, reset - time.time() if reset > 1e9 else reset)
+        if remaining <= RATE_LIMIT_RESERVE:
+          self.blocked_until = max(self.blocked_until, now + reset_in)
+        else:
+          # spread the remaining quota over the window instead of exhausting it early
+          self.rate = min(self.base_rate, max((remaining - RATE_LIMIT_RESERVE) / reset_in, 0.01))
+      return retry_after
+
+  def stats(self):
+    return {'rate': round(self.rate, 3), 'tokens': round(self.tokens, 2), 'waits': self.waits, 'throttled': self.throttled}
+
+class RateLimiter(object):
+
+  def __init__(self, rates=HOST_RATES):
+    self.rates = rates
+    self.buckets = {}
+    self.lock = threading.Lock()
+
+  def bucket(self, host):
+    if host not in self.rates:
+      return None
+    if host not in self.buckets:
+      with self.lock:
+        if host not in self.buckets:
+          self.buckets[host] = TokenBucket(*self.rates[host])
+    return self.buckets[host]
+
+  def _reserve(self, host, deadline):
+    bucket = self.bucket(host)
+    if bucket is None:
+      return 0
+    wait = bucket.reserve(deadline.remaining() if deadline else None)
+    if wait is None:
+      raise DeadlineExceeded(f'rate limit for {host} exceeds request budget')
+    if wait > 0:
+      logger.debug(f'rate_limit: host={host} wait={round(wait,3)}')
+    return wait
+
+  def acquire(self, host, deadline=None):
+    wait = self._reserve(host, deadline)
+    if wait > 0:
+      time.sleep(wait)
+
+  async def aacquire(self, host, deadline=None):
+    wait = self._reserve(host, deadline)
+    if wait > 0:
+      await asyncio.sleep(wait)
+
+  def try_acquire(self, host):
+    bucket = self.bucket(host)
+    return bucket is None or bucket.try_reserve()
+
+  def observe(self, host, resp):
+    bucket = self.bucket(host)
+    if bucket is not None:
+      return bucket.observe(resp.status_code, resp.headers)
+
+  def should_retry(self, resp, retry_after, deadline=None):
+    if resp.status_code not in (429, 503) or retry_after is None:
+      return False
+    return retry_after < (deadline.remaining() if deadline else MAX_RETRY_AFTER)
+
+  def stats(self):
+    return {host: bucket.stats() for host, bucket in list(self.buckets.items())}
+
+limiter = RateLimiter()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import json
+import threading
+from time import monotonic, time
+
+# redis://host:6379/0 shares hot entries across instances, fakeredis:// uses an in-process stand-in for tests
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT', 0.1))      # seconds, a slow tier is worse than a miss
+REDIS_RETRY_AFTER = float(os.environ.get('REDIS_RETRY_AFTER', 5)) # seconds the tier is skipped after an error
+REDIS_PREFIX = os.environ.get('REDIS_PREFIX', 'iiif')
+
+_client = None
+_client_lock = threading.Lock()
+
+def client():
+  '''Shared client for REDIS_URL, None when unset or the redis package is not installed'''
+  global _client
+  if _client is None and REDIS_URL:
+    with _client_lock:
+      if _client is None:
+        try:
+          if REDIS_URL.startswith('fakeredis://'):
+            import fakeredis
+            _client = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+          else:
+            import redis
+            _client = redis.Redis.from_url(REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT, health_check_interval=30)
+          logger.info(f'redis_cache: using {REDIS_URL.split("@")[-1]}')
+        except ImportError as exc:
+          logger.warning(f'redis_cache: REDIS_URL is set but {exc.name} is not installed, distributed cache disabled')
+          return None
+  return _client
+
+class RedisCache(object):
+  '''Cache tier shared by every instance through a Redis protocol server. Keys are namespaced by cache name,
+  values other than bytes are stored as JSON and every entry is written with a TTL. Errors count as misses.'''
+
+  # values written by other instances are never unpickled, entries of any other format count as misses
+  _BYTES, _JSON = b'B', b'J'
+
+  def __init__(self, name, redis_client, max_bytes, max_age_seconds=3600):
+    self.name = name
+    self.redis = redis_client
+    self.max_entry = max_bytes // 10
+    self.max_age = int(max_age_seconds)
+    self.down_until = 0
+    self.hits = self.misses = self.errors = self.skipped = 0
+
+  def _key(self, key):
+    return f'{REDIS_PREFIX}:{self.name}:{key}'
+
+  def _available(self):
+    if monotonic() < self.down_until:
+      self.skipped += 1
+      return False
+    return True
+
+  def _failed(self, exc):
+    self.errors += 1
+    self.down_until = monotonic() + REDIS_RETRY_AFTER
+    logger.warning(f'redis_cache: name={self.name} {type(exc).__name__}: {exc}, skipping for {REDIS_RETRY_AFTER}s')
+
+  def _call(self, method, *args, **kwargs):
+    if not self._available():
+      return None
+    try:
+      return getattr(self.redis, method)(*args, **kwargs)
+    except Exception as exc:
+      self._failed(exc)
+      return None
+
+  def _encode(self, value):
+    '''None for values JSON cannot hold, they are not cached in this tier'''
+    if isinstance(value, (bytes, bytearray)):
+      return self._BYTES + bytes(value)
+    try:
+      return self._JSON + json.dumps(value, separators=(',', ':')).encode('utf-8')
+    except (TypeError, ValueError) as exc:
+      logger.debug(f'redis_cache: not caching name={self.name} {exc}')
+      return None
+
+  def _decode(self, data):
+    if data is None:
+      return None
+    if data[:1] == self._BYTES:
+      return bytes(data[1:])
+    return json.loads(data[1:]) if data[:1] == self._JSON else None
+
+  def get_entry(self, key):
+    '''(value, expires) for key, read with its TTL in one round trip, (None, None) on a miss or error'''
+    if not self._available():
+      return None, None
+    try:
+      pipe = self.redis.pipeline(transaction=False)
+      pipe.get(self._key(key))
+      pipe.pttl(self._key(key))
+      data, pttl = pipe.execute()
+    except Exception as exc:
+      self._failed(exc)
+      return None, None
+    value = self._decode(data)
+    if value is None:
+      self.misses += 1
+      return None, None
+    self.hits += 1
+    return value, time() + pttl / 1000 if pttl and pttl > 0 else None
+
+  def get(self, key, default=None):
+    value = self._decode(self._call('get', self._key(key)))
+    if value is None:
+      self.misses += 1
+      return default
+    self.hits += 1
+    return value
+
+  def __getitem__(self, key):
+    missing = object()
+    value = self.get(key, missing)
+    if value is missing:
+      raise KeyError(key)
+    return value
+
+  def __contains__(self, key):
+    return bool(self._call('exists', self._key(key)))
+
+  def __setitem__(self, key, value):
+    self.put(key, value)
+
+  def put(self, key, value, expires=None):
+    '''Stores value until expires, a unix time, at most max_age_seconds from now'''
+    data = self._encode(value)
+    ttl = self.max_age if expires is None else min(self.max_age, int(expires - time()))
+    if data is not None and len(data) <= self.max_entry and ttl > 0:
+      self._call('set', self._key(key), data, ex=ttl)
+
+  def update(self, items):
+    items = [(self._key(key), self._encode(value)) for key, value in dict(items).items()]
+    if not items or not self._available():
+      return
+    try:
+      pipe = self.redis.pipeline(transaction=False)
+      for key, data in items:
+        if data is not None and len(data) <= self.max_entry:
+          pipe.set(key, data, ex=self.max_age)
+      pipe.execute()
+    except Exception as exc:
+      self._failed(exc)
+
+  def pop(self, key, default=None):
+    value = self.get(key, default)
+    self._call('delete', self._key(key))
+    return value
+
+  def __delitem__(self, key):
+    if not self._call('delete', self._key(key)):
+      raise KeyError(key)
+
+  def __len__(self):
+    # entries expire on the server and are shared with other instances, there is no cheap local count
+    return 0
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'name': self.name,
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+      'errors': self.errors,
+      'skipped': self.skipped
+    }
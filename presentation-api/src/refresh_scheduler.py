@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import asyncio
+import threading
+from time import monotonic
+
+from tinylfu import CountMinSketch
+from executors import run_background
+
+REFRESH_TOP_N = int(os.environ.get('REFRESH_TOP_N', 2000))          # most requested manifests kept warm
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL', 60))    # seconds between scheduler passes
+REFRESH_BUDGET = int(os.environ.get('REFRESH_BUDGET', 20))          # refreshes started per pass, 0 disables the scheduler
+REFRESH_LEAD = float(os.environ.get('REFRESH_LEAD', 900))           # seconds before going stale a hot manifest is refreshed
+REFRESH_MIN_COUNT = 2                                               # manifests requested once are left to the request path
+REFRESH_RETRY = 10 * REFRESH_INTERVAL                               # next look at a manifest whose refresh did not stick
+
+class RefreshScheduler(object):
+  '''Counts requests per manifest id in a count-min sketch and refreshes the hottest
+  cached manifests in the background shortly before they would go stale.'''
+
+  def __init__(self, top_n=REFRESH_TOP_N, interval=REFRESH_INTERVAL, budget=REFRESH_BUDGET, lead=REFRESH_LEAD):
+    self.top_n = top_n
+    self.interval = interval
+    self.budget = budget
+    self.lead = lead
+    self.sketch = CountMinSketch(top_n * 16)
+    self.hot = {}     # manifest id -> estimated request count, at most 2 * top_n between prunes
+    self.floor = 0    # lowest count kept by the last prune, colder ids are not tracked
+    self.due = {}     # manifest id -> monotonic time of the next refresh
+    self.lock = threading.Lock()
+    self.refresh_fn = None
+    self._task = None
+    self.requests = self.passes = self.dispatched = self.checked = self.failed = 0
+
+  def record(self, mid):
+    with self.lock:
+      self.requests += 1
+      self.sketch.add(mid)
+      count = self.sketch.estimate(mid)
+      if count < REFRESH_MIN_COUNT or (mid not in self.hot and count < self.floor):
+        return
+      # re-inserted so that among ids with saturated counters the most recently requested rank first
+      self.hot.pop(mid, None)
+      self.hot[mid] = count
+      if len(self.hot) > 2 * self.top_n:
+        self._prune()
+
+  def _prune(self):
+    # counts are read again, ids that went quiet have been halved by sketch aging since they were recorded
+    ranked = self._ranked([(mid, self.sketch.estimate(mid)) for mid in self.hot])
+    self.hot = dict(reversed(ranked))
+    self.floor = ranked[-1][1] if len(ranked) == self.top_n else 0
+    self.due = dict([(mid, due) for mid, due in self.due.items() if mid in self.hot])
+
+  def _ranked(self, counts):
+    return sorted(reversed(counts), key=lambda item: item[1], reverse=True)[:self.top_n]
+
+  def _candidates(self):
+    with self.lock:
+      now = monotonic()
+      return [mid for mid, _ in self._ranked(list(self.hot.items())) if self.due.get(mid, 0) <= now][:self.budget]
+
+  def _refresh(self, mid):
+    try:
+      due_in = self.refresh_fn(mid, self.lead)
+    except Exception as exc:
+      logger.warning(f'refresh_scheduler: refresh failed mid={mid} {type(exc).__name__}: {exc}')
+      due_in = None
+      self.failed += 1
+    with self.lock:
+      if mid in self.hot:
+        self.due[mid] = monotonic() + (REFRESH_RETRY if due_in is None else max(due_in, self.interval))
+    if due_in is not None:
+      self.checked += 1
+
+  def run_pass(self):
+    self.passes += 1
+    candidates = self._candidates()
+    for mid in candidates:
+      # shares the key of request path rebuilds so a manifest is never refreshed twice at once
+      if run_background(f'rebuild:{mid}', self._refresh, mid):
+        self.dispatched += 1
+    if candidates:
+      logger.info(f'refresh_scheduler: pass={self.passes} candidates={len(candidates)} tracked={len(self.hot)}')
+
+  async def _loop(self):
+    while True:
+      await asyncio.sleep(self.interval)
+      self.run_pass()
+
+  def start(self, refresh_fn):
+    '''refresh_fn(mid, lead) refreshes mid if it goes stale within lead seconds and returns the seconds until it is next due'''
+    self.refresh_fn = refresh_fn
+    if self._task is None and self.budget > 0:
+      self._task = asyncio.get_running_loop().create_task(self._loop())
+
+  def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      self._task = None
+
+  def stats(self):
+    return {
+      'requests': self.requests,
+      'tracked': len(self.hot),
+      'floor': self.floor,
+      'passes': self.passes,
+      'dispatched': self.dispatched,
+      'checked': self.checked,
+      'failed': self.failed,
+      'sketch_resets': self.sketch.resets
+    }
+
+scheduler = RefreshScheduler()
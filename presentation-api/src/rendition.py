@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Manifests as served. Manifests are stored gzipped with {BASE_URL} placeholders and kept in process as
+templates split at the placeholders, so a cache hit is rendered by joining bytes, without parsing JSON.
+The rendered body for a base url is compressed once, when the manifest is written or first served, and
+the gzip and brotli variants are cached by content digest so responses pick one without compressing anything.
+'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import json
+import gzip
+import hashlib
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+from expiringdict import ExpiringDict
+from tinylfu import TinyLFUCache
+from cache_backend import make_cache
+
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', 'https://iiif.juncture-digital.org') # variants for it are made when a manifest is written
+GZIP_LEVEL = int(os.environ.get('MANIFEST_GZIP_LEVEL', 9))
+BROTLI_QUALITY = int(os.environ.get('MANIFEST_BROTLI_QUALITY', 9)) # 10 and 11 are several times slower for a few percent
+COMPRESS_MIN_BYTES = 1024 # smaller bodies are sent as is
+# preferred first, brotli is only offered when the package is installed
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+TEMPLATE_ENTRIES = int(os.environ.get('MANIFEST_TEMPLATE_ENTRIES', 2000)) # stored manifests kept split and parsed for facts
+# seconds the digest of a stored manifest is trusted, a rebuild elsewhere reaches revalidating clients after this
+DIGEST_TRUST_SECONDS = int(os.environ.get('MANIFEST_DIGEST_TRUST_SECONDS', 60))
+
+_GZIP_MAGIC = b'\x1f\x8b'
+# format marker in the user metadata of stored manifests, the objects are also sent with Content-Encoding: gzip
+GZIP_FORMAT, PLAIN_FORMAT = 'json+gzip', 'json'
+_PLACEHOLDER = b'{BASE_URL}'
+
+# compressed bodies keyed by content digest and encoding, a changed manifest gets new keys and old ones age out
+variants = make_cache('manifest_variants', TinyLFUCache(32 * 1024 * 1024, max_age_seconds=3600), 256 * 1024 * 1024, max_age_seconds=86400, distributed=True)
+# templates by digest of the stored object, a stored manifest is decompressed and parsed once per process
+_templates = ExpiringDict(max_len=TEMPLATE_ENTRIES, max_age_seconds=3600)
+# digest of the stored template of each manifest id, set whenever a manifest is saved or loaded
+current_digests = make_cache('manifest_digests', ExpiringDict(max_len=50000, max_age_seconds=DIGEST_TRUST_SECONDS), 16 * 1024 * 1024, max_age_seconds=DIGEST_TRUST_SECONDS, distributed=True)
+# the last response to each request key, with the manifest id and template digest it was made from
+served = make_cache('manifest_served', ExpiringDict(max_len=50000, max_age_seconds=3600), 16 * 1024 * 1024, max_age_seconds=86400, distributed=True)
+_stats = {'not_modified': 0, 'templates_loaded': 0, 'templates_reused': 0, 'compressed': 0, 'served': dict([(encoding, 0) for encoding in ENCODINGS + ('identity',)])}
+
+def pack(template):
+  '''Stored form of a manifest template'''
+  return gzip.compress(template.encode('utf-8'), GZIP_LEVEL, mtime=0)
+
+def unpack(stored):
+  '''Manifest template from either stored form, gzipped or plain JSON. Manifests stored before compression
+  are plain, and a reader that honours the Content-Encoding of a gzipped object gets it decompressed.'''
+  if isinstance(stored, str):
+    return stored
+  if stored[:2] == _GZIP_MAGIC:
+    stored = gzip.decompress(stored)
+  return stored.decode('utf-8')
+
+def stored_metadata(stored, metadata=None):
+  '''User metadata to store a manifest with, marked with the form it is stored in'''
+  gzipped = isinstance(stored, bytes) and stored[:2] == _GZIP_MAGIC
+  return dict(metadata or {}, format=GZIP_FORMAT if gzipped else PLAIN_FORMAT)
+
+def _digest(data):
+  return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class Template(object):
+  '''A manifest serialized with {BASE_URL} placeholders, split at them so rendering for a base url is a join.
+  facts holds the values handlers check on a cache hit, taken when the manifest was parsed.'''
+
+  def __init__(self, text, digest=None, facts=None):
+    self.chunks = text.encode('utf-8').split(_PLACEHOLDER)
+    self.digest = digest or _digest(text.encode('utf-8'))
+    self.facts = facts or {}
+
+  @property
+  def text(self):
+    return _PLACEHOLDER.join(self.chunks).decode('utf-8')
+
+  def manifest(self):
+    return json.loads(self.text)
+
+  def render(self, baseurl):
+    return (baseurl or '').encode('utf-8').join(self.chunks)
+
+  def __deepcopy__(self, memo):
+    # never changed once made, shared by the copies single flight hands out
+    return self
+
+def load(stored, facts):
+  '''Template of a stored manifest, facts(m) is called with the parsed manifest the first time it is seen.
+  Without facts the manifest is not parsed. Templates are digested by their text, so both stored forms
+  of a manifest have the same digest and ETag.'''
+  stored_digest = _digest(stored if isinstance(stored, bytes) else stored.encode('utf-8'))
+  template = _templates.get(stored_digest)
+  if template is None:
+    text = unpack(stored)
+    template = _templates[stored_digest] = Template(text, facts=facts(json.loads(text)) if facts else None)
+    _stats['templates_loaded'] += 1
+  else:
+    _stats['templates_reused'] += 1
+  return template
+
+def store(text, facts):
+  '''Stored form and template of a manifest about to be written, the template is reused when it is read back'''
+  stored = pack(text)
+  template = _templates[_digest(stored)] = Template(text, facts=facts)
+  return stored, template
+
+def stored_as(manifestid, template):
+  '''Records the template a manifest id is currently stored as'''
+  if current_digests.get(manifestid) != template.digest:
+    current_digests[manifestid] = template.digest
+
+def remember(key, response, source):
+  '''Records the response made for a request key from source, the rendition of the stored manifest'''
+  if source.manifestid:
+    served[key] = (source.manifestid, source.template.digest, response.digest, len(response.body))
+
+def known_digest(key):
+  '''Manifest id, response digest and body size of the last response for key, (None, None, None) unless it is
+  still current. The size tells which encoding a 304 names in its ETag, as the 200 would have.'''
+  entry = served.get(key)
+  # entries recorded without the size are not used
+  if entry and len(entry) == 4 and current_digests.get(entry[0]) == entry[1]:
+    return entry[0], entry[2], entry[3]
+  return None, None, None
+
+def etag(digest, encoding=None):
+  # strong validators differ per content coding
+  return f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+
+def etag_matches(if_none_match, digest):
+  '''If-None-Match comparison, weak and per coding, so a validator of any variant of the body matches'''
+  if not if_none_match or not digest:
+    return False
+  for tag in if_none_match.split(','):
+    tag = tag.strip()
+    if tag == '*':
+      return True
+    tag = tag[2:] if tag.startswith('W/') else tag
+    if tag.strip('"').split('-')[0] == digest:
+      _stats['not_modified'] += 1
+      return True
+  return False
+
+def compress(body, encoding):
+  _stats['compressed'] += 1
+  if encoding == 'br':
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+  return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+def negotiate(accept_encoding):
+  '''Preferred encoding the client accepts, None for identity'''
+  accepted = {}
+  for item in (accept_encoding or '').lower().split(','):
+    coding, _, params = item.strip().partition(';')
+    quality = 1.0
+    if params.strip().startswith('q='):
+      try:
+        quality = float(params.strip()[2:])
+      except ValueError:
+        quality = 0.0
+    accepted[coding.strip()] = quality
+  best = None
+  for encoding in ENCODINGS:
+    quality = accepted.get(encoding, accepted.get('*', 0.0))
+    if quality > 0 and (best is None or quality > best[1]):
+      best = (encoding, quality)
+  return best[0] if best else None
+
+def served_encoding(accept_encoding, size):
+  '''Encoding a body of size bytes is sent in for the client's Accept-Encoding, None when sent as is'''
+  return negotiate(accept_encoding) if size >= COMPRESS_MIN_BYTES else None
+
+class Rendition(object):
+  '''A manifest rendered for a base url. manifestid is the id it is cached under, None for external manifests.
+  The manifest dict is only parsed from the body when asked for.'''
+
+  def __init__(self, template, baseurl, manifest=None, manifestid=None):
+    self.template = template
+    self.baseurl = baseurl
+    self.manifestid = manifestid
+    self._manifest = manifest
+    self._body = None
+
+  @property
+  def body(self):
+    if self._body is None:
+      self._body = self.template.render(self.baseurl)
+    return self._body
+
+  @property
+  def manifest(self):
+    if self._manifest is None:
+      self._manifest = json.loads(self.body)
+    return self._manifest
+
+  @property
+  def digest(self):
+    return _digest(f'{self.template.digest}|{self.baseurl}'.encode('utf-8'))
+
+  def precompress(self):
+    '''Makes the variants missing from the cache'''
+    if len(self.body) >= COMPRESS_MIN_BYTES:
+      for encoding in ENCODINGS:
+        if f'{self.digest}.{encoding}' not in variants:
+          variants[f'{self.digest}.{encoding}'] = compress(self.body, encoding)
+
+  def encoded(self, accept_encoding):
+    '''Response body for the client's Accept-Encoding and its Content-Encoding, None when sent as is'''
+    encoding = served_encoding(accept_encoding, len(self.body))
+    if encoding is None:
+      _stats['served']['identity'] += 1
+      return self.body, None
+    content = variants.get(f'{self.digest}.{encoding}')
+    if content is None:
+      # evicted, or a manifest cached before variants were made, compressed once here and then shared
+      content = variants[f'{self.digest}.{encoding}'] = compress(self.body, encoding)
+    _stats['served'][encoding] += 1
+    return content, encoding
+
+def precompress(template, baseurls):
+  '''Variants of a manifest just written, for the base urls it is likely to be requested with'''
+  for baseurl in set([baseurl for baseurl in baseurls if baseurl]):
+    Rendition(template, baseurl).precompress()
+
+def stats():
+  return dict(_stats, templates=len(_templates), encodings=ENCODINGS, variants=variants.stats() if hasattr(variants, 'stats') else None)
@@ -14,17 +14,58 @@ DEFAULT_CACHE_DIR = '/data'
 DEFAULT_CACHE_NAME = 'corpus'
 
 from expiringdict import ExpiringDict
+from tinylfu import TinyLFUCache
+from cache_backend import make_cache
+from write_behind import write_behind, WRITE_BEHIND_BUCKETS
+from membership import Membership, MEMBERSHIP_BLOOM_BUCKETS
+from executors import run_background
 
 import boto3
 from botocore.exceptions import ClientError
 
 DEFAULT_BUCKET_NAME = 'iiif-tile-cache'
 
+# byte budget of the in-process cache in front of each bucket
+LOCAL_CACHE_BYTES = {
+    'iiif-manifest-cache': int(os.environ.get('MANIFEST_LOCAL_CACHE_BYTES', 64 * 1024 * 1024)),
+    'iiif-thumbnail': int(os.environ.get('THUMBNAIL_LOCAL_CACHE_BYTES', 16 * 1024 * 1024))
+}
+DEFAULT_LOCAL_CACHE_BYTES = int(os.environ.get('LOCAL_CACHE_BYTES', 16 * 1024 * 1024))
+# byte budget of the cache shared by the worker processes of a node, behind the in-process cache
+SHARED_CACHE_BYTES = {
+    'iiif-manifest-cache': int(os.environ.get('MANIFEST_SHARED_CACHE_BYTES', 256 * 1024 * 1024)),
+    'iiif-thumbnail': int(os.environ.get('THUMBNAIL_SHARED_CACHE_BYTES', 128 * 1024 * 1024))
+}
+DEFAULT_SHARED_CACHE_BYTES = int(os.environ.get('SHARED_CACHE_BYTES', 64 * 1024 * 1024))
+# buckets whose objects are also kept in the distributed cache when REDIS_URL is set
+DISTRIBUTED_BUCKETS = ('iiif-manifest-cache',)
+PRESIGNED_URL_REGION = 'us-east-1'
+PRESIGNED_URL_REUSE = 300 # seconds a presigned url is handed out again
+
 class Bucket(object):
     
     def __init__(self, bucket=DEFAULT_BUCKET_NAME, **kwargs):
         self.bucket_name = bucket
-        self._local_cache = ExpiringDict(max_len=100, max_age_seconds=3600) # cache content for 60 minutes
+        self._local_cache = make_cache(
+            f's3-{bucket}',
+            TinyLFUCache(
+                kwargs.get('local_cache_bytes', LOCAL_CACHE_BYTES.get(bucket, DEFAULT_LOCAL_CACHE_BYTES)),
+                max_age_seconds=3600 # cache content for 60 minutes
+            ),
+            kwargs.get('shared_cache_bytes', SHARED_CACHE_BYTES.get(bucket, DEFAULT_SHARED_CACHE_BYTES)),
+            max_age_seconds=3600,
+            distributed=bucket in DISTRIBUTED_BUCKETS
+        )
+        # user metadata of objects read or written
+        self._local_metadata = make_cache(
+            f's3-{bucket}-metadata',
+            ExpiringDict(max_len=10000, max_age_seconds=3600),
+            16 * 1024 * 1024,
+            max_age_seconds=3600,
+            distributed=bucket in DISTRIBUTED_BUCKETS
+        )
+        # puts return once the object is in the cache tiers, S3 is written by the write_behind flusher
+        self.write_behind = kwargs.get('write_behind', bucket in WRITE_BEHIND_BUCKETS)
         if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
             self.s3 = boto3.client('s3')
         else:
@@ -33,24 +74,80 @@ class Bucket(object):
                 aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY')
             ).client('s3')
         self.s3_paginator = self.s3.get_paginator('list_objects_v2')
+        # known existence of keys, answers exists() without a request to S3 when it can
+        self.membership = Membership(bucket, bloom=kwargs.get('membership_bloom', bucket in MEMBERSHIP_BLOOM_BUCKETS))
+
+    def exists(self, key):
+        '''True if an object with exactly this key exists'''
+        if write_behind.get(self.bucket_name, key) is not None:
+            return True
+        if self.membership.needs_seed():
+            run_background(f'membership:{self.bucket_name}', self.membership.seed, self.__iter__(''))
+        known = self.membership.lookup(key)
+        if known is not None:
+            return known
+        return self.metadata(key) is not None
 
     def __contains__(self, key):
-        return self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=key)['KeyCount'] > 0
+        return self.exists(key)
 
     def __setitem__(self, key, obj):
-        logger.info(f'__setitem__: bucket={self.bucket_name} key={key}')
+        return self.put(key, obj)
+
+    def put(self, key, obj, metadata=None):
+        logger.info(f'put: bucket={self.bucket_name} key={key} metadata={metadata}')
         self._local_cache[key] = obj
-        return self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=obj)
+        self._local_metadata[key] = metadata or {}
+        self.membership.added(key)
+        if self.write_behind and write_behind.put(self, key, obj, metadata or {}):
+            return None
+        return self.put_object(key, obj, metadata)
+
+    def put_object(self, key, obj, metadata=None):
+        metadata = metadata or {}
+        # objects marked as gzipped JSON, such as stored manifests, say so in their headers too
+        encoding = {'ContentEncoding': 'gzip', 'ContentType': 'application/json'} if metadata.get('format', '').endswith('+gzip') else {}
+        return self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=obj, Metadata=metadata, **encoding)
+
+    def metadata(self, key):
+        '''User metadata stored with the object, None if the object does not exist'''
+        metadata = self._local_metadata.get(key)
+        if metadata is not None:
+            return metadata
+        pending = write_behind.get(self.bucket_name, key)
+        if pending is not None:
+            return pending.metadata
+        try:
+            metadata = self.s3.head_object(Bucket=self.bucket_name, Key=key).get('Metadata', {})
+        except ClientError as ex:
+            if ex.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                self.membership.record(key, False)
+                return None
+            raise
+        self._local_metadata[key] = metadata
+        self.membership.record(key, True)
+        return metadata
 
     def __getitem__(self, key, refresh=False):
-        logger.info(f's3.__getitem__ {key} in_cache={key in self._local_cache} refresh={refresh}')
+        obj = None if refresh else self._local_cache.get(key)
+        logger.info(f's3.__getitem__ {key} in_cache={obj is not None} refresh={refresh}')
         try:
-            if refresh or key not in self._local_cache:
-                self._local_cache[key] = self.s3.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
-            return self._local_cache[key]
+            pending = write_behind.get(self.bucket_name, key) if obj is None else None
+            if pending is not None:
+                # not in S3 yet, and newer than what S3 holds
+                obj = pending.obj
+            elif obj is None:
+                # the local cache may decline to admit the object, so it is returned directly
+                resp = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+                obj = resp['Body'].read()
+                self._local_cache[key] = obj
+                self._local_metadata[key] = resp.get('Metadata', {})
+                self.membership.record(key, True)
+            return obj
         except ClientError as ex:
             logger.info(f's3.__getitem__ {key} not found')
             if ex.response['Error']['Code'] == 'NoSuchKey':
+                self.membership.record(key, False)
                 raise KeyError
 
     def get(self, key, default=None, refresh=False):
@@ -60,8 +157,15 @@ class Bucket(object):
             return default
 
     def __delitem__(self, key):
+        write_behind.discard(self.bucket_name, key)
+        self._local_cache.pop(key)
+        self._local_metadata.pop(key, None)
+        self.membership.removed(key)
         return self.s3.delete_object(Bucket=self.bucket_name, Key=key)
 
+    def stats(self):
+        return {'bucket': self.bucket_name, 'write_behind': self.write_behind, 'membership': self.membership.stats(), 'local_cache': self._local_cache.stats()}
+
     def __iter__(self, prefix='/', delimiter='/', start_after=''):
         logger.info(f'__iter__: prefix={prefix}')
         prefix = prefix[1:] if prefix.startswith(delimiter) else prefix
@@ -86,6 +190,26 @@ class Bucket(object):
     def dir(self, prefix=None):
         return self.keys(prefix)
 
+_presigned_urls = make_cache('presigned_urls', ExpiringDict(max_len=10000, max_age_seconds=PRESIGNED_URL_REUSE), 16 * 1024 * 1024, max_age_seconds=PRESIGNED_URL_REUSE, distributed=True)
+_presign_client = None
+
+def presigned_url(bucket_name, key, expiration=600, **params):
+    '''Presigned GET url for an object, params are passed on as get_object parameters.
+    Urls valid for at least twice PRESIGNED_URL_REUSE are reused for PRESIGNED_URL_REUSE seconds.'''
+    global _presign_client
+    # the url is fetched straight from S3, an object still pending there is written first
+    if write_behind.get(bucket_name, key) is not None:
+        write_behind.flush(bucket_name, key)
+    cache_key = f'{bucket_name}/{key}?{"&".join(f"{name}={value}" for name, value in sorted(params.items()))}&expiration={expiration}'
+    url = _presigned_urls.get(cache_key)
+    if url is None:
+        if _presign_client is None:
+            _presign_client = boto3.client('s3', region_name=PRESIGNED_URL_REGION, config=boto3.session.Config(signature_version='s3v4'))
+        url = _presign_client.generate_presigned_url('get_object', Params=dict(params, Bucket=bucket_name, Key=key), ExpiresIn=expiration)
+        if expiration >= 2 * PRESIGNED_URL_REUSE:
+            _presigned_urls[cache_key] = url
+    return url
+
 def usage():
     print('%s [hl:b:edup:] [keys]' % sys.argv[0])
     print('   -h --help            Print help message')
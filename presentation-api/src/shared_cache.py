@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from time import time as now
+
+SHARED_CACHE_DIR = os.environ.get('SHARED_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'iiif-shared-cache')) # empty disables the shared tier
+SHARED_CACHE_TRIM_EVERY = 200    # writes between checks of the byte budget
+SHARED_CACHE_TOUCH_AFTER = 60    # seconds before a read refreshes an entry's recency, keeps reads mostly write free
+_BYTES, _TEXT, _JSON = 0, 1, 2   # how a value is stored, the cache is shared so values are never unpickled
+
+def db_path(cache_dir, name):
+  # the format is part of the file name, databases of earlier formats are left alone
+  return os.path.join(cache_dir, f'{name}.v2.sqlite')
+
+def encode(value):
+  '''(blob, format) for a value, raises TypeError for values JSON cannot hold'''
+  if isinstance(value, (bytes, bytearray)):
+    return bytes(value), _BYTES
+  if isinstance(value, str):
+    return value.encode('utf-8'), _TEXT
+  return json.dumps(value, separators=(',', ':')).encode('utf-8'), _JSON
+
+def decode(blob, format):
+  if format == _TEXT:
+    return blob.decode('utf-8')
+  return json.loads(blob) if format == _JSON else blob
+
+class SharedCache(object):
+  '''Cache shared by the worker processes of a node, one SQLite database in WAL mode per cache.
+  Values are stored as bytes, text or JSON, entries expire after max_age_seconds and the least recently
+  read entries are dropped when the database grows past max_bytes.'''
+
+  def __init__(self, name, max_bytes, max_age_seconds=3600, cache_dir=SHARED_CACHE_DIR):
+    self.name = name
+    self.max_bytes = max_bytes
+    self.max_age = max_age_seconds
+    self.path = db_path(cache_dir, name)
+    os.makedirs(cache_dir, exist_ok=True)
+    self._local = threading.local()
+    self.hits = self.misses = self.writes = self.trims = self.errors = 0
+    with self._connection() as db:
+      db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, format INTEGER, size INTEGER, expires REAL, accessed REAL)')
+      db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+  def _connection(self):
+    # sqlite connections are not shared between threads
+    db = getattr(self._local, 'db', None)
+    if db is None:
+      db = self._local.db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+  @staticmethod
+  def _key(key):
+    return key if isinstance(key, str) else repr(key)
+
+  def _row(self, key):
+    try:
+      return self._connection().execute('SELECT value, format, expires, accessed FROM cache WHERE key = ?', (self._key(key),)).fetchone()
+    except sqlite3.Error as exc:
+      self.errors += 1
+      logger.warning(f'shared_cache: read failed name={self.name} {exc}')
+      return None
+
+  def get_entry(self, key):
+    '''(value, expires) for key, (None, None) when it is missing or expired'''
+    row = self._row(key)
+    if row is None or row[2] <= now():
+      self.misses += 1
+      return None, None
+    value, format, expires, accessed = row
+    self.hits += 1
+    if now() - accessed > SHARED_CACHE_TOUCH_AFTER:
+      self._execute('UPDATE cache SET accessed = ? WHERE key = ?', (now(), self._key(key)))
+    return decode(value, format), expires
+
+  def get(self, key, default=None):
+    value, _ = self.get_entry(key)
+    return default if value is None else value
+
+  def __getitem__(self, key):
+    missing = object()
+    value = self.get(key, missing)
+    if value is missing:
+      raise KeyError(key)
+    return value
+
+  def __contains__(self, key):
+    row = self._row(key)
+    return row is not None and row[2] > now()
+
+  def __setitem__(self, key, value):
+    self.put(key, value)
+
+  def put(self, key, value, expires=None):
+    '''Stores value until expires, a unix time, at most max_age_seconds from now'''
+    expires = now() + self.max_age if expires is None else min(expires, now() + self.max_age)
+    try:
+      blob, format = encode(value)
+    except (TypeError, ValueError) as exc:
+      logger.debug(f'shared_cache: not caching key={key} name={self.name} {exc}')
+      return
+    if len(blob) > self.max_bytes // 10 or expires <= now():
+      return
+    self._execute('INSERT OR REPLACE INTO cache (key, value, format, size, expires, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+      (self._key(key), blob, format, len(blob), expires, now()))
+    self.writes += 1
+    if self.writes % SHARED_CACHE_TRIM_EVERY == 0:
+      self.trim()
+
+  def update(self, items):
+    for key, value in dict(items).items():
+      self[key] = value
+
+  def pop(self, key, default=None):
+    value = self.get(key, default)
+    self._execute('DELETE FROM cache WHERE key = ?', (self._key(key),))
+    return value
+
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    self.pop(key)
+
+  def __len__(self):
+    row = self._fetchone('SELECT COUNT(*) FROM cache WHERE expires > ?', (now(),))
+    return row[0] if row else 0
+
+  def _execute(self, sql, params=()):
+    try:
+      self._connection().execute(sql, params)
+    except sqlite3.Error as exc:
+      # a busy or broken shared tier only costs hit rate, callers fall back to the upstream source
+      self.errors += 1
+      logger.warning(f'shared_cache: write failed name={self.name} {exc}')
+
+  def _fetchone(self, sql, params=()):
+    try:
+      return self._connection().execute(sql, params).fetchone()
+    except sqlite3.Error as exc:
+      self.errors += 1
+      logger.warning(f'shared_cache: read failed name={self.name} {exc}')
+      return None
+
+  def trim(self):
+    '''Drops expired entries, then the least recently read ones until the cache fits its byte budget'''
+    self._execute('DELETE FROM cache WHERE expires <= ?', (now(),))
+    row = self._fetchone('SELECT COALESCE(SUM(size), 0) FROM cache')
+    excess = (row[0] if row else 0) - self.max_bytes
+    if excess > 0:
+      # a tenth of the budget is freed at once so the next writes do not trim again
+      self._execute('''DELETE FROM cache WHERE key IN (
+        SELECT key FROM (SELECT key, size, SUM(size) OVER (ORDER BY accessed) AS freed FROM cache) WHERE freed - size < ?)''',
+        (excess + self.max_bytes // 10,))
+      self.trims += 1
+
+  @property
+  def bytes(self):
+    row = self._fetchone('SELECT COALESCE(SUM(size), 0) FROM cache')
+    return row[0] if row else 0
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'name': self.name,
+      'entries': len(self),
+      'bytes': self.bytes,
+      'max_bytes': self.max_bytes,
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+      'trims': self.trims,
+      'errors': self.errors
+    }
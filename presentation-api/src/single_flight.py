@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import copy
+import asyncio
+import hashlib
+import tempfile
+import threading
+from time import sleep, monotonic
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+try:
+  import fcntl
+except ImportError: # not available on Windows, builds are then only coalesced within a process
+  fcntl = None
+
+from deadline import DeadlineExceeded
+
+BUILD_LOCK_DIR = os.environ.get('BUILD_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'iiif-build-locks'))
+BUILD_LOCK_TIMEOUT = float(os.environ.get('BUILD_LOCK_TIMEOUT', 30)) # longest wait on a build held by another worker
+BUILD_LOCK_POLL = 0.05
+
+class SingleFlight(object):
+  '''Coalesces concurrent calls for the same key into one in-flight call.
+  Within a process callers share the leader's result, across worker processes on a node
+  the leader holds an flock lease on a per key lock file while it builds.'''
+
+  def __init__(self, name, lock_dir=BUILD_LOCK_DIR):
+    self.name = name
+    self.lock_dir = lock_dir
+    self.flights = {}
+    self.lock = threading.Lock()
+    self.leaders = 0
+    self.followers = 0
+    self.peer_waits = 0
+
+  def _join(self, key):
+    with self.lock:
+      future = self.flights.get(key)
+      if future is not None:
+        self.followers += 1
+        return future, False
+      future = self.flights[key] = Future()
+      self.leaders += 1
+      return future, True
+
+  def _finish(self, key, future, result=None, error=None):
+    with self.lock:
+      self.flights.pop(key, None)
+    if error is not None:
+      future.set_exception(error)
+    else:
+      future.set_result(result)
+
+  def _open_lock(self, lease_key):
+    if fcntl is None:
+      return None
+    try:
+      os.makedirs(self.lock_dir, exist_ok=True)
+      path = os.path.join(self.lock_dir, f'{self.name}-{hashlib.sha1(lease_key.encode("utf-8")).hexdigest()}.lock')
+      return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as exc:
+      logger.warning(f'single_flight: lock file unavailable, coalescing within this process only: {exc}')
+      return None
+
+  @staticmethod
+  def _try_lock(fd):
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      return True
+    except BlockingIOError:
+      return False
+
+  @staticmethod
+  def _release(fd):
+    if fd is not None:
+      fcntl.flock(fd, fcntl.LOCK_UN)
+      os.close(fd)
+
+  def _wait_limit(self, deadline):
+    return monotonic() + min(BUILD_LOCK_TIMEOUT, deadline.remaining() if deadline else BUILD_LOCK_TIMEOUT)
+
+  @contextmanager
+  def _lease(self, lease_key, deadline):
+    '''Yields True when another worker held the lease and has since finished building'''
+    fd = self._open_lock(lease_key)
+    try:
+      if fd is None or self._try_lock(fd):
+        yield False
+        return
+      self.peer_waits += 1
+      logger.info(f'single_flight: waiting on another worker name={self.name} key={lease_key}')
+      until = self._wait_limit(deadline)
+      while monotonic() < until:
+        sleep(BUILD_LOCK_POLL)
+        if self._try_lock(fd):
+          yield True
+          return
+      # the other worker is taking too long, build without the lease rather than fail the request
+      yield False
+    finally:
+      self._release(fd)
+
+  @asynccontextmanager
+  async def _alease(self, lease_key, deadline):
+    fd = self._open_lock(lease_key)
+    try:
+      if fd is None or self._try_lock(fd):
+        yield False
+        return
+      self.peer_waits += 1
+      logger.info(f'single_flight: waiting on another worker name={self.name} key={lease_key}')
+      until = self._wait_limit(deadline)
+      while monotonic() < until:
+        await asyncio.sleep(BUILD_LOCK_POLL)
+        if self._try_lock(fd):
+          yield True
+          return
+      yield False
+    finally:
+      self._release(fd)
+
+  def do(self, key, fn, lease_key=None, deadline=None):
+    '''Calls fn(peer_built) once for concurrent callers of key, every caller gets its own copy of the result'''
+    future, leader = self._join(key)
+    if not leader:
+      try:
+        return copy.deepcopy(future.result(timeout=deadline.remaining() if deadline else None))
+      except FutureTimeout:
+        raise DeadlineExceeded(f'waiting on in-flight build of {key}')
+    try:
+      with self._lease(lease_key or key, deadline) as peer_built:
+        result = fn(peer_built)
+    except BaseException as exc:
+      self._finish(key, future, error=exc)
+      raise
+    self._finish(key, future, result)
+    return copy.deepcopy(result)
+
+  async def ado(self, key, coro_fn, lease_key=None, deadline=None):
+    '''Async counterpart of do, coro_fn(peer_built) returns an awaitable'''
+    future, leader = self._join(key)
+    if not leader:
+      try:
+        result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), deadline.remaining() if deadline else None)
+      except asyncio.TimeoutError:
+        raise DeadlineExceeded(f'waiting on in-flight build of {key}')
+      return copy.deepcopy(result)
+    try:
+      async with self._alease(lease_key or key, deadline) as peer_built:
+        result = await coro_fn(peer_built)
+    except BaseException as exc:
+      self._finish(key, future, error=exc)
+      raise
+    self._finish(key, future, result)
+    return copy.deepcopy(result)
+
+  def stats(self):
+    return {'in_flight': len(self.flights), 'leaders': self.leaders, 'followers': self.followers, 'peer_waits': self.peer_waits}
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Warm start snapshot of the hottest cache entries. The file is memory-mapped at cold start
+and looked up in place, entries are only decoded when a cache miss reaches them.
+
+  python snapshot.py export [-n 2000] [-o cache.snapshot]   export from the node shared caches
+  python snapshot.py info [cache.snapshot]
+'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+
+import mmap
+import json
+import zlib
+import sqlite3
+import struct
+import hashlib
+import argparse
+import tempfile
+import urllib.request
+from time import time as now
+
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', os.path.join(SCRIPT_DIR, 'cache.snapshot'))
+SNAPSHOT_URL = os.environ.get('SNAPSHOT_URL')                                # fetched in one GET when no file is shipped
+SNAPSHOT_MAX_AGE = float(os.environ.get('SNAPSHOT_MAX_AGE_DAYS', 7)) * 86400 # older snapshots are ignored
+# caches exported by default, the manifest bucket with its metadata, entity labels and image service states
+SNAPSHOT_CACHES = ('s3-iiif-manifest-cache', 's3-iiif-manifest-cache-metadata', 'entity_labels', 'image_service_states')
+
+_MAGIC = b'IIIFSNP3'
+_HEADER = struct.Struct('<8sdII')    # magic, created, entries, length of the cache names json
+_INDEX = struct.Struct('<QII')       # key hash, record offset, record length, sorted by hash
+_RECORD = struct.Struct('<HBd')      # key length, flags, unix time the entry expires
+_JSON, _COMPRESSED, _TEXT = 1, 2, 4 # a snapshot may be fetched from SNAPSHOT_URL, its values are never unpickled
+_COMPRESS_OVER = 512
+
+def _hash(full_key):
+  return struct.unpack('<Q', hashlib.blake2b(full_key, digest_size=8).digest())[0]
+
+def _full_key(cache, key):
+  # keys are normalized as in shared_cache
+  return f'{cache}\x00{key if isinstance(key, str) else repr(key)}'.encode('utf-8')
+
+class Snapshot(object):
+  '''Read-only view of a snapshot file, lookups binary search the mmapped index'''
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as fp:
+      self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.created, self.entries, names_len = _HEADER.unpack_from(self.mm, 0)
+    if magic != _MAGIC:
+      raise ValueError(f'{path} is not a cache snapshot')
+    self.caches = set(json.loads(self.mm[_HEADER.size:_HEADER.size+names_len]))
+    self.index_start = _HEADER.size + names_len
+    self.hits = self.misses = 0
+
+  def _index(self, pos):
+    return _INDEX.unpack_from(self.mm, self.index_start + pos * _INDEX.size)
+
+  def _lower_bound(self, key_hash):
+    lo, hi = 0, self.entries
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._index(mid)[0] < key_hash:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def get(self, cache, key, default=None):
+    value, _ = self.get_entry(cache, key)
+    return default if value is None else value
+
+  def get_entry(self, cache, key):
+    '''(value, expires) for key in cache, (None, None) when it is not in the snapshot or has expired'''
+    full_key = _full_key(cache, key)
+    key_hash = _hash(full_key)
+    pos = self._lower_bound(key_hash)
+    while pos < self.entries:
+      entry_hash, offset, length = self._index(pos)
+      if entry_hash != key_hash:
+        break
+      key_len, flags, expires = _RECORD.unpack_from(self.mm, offset)
+      start = offset + _RECORD.size
+      if self.mm[start:start+key_len] == full_key:
+        if expires <= now():
+          break
+        self.hits += 1
+        payload = self.mm[start+key_len:offset+length]
+        if flags & _COMPRESSED:
+          payload = zlib.decompress(payload)
+        if flags & _JSON:
+          return json.loads(payload), expires
+        return payload.decode('utf-8') if flags & _TEXT else payload, expires
+      pos += 1
+    self.misses += 1
+    return None, None
+
+  def stats(self):
+    return {'path': self.path, 'age': round(now() - self.created), 'entries': self.entries, 'hits': self.hits, 'misses': self.misses}
+
+class SnapshotTier(object):
+  '''One cache's entries in a snapshot, as the last read-only tier of a TieredCache'''
+
+  def __init__(self, snapshot, cache):
+    self.snapshot = snapshot
+    self.cache = cache
+
+  def get(self, key, default=None):
+    return self.snapshot.get(self.cache, key, default)
+
+  def get_entry(self, key):
+    return self.snapshot.get_entry(self.cache, key)
+
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def __setitem__(self, key, value):
+    pass
+
+  def update(self, items):
+    pass
+
+  def pop(self, key, default=None):
+    return default
+
+  def stats(self):
+    return dict(self.snapshot.stats(), cache=self.cache)
+
+def write(path, entries, created=None):
+  '''entries is an iterable of (cache, key, value, expires), values other than bytes and str are stored as JSON'''
+  caches, records = set(), []
+  for cache, key, value, expires in entries:
+    caches.add(cache)
+    full_key = _full_key(cache, key)
+    flags = 0
+    if isinstance(value, str):
+      value, flags = value.encode('utf-8'), _TEXT
+    elif not isinstance(value, (bytes, bytearray)):
+      value, flags = json.dumps(value, separators=(',', ':')).encode('utf-8'), _JSON
+    if len(value) > _COMPRESS_OVER:
+      compressed = zlib.compress(value, 9)
+      if len(compressed) < len(value):
+        value, flags = compressed, flags | _COMPRESSED
+    records.append((_hash(full_key), _RECORD.pack(len(full_key), flags, expires) + full_key + bytes(value)))
+  records.sort(key=lambda record: record[0])
+  names = json.dumps(sorted(caches)).encode('utf-8')
+  offset = _HEADER.size + len(names) + len(records) * _INDEX.size
+  tmp_path = f'{path}.tmp'
+  with open(tmp_path, 'wb') as fp:
+    fp.write(_HEADER.pack(_MAGIC, created or now(), len(records), len(names)))
+    fp.write(names)
+    for key_hash, record in records:
+      fp.write(_INDEX.pack(key_hash, offset, len(record)))
+      offset += len(record)
+    for _, record in records:
+      fp.write(record)
+  os.replace(tmp_path, path)
+  return len(records)
+
+def export_shared_caches(path, limit, caches=SNAPSHOT_CACHES, cache_dir=None):
+  '''Exports the most recently read live entries of each node shared cache'''
+  from shared_cache import SHARED_CACHE_DIR, db_path, decode
+  cache_dir = cache_dir or SHARED_CACHE_DIR
+  def entries():
+    for cache in caches:
+      cache_path = db_path(cache_dir, cache)
+      if not os.path.exists(cache_path):
+        logger.warning(f'snapshot: no shared cache {cache_path}')
+        continue
+      db = sqlite3.connect(f'file:{cache_path}?mode=ro', uri=True)
+      rows = db.execute('SELECT key, value, format, expires FROM cache WHERE expires > ? ORDER BY accessed DESC LIMIT ?', (now(), limit))
+      for key, value, format, expires in rows:
+        yield cache, key, decode(value, format), expires
+      db.close()
+  return write(path, entries())
+
+def load(path=SNAPSHOT_PATH, url=SNAPSHOT_URL):
+  '''Snapshot shipped at path, or fetched from url, None when there is none or it is too old'''
+  if not os.path.exists(path) and url:
+    path = os.path.join(tempfile.gettempdir(), 'iiif-cache.snapshot')
+    if not os.path.exists(path):
+      try:
+        start = now()
+        with urllib.request.urlopen(url, timeout=10) as resp, open(f'{path}.tmp', 'wb') as fp:
+          fp.write(resp.read())
+        os.replace(f'{path}.tmp', path)
+        logger.info(f'snapshot: fetched {url} elapsed={round(now()-start,3)}')
+      except Exception as exc:
+        logger.warning(f'snapshot: fetching {url} failed: {exc}')
+        return None
+  if not os.path.exists(path):
+    return None
+  try:
+    snapshot = Snapshot(path)
+  except (OSError, ValueError, struct.error) as exc:
+    logger.warning(f'snapshot: ignoring {path}: {exc}')
+    return None
+  if now() - snapshot.created > SNAPSHOT_MAX_AGE:
+    logger.info(f'snapshot: ignoring {path}, created {round((now()-snapshot.created)/86400, 1)} days ago')
+    return None
+  logger.info(f'snapshot: loaded {path} entries={snapshot.entries} caches={sorted(snapshot.caches)}')
+  return snapshot
+
+if __name__ == '__main__':
+  logger.setLevel(logging.INFO)
+  parser = argparse.ArgumentParser(description='Export or inspect a warm start cache snapshot')
+  parser.add_argument('command', choices=('export', 'info'))
+  parser.add_argument('path', nargs='?', default=SNAPSHOT_PATH)
+  parser.add_argument('-n', '--limit', type=int, default=2000, help='entries exported per cache')
+  parser.add_argument('-o', '--output', help='snapshot file to write, defaults to path')
+  parser.add_argument('-d', '--cache-dir', help='shared cache directory, defaults to SHARED_CACHE_DIR')
+  args = parser.parse_args()
+  if args.command == 'export':
+    count = export_shared_caches(args.output or args.path, args.limit, cache_dir=args.cache_dir)
+    print(f'{count} entries written to {args.output or args.path}')
+  else:
+    snapshot = Snapshot(args.path)
+    print(json.dumps(dict(snapshot.stats(), caches=sorted(snapshot.caches)), indent=2))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Manifest summaries. The few values the thumbnail, banner and poster routes need from a manifest, recorded
+when the manifest is saved or loaded, so a redirect is a lookup by manifest id without loading the manifest.
+'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+from time import time
+
+from expiringdict import ExpiringDict
+from cache_backend import make_cache
+
+import rendition
+
+SUMMARY_ENTRIES = int(os.environ.get('MANIFEST_SUMMARY_ENTRIES', 100000))      # per process, a summary is a few hundred bytes
+SUMMARY_MAX_AGE = int(os.environ.get('MANIFEST_SUMMARY_MAX_AGE', 86400))      # seconds, unless a newer stored manifest is seen first
+
+def _find_item(obj, type, attr=None, attr_val=None, sub_attr=None):
+  if 'items' in obj and isinstance(obj['items'], list):
+    for item in obj['items']:
+      if item.get('type') == type and (attr is None or item.get(attr) == attr_val):
+          return item[sub_attr] if sub_attr else item
+      return _find_item(item, type, attr, attr_val, sub_attr)
+
+def _metadata_value(m, key):
+  return next(iter([list(md['value'].values())[0][0] for md in m.get('metadata',[]) if key in [list(md['label'].values())[0][0]]]), None)
+
+def summarize(m):
+  '''Summary of a v3 manifest'''
+  canvas = _find_item(m, 'Canvas') or {}
+  body = _find_item(m, type='Annotation', attr='motivation', attr_val='painting', sub_attr='body') or {}
+  thumbnail = m.get('thumbnail')
+  return {
+    'service_id': body['service'][0].get('id') if body.get('service') else None,
+    'type': body.get('type'),
+    'width': body.get('width', canvas.get('width')),
+    'height': body.get('height', canvas.get('height')),
+    'thumbnail': thumbnail[0].get('id') if isinstance(thumbnail, list) and thumbnail else None,
+    'image_url': _metadata_value(m, 'image_url')
+  }
+
+class Summaries(object):
+  '''Summaries by manifest id, each tagged with the digest of the stored template it was taken from.
+  A summary is not used once a different template is known to be stored for its manifest id.'''
+
+  def __init__(self):
+    self.cache = make_cache('manifest_summaries', ExpiringDict(max_len=SUMMARY_ENTRIES, max_age_seconds=SUMMARY_MAX_AGE), 32 * 1024 * 1024, max_age_seconds=SUMMARY_MAX_AGE)
+    self.hits = self.misses = self.stale = self.written = 0
+
+  def record(self, manifestid, template, due=None, expires=None):
+    '''Records the summary of the template a manifest id is stored as, the summary is one of the template facts.
+    due is the unix time the manifest is next revalidated, expires the time it is past its hard TTL.'''
+    summary = template.facts.get('summary')
+    if summary is None:
+      return
+    current = self.cache.get(manifestid)
+    # a revalidated manifest keeps its digest but moves its due time, the summary is rewritten with it
+    if current is None or current['digest'] != template.digest or abs((current.get('due') or 0) - (due or 0)) > 1:
+      self.cache[manifestid] = dict(summary, digest=template.digest, due=due, expires=expires)
+      self.written += 1
+
+  def get(self, manifestid):
+    '''Summary of a manifest, None when it has to be loaded'''
+    summary = self.cache.get(manifestid)
+    if summary is None:
+      self.misses += 1
+      return None
+    if rendition.current_digests.get(manifestid) not in (None, summary['digest']) or time() >= (summary.get('expires') or float('inf')):
+      self.stale += 1
+      return None
+    self.hits += 1
+    return summary
+
+  def due(self, summary):
+    '''True when the manifest a summary was taken from is due to be revalidated'''
+    return summary.get('due') is None or time() >= summary['due']
+
+  def stats(self):
+    lookups = self.hits + self.misses + self.stale
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'stale': self.stale,
+      'written': self.written,
+      'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+    }
+
+summaries = Summaries()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import sys
+import random
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+
+AVG_ENTRY_BYTES = 8 * 1024 # used to size the sketch from a byte budget
+_HALVE = bytes([count >> 1 for count in range(256)])
+_MASK64 = (1 << 64) - 1
+
+class CountMinSketch(object):
+  '''Approximate access counts in 4 bit saturating counters, halved periodically so old popularity fades'''
+
+  def __init__(self, width, depth=4, sample_factor=10):
+    self.width = 1 << max(10, (int(width) - 1).bit_length())
+    self.mask = self.width - 1
+    self.rows = [bytearray(self.width) for _ in range(depth)]
+    self.seeds = [random.getrandbits(64) for _ in range(depth)]
+    self.additions = 0
+    self.sample_size = sample_factor * self.width
+    self.resets = 0
+
+  def _indexes(self, key):
+    # each row mixes the key hash with its own seed through the murmur3 finalizer, hash((h, seed))
+    # gave row indexes that differ by a constant offset so keys colliding in one row collided in all
+    h = hash(key)
+    indexes = []
+    for seed in self.seeds:
+      x = ((h ^ seed) * 0xff51afd7ed558ccd) & _MASK64
+      x ^= x >> 33
+      x = (x * 0xc4ceb9fe1a85ec53) & _MASK64
+      x ^= x >> 33
+      indexes.append(x & self.mask)
+    return indexes
+
+  def add(self, key):
+    for row, idx in zip(self.rows, self._indexes(key)):
+      if row[idx] < 15:
+        row[idx] += 1
+    self.additions += 1
+    if self.additions >= self.sample_size:
+      self.age()
+
+  def estimate(self, key):
+    return min(row[idx] for row, idx in zip(self.rows, self._indexes(key)))
+
+  def age(self):
+    for row in self.rows:
+      row[:] = row.translate(_HALVE)
+    self.additions //= 2
+    self.resets += 1
+
+def _sizeof(value):
+  return len(value) if isinstance(value, (bytes, bytearray, str)) else sys.getsizeof(value)
+
+class _Entry(object):
+
+  __slots__ = ('value', 'size', 'expires')
+
+  def __init__(self, value, size, expires):
+    self.value = value
+    self.size = size
+    self.expires = expires
+
+class TinyLFUCache(object):
+  '''Byte budgeted W-TinyLFU cache. New entries land in a small LRU window, entries leaving the window
+  are admitted to the main segmented LRU only if they are accessed more often than the entry they would evict.'''
+
+  def __init__(self, max_bytes, max_age_seconds=3600, window_ratio=0.01, protected_ratio=0.8, max_entry_ratio=0.1, sketch=None):
+    self.max_bytes = max_bytes
+    self.max_age = max_age_seconds
+    self.window_max = max(1, int(max_bytes * window_ratio))
+    self.protected_max = int((max_bytes - self.window_max) * protected_ratio)
+    self.main_max = max_bytes - self.window_max
+    self.max_entry = int(max_bytes * max_entry_ratio)
+    self.sketch = sketch or CountMinSketch(max_bytes // AVG_ENTRY_BYTES)
+    self.window, self.probation, self.protected = OrderedDict(), OrderedDict(), OrderedDict()
+    self.sizes = {'window': 0, 'probation': 0, 'protected': 0}
+    self.lock = threading.RLock()
+    self.hits = self.misses = self.evictions = self.rejections = self.expirations = 0
+
+  def _segments(self):
+    return (('window', self.window), ('probation', self.probation), ('protected', self.protected))
+
+  def _find(self, key):
+    for name, segment in self._segments():
+      if key in segment:
+        return name, segment
+    return None, None
+
+  def _remove(self, key):
+    name, segment = self._find(key)
+    if segment is not None:
+      entry = segment.pop(key)
+      self.sizes[name] -= entry.size
+      return entry
+
+  def _live(self, key):
+    '''Segment holding key, expired entries are dropped on the way'''
+    name, segment = self._find(key)
+    if segment is not None and monotonic() >= segment[key].expires:
+      self._remove(key)
+      self.expirations += 1
+      return None, None
+    return name, segment
+
+  def __contains__(self, key):
+    with self.lock:
+      return self._live(key)[1] is not None
+
+  def get(self, key, default=None):
+    with self.lock:
+      self.sketch.add(key)
+      name, segment = self._live(key)
+      if segment is None:
+        self.misses += 1
+        return default
+      self.hits += 1
+      entry = segment[key]
+      if name == 'probation':
+        # a second hit promotes the entry, the protected segment demotes its least recent entries to make room
+        del self.probation[key]
+        self.sizes['probation'] -= entry.size
+        self.protected[key] = entry
+        self.sizes['protected'] += entry.size
+        while self.sizes['protected'] > self.protected_max and len(self.protected) > 1:
+          demoted_key, demoted = self.protected.popitem(last=False)
+          self.sizes['protected'] -= demoted.size
+          self.probation[demoted_key] = demoted
+          self.sizes['probation'] += demoted.size
+      else:
+        segment.move_to_end(key)
+      return entry.value
+
+  def __getitem__(self, key):
+    missing = object()
+    value = self.get(key, missing)
+    if value is missing:
+      raise KeyError(key)
+    return value
+
+  def __setitem__(self, key, value):
+    self.put(key, value)
+
+  def put(self, key, value, expires=None):
+    '''Stores value until expires, a unix time, at most max_age_seconds from now'''
+    size = _sizeof(value)
+    ttl = self.max_age if expires is None else min(self.max_age, expires - time())
+    with self.lock:
+      self._remove(key)
+      if size > self.max_entry:
+        self.rejections += 1
+        logger.debug(f'tinylfu: not caching key={key} size={size} max_entry={self.max_entry}')
+        return
+      self.window[key] = _Entry(value, size, monotonic() + ttl)
+      self.sizes['window'] += size
+      while self.sizes['window'] > self.window_max:
+        candidate_key, candidate = self.window.popitem(last=False)
+        self.sizes['window'] -= candidate.size
+        self._admit(candidate_key, candidate)
+
+  def _admit(self, key, entry):
+    # the candidate is judged once, against the entry it would evict first, a rejected candidate evicts nothing
+    if self.sizes['probation'] + self.sizes['protected'] + entry.size > self.main_max:
+      victims = self.probation if self.probation else self.protected
+      if self.sketch.estimate(key) <= self.sketch.estimate(next(iter(victims))):
+        self.rejections += 1
+        return
+      # an admitted candidate larger than the first victim takes the room of the next least recent entries too
+      while self.sizes['probation'] + self.sizes['protected'] + entry.size > self.main_max:
+        victims = self.probation if self.probation else self.protected
+        victim_key, victim = victims.popitem(last=False)
+        self.sizes['probation' if victims is self.probation else 'protected'] -= victim.size
+        self.evictions += 1
+    self.probation[key] = entry
+    self.sizes['probation'] += entry.size
+
+  def pop(self, key, default=None):
+    with self.lock:
+      entry = self._remove(key)
+      return entry.value if entry is not None else default
+
+  def __delitem__(self, key):
+    with self.lock:
+      if self._remove(key) is None:
+        raise KeyError(key)
+
+  def __len__(self):
+    return len(self.window) + len(self.probation) + len(self.protected)
+
+  @property
+  def bytes(self):
+    return sum(self.sizes.values())
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'entries': len(self),
+      'bytes': self.bytes,
+      'max_bytes': self.max_bytes,
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+      'evictions': self.evictions,
+      'rejections': self.rejections,
+      'expirations': self.expirations
+    }
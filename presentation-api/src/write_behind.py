@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import atexit
+import threading
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+
+# comma separated buckets whose puts return before reaching S3, empty keeps every put synchronous
+WRITE_BEHIND_BUCKETS = tuple([name.strip() for name in os.environ.get('S3_WRITE_BEHIND_BUCKETS', '').split(',') if name.strip()])
+WRITE_BEHIND_INTERVAL = float(os.environ.get('S3_WRITE_BEHIND_INTERVAL', 0.5))                 # seconds between flushes
+WRITE_BEHIND_BATCH = int(os.environ.get('S3_WRITE_BEHIND_BATCH', 32))                         # puts per flush, a full batch flushes at once
+WRITE_BEHIND_WORKERS = int(os.environ.get('S3_WRITE_BEHIND_WORKERS', 8))                      # concurrent puts of a flush
+WRITE_BEHIND_ATTEMPTS = int(os.environ.get('S3_WRITE_BEHIND_ATTEMPTS', 6))                    # then the write is dropped and logged
+WRITE_BEHIND_MAX_BYTES = int(os.environ.get('S3_WRITE_BEHIND_MAX_BYTES', 64 * 1024 * 1024))   # pending beyond this, puts are synchronous again
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.environ.get('S3_WRITE_BEHIND_SHUTDOWN_TIMEOUT', 20)) # seconds shutdown waits for pending writes
+
+class _Write(object):
+  __slots__ = ('bucket', 'key', 'obj', 'metadata', 'size', 'attempts', 'due')
+
+  def __init__(self, bucket, key, obj, metadata):
+    self.bucket = bucket
+    self.key = key
+    self.obj = obj
+    self.metadata = metadata
+    self.size = len(obj) if isinstance(obj, (bytes, bytearray, str)) else 0
+    self.attempts = 0
+    self.due = monotonic()
+
+class WriteBehind(object):
+  '''Pending S3 writes, persisted in batches by a flusher thread. A later write of a key replaces a pending one,
+  failed writes are retried with exponential backoff. Readers of the bucket see pending objects through get().'''
+
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.pending = {} # (bucket name, key) -> _Write, kept until the put succeeds
+    self.inflight = set()
+    self.pending_bytes = 0
+    self.thread = None
+    self.stopping = False
+    self.executor = ThreadPoolExecutor(max_workers=WRITE_BEHIND_WORKERS, thread_name_prefix='iiif-write-behind')
+    self.queued = self.written = self.coalesced = self.retries = self.dropped = self.synchronous = self.flushes = 0
+
+  def put(self, bucket, key, obj, metadata):
+    '''Queues the write, False when the backlog is full or shutting down and the caller should write synchronously'''
+    write = _Write(bucket, key, obj, metadata)
+    with self.cond:
+      if self.stopping or self.pending_bytes + write.size > WRITE_BEHIND_MAX_BYTES:
+        self.synchronous += 1
+        return False
+      replaced = self.pending.get((bucket.bucket_name, key))
+      if replaced is not None:
+        self.pending_bytes -= replaced.size
+        self.coalesced += 1
+      self.pending[(bucket.bucket_name, key)] = write
+      self.pending_bytes += write.size
+      self.queued += 1
+      if self.thread is None:
+        self.thread = threading.Thread(target=self._run, name='iiif-write-behind-flusher', daemon=True)
+        self.thread.start()
+      if len(self.pending) - len(self.inflight) >= WRITE_BEHIND_BATCH:
+        self.cond.notify_all()
+    return True
+
+  def get(self, bucket_name, key):
+    '''The pending write of key, None when there is none'''
+    with self.cond:
+      return self.pending.get((bucket_name, key))
+
+  def discard(self, bucket_name, key):
+    with self.cond:
+      write = self.pending.pop((bucket_name, key), None)
+      if write is not None:
+        self.pending_bytes -= write.size
+
+  def _take(self, batch, due_only=True, match=None):
+    # called with the lock held, marks the writes taken as in flight
+    at = monotonic()
+    writes = [write for pkey, write in self.pending.items()
+              if pkey not in self.inflight and (not due_only or write.due <= at) and (match is None or match(pkey))][:batch]
+    self.inflight.update([(write.bucket.bucket_name, write.key) for write in writes])
+    return writes
+
+  def _write(self, write):
+    pkey = (write.bucket.bucket_name, write.key)
+    try:
+      write.bucket.put_object(write.key, write.obj, write.metadata)
+      succeeded = True
+    except Exception as exc:
+      succeeded = False
+      write.attempts += 1
+      logger.warning(f'write_behind: put failed bucket={pkey[0]} key={write.key} attempt={write.attempts} {type(exc).__name__}: {exc}')
+    with self.cond:
+      self.inflight.discard(pkey)
+      current = self.pending.get(pkey)
+      if succeeded:
+        self.written += 1
+      elif write.attempts >= WRITE_BEHIND_ATTEMPTS:
+        self.dropped += 1
+        logger.error(f'write_behind: dropping write bucket={pkey[0]} key={write.key} after {write.attempts} attempts')
+      else:
+        self.retries += 1
+        write.due = monotonic() + WRITE_BEHIND_INTERVAL * 2 ** write.attempts
+      # a newer write of the key queued meanwhile stays pending
+      if current is write and (succeeded or write.attempts >= WRITE_BEHIND_ATTEMPTS):
+        del self.pending[pkey]
+        self.pending_bytes -= write.size
+      self.cond.notify_all()
+
+  def _write_all(self, writes):
+    try:
+      list(self.executor.map(self._write, writes))
+    except RuntimeError:
+      # executors refuse work once the interpreter is shutting down, the drain at exit writes in this thread
+      for write in writes:
+        self._write(write)
+
+  def _run(self):
+    while True:
+      with self.cond:
+        if self.stopping:
+          return
+        self.cond.wait(WRITE_BEHIND_INTERVAL)
+        writes = self._take(WRITE_BEHIND_BATCH)
+      if writes:
+        self.flushes += 1
+        self._write_all(writes)
+
+  def flush(self, bucket_name=None, key=None, timeout=None):
+    '''Writes pending objects now, retries included, all of them or those of one bucket or key.
+    Returns the number of writes still pending when timeout runs out.'''
+    match = lambda pkey: (bucket_name is None or pkey[0] == bucket_name) and (key is None or pkey[1] == key)
+    deadline = monotonic() + timeout if timeout is not None else None
+    while True:
+      with self.cond:
+        remaining = [pkey for pkey in self.pending if match(pkey)]
+        if not remaining or (deadline is not None and monotonic() >= deadline):
+          return len(remaining)
+        writes = self._take(WRITE_BEHIND_BATCH, due_only=False, match=match)
+        if not writes:
+          # taken by the flusher thread, wait for it to finish them
+          self.cond.wait(0.05 if deadline is None else max(0, min(0.05, deadline - monotonic())))
+          continue
+      self._write_all(writes)
+
+  def stop(self, timeout=WRITE_BEHIND_SHUTDOWN_TIMEOUT):
+    '''Flushes pending writes and stops the flusher, later puts are synchronous'''
+    with self.cond:
+      self.stopping = True
+      self.cond.notify_all()
+    remaining = self.flush(timeout=timeout)
+    if remaining:
+      logger.error(f'write_behind: {remaining} writes not persisted at shutdown')
+    return remaining
+
+  def stats(self):
+    return {
+      'buckets': WRITE_BEHIND_BUCKETS,
+      'pending': len(self.pending),
+      'pending_bytes': self.pending_bytes,
+      'inflight': len(self.inflight),
+      'queued': self.queued,
+      'written': self.written,
+      'coalesced': self.coalesced,
+      'retries': self.retries,
+      'dropped': self.dropped,
+      'synchronous': self.synchronous,
+      'flushes': self.flushes
+    }
+
+write_behind = WriteBehind()
+# a worker exiting without the app shutdown event still persists what it queued
+atexit.register(write_behind.stop)
@@ -0,0 +1,72 @@
+import os
+import sys
+import tempfile
+
+# the service modules are imported from src as they are when the app runs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+# node shared caches of a test run are kept apart from those of a service running on the same machine
+os.environ.setdefault('SHARED_CACHE_DIR', tempfile.mkdtemp(prefix='iiif-test-cache-'))
+os.environ.setdefault('SNAPSHOT_PATH', os.path.join(os.environ['SHARED_CACHE_DIR'], 'cache.snapshot'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import io
+import uuid
+from collections import Counter
+
+import pytest
+
+
+class FakeS3(object):
+  '''boto3 S3 client stand-in holding the objects of one bucket, fail_puts makes the next puts raise'''
+
+  def __init__(self):
+    self.objects = {} # key -> (body, metadata)
+    self.calls = Counter()
+    self.fail_puts = 0
+
+  def _error(self, code, operation):
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code, 'Message': 'Not Found'}}, operation)
+
+  def put_object(self, Bucket, Key, Body, Metadata, **kwargs):
+    self.calls['put_object'] += 1
+    if self.fail_puts:
+      self.fail_puts -= 1
+      raise ConnectionError('S3 unavailable')
+    self.objects[Key] = (Body, Metadata)
+
+  def get_object(self, Bucket, Key):
+    self.calls['get_object'] += 1
+    if Key not in self.objects:
+      raise self._error('NoSuchKey', 'GetObject')
+    body, metadata = self.objects[Key]
+    return {'Body': io.BytesIO(body), 'Metadata': metadata}
+
+  def head_object(self, Bucket, Key):
+    self.calls['head_object'] += 1
+    if Key not in self.objects:
+      raise self._error('404', 'HeadObject')
+    return {'Metadata': self.objects[Key][1]}
+
+  def delete_object(self, Bucket, Key):
+    self.objects.pop(Key, None)
+
+  def get_paginator(self, name):
+    return self
+
+  def paginate(self, Bucket, Prefix, StartAfter):
+    self.calls['list_objects_v2'] += 1
+    yield {'Contents': [{'Key': key} for key in sorted(self.objects) if key.startswith(Prefix) and key > StartAfter]}
+
+
+@pytest.fixture
+def make_bucket():
+  '''Buckets backed by a FakeS3, each with a name of its own so no cache tier is shared between tests'''
+  from s3 import Bucket
+
+  def make_bucket(**kwargs):
+    bucket = Bucket(f'test-{uuid.uuid4().hex[:12]}', **kwargs)
+    bucket.s3 = bucket.s3_paginator = FakeS3()
+    return bucket
+  return make_bucket
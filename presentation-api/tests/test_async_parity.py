@@ -0,0 +1,66 @@
+import asyncio
+import base64
+
+import pytest
+
+import gh
+import http_client
+import handlers.jstor
+import handlers.met
+from negative_cache import SourceNotFound
+
+class FakeResponse(object):
+
+  def __init__(self, status_code, body=None, url=''):
+    self.status_code = status_code
+    self.body = body
+    self.url = url
+
+  def json(self):
+    return self.body
+
+@pytest.fixture
+def upstream(monkeypatch):
+  '''Serves the same canned responses to the sync and async clients'''
+  responses = {}
+  def get(url, **kwargs):
+    for prefix, resp in responses.items():
+      if url.startswith(prefix):
+        return resp
+    return FakeResponse(404)
+  async def aget(url, **kwargs):
+    return get(url, **kwargs)
+  monkeypatch.setattr(http_client, 'get', get)
+  monkeypatch.setattr(http_client, 'aget', aget)
+  return responses
+
+def test_gh_file_parsed_the_same(upstream):
+  upstream['https://api.github.com/repos/a/b/contents'] = FakeResponse(200, {'content': base64.b64encode(b'label: x').decode(), 'sha': 'abc'})
+  url = gh._contents_url('a', 'b', None, '/x.yaml')
+  assert gh.get_gh_file_by_url(url) == asyncio.run(gh.aget_gh_file_by_url(url)) == ('label: x', url, 'abc')
+
+def test_gh_dir_list_parsed_the_same(upstream):
+  upstream['https://api.github.com/repos/a/c/contents/'] = FakeResponse(200, [{'name': 'x.jpg'}, {'name': 'x.yaml'}])
+  assert gh.gh_dir_list('a', 'c') == asyncio.run(gh.agh_dir_list('a', 'c')) == ['x.jpg', 'x.yaml']
+  assert gh.gh_dir_list('a', 'd') == asyncio.run(gh.agh_dir_list('a', 'd')) == []
+
+def test_jstor_props_parsed_the_same(upstream):
+  upstream['https://www.jstor.org/api/'] = FakeResponse(200, {'item_title': 'T', 'iiifUrls': ['https://www.jstor.org/iiif/abc']})
+  upstream['https://api.juncture-digital.org/image-info/'] = FakeResponse(200, {'width': 10, 'height': 20})
+  sync_props = handlers.jstor.Handler('123', defer_build=True).raw_props
+  async_props = asyncio.run(handlers.jstor.Handler('123', defer_build=True).araw_props())
+  assert sync_props == async_props
+  assert sync_props['iiif_info'] == {'width': 10, 'height': 20}
+
+def test_met_not_found_raised_by_both(upstream):
+  with pytest.raises(SourceNotFound):
+    handlers.met.Handler('1', defer_build=True).raw_props
+  with pytest.raises(SourceNotFound):
+    asyncio.run(handlers.met.Handler('2', defer_build=True).araw_props())
+
+def test_gh_sourceid_extension_found_the_same(upstream):
+  import handlers.github
+  upstream['https://api.github.com/repos/a/c/contents/'] = FakeResponse(200, [{'name': 'x.jpg'}])
+  Handler = handlers.github.Handler
+  assert Handler._fix_sourceid('a/c/x') == asyncio.run(Handler._afix_sourceid('a/c/x')) == 'a/c/x.jpg'
+  assert Handler._fix_sourceid('a/c/y.png') == asyncio.run(Handler._afix_sourceid('a/c/y.png')) == 'a/c/y.png'
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+
+import pytest
+
+from batch_loader import BatchLoader
+from deadline import Deadline, DeadlineExceeded
+
+
+class SlowLoader(object):
+  '''load_batch stand-in that records each batch and holds it until released'''
+
+  def __init__(self):
+    self.batches = []
+    self.release = threading.Event()
+
+  def __call__(self, keys, deadline):
+    self.batches.append(list(keys))
+    self.release.wait(5)
+    return {key: key.upper() for key in keys}
+
+
+def test_concurrent_keys_are_coalesced_into_one_batch():
+  load = SlowLoader()
+  load.release.set()
+  loader = BatchLoader('test', load, window=0.05)
+
+  async def lookups():
+    return await asyncio.gather(loader.aload_many(['a', 'b']), loader.aload_many(['b', 'c']))
+
+  first, second = asyncio.run(lookups())
+  assert first == {'a': 'A', 'b': 'B'}
+  assert second == {'b': 'B', 'c': 'C'}
+  assert load.batches == [['a', 'b', 'c']]
+  assert loader.stats() == {'batches': 1, 'keys': 3, 'coalesced': 1}
+
+
+def test_timed_out_caller_does_not_cancel_shared_keys():
+  load = SlowLoader()
+  loader = BatchLoader('test', load, window=0.01)
+
+  async def lookups():
+    patient = asyncio.ensure_future(loader.aload_many(['a', 'b'], Deadline(5)))
+    await asyncio.sleep(0)
+    with pytest.raises(DeadlineExceeded):
+      await loader.aload_many(['a'], Deadline(0.05))
+    load.release.set()
+    return await patient
+
+  assert asyncio.run(lookups()) == {'a': 'A', 'b': 'B'}
+  assert load.batches == [['a', 'b']]
+
+
+def test_failed_batch_is_raised_to_every_caller():
+  def load(keys, deadline):
+    raise RuntimeError('upstream down')
+
+  loader = BatchLoader('test', load, window=0.01)
+  with pytest.raises(RuntimeError):
+    loader.load_many(['a', 'b'])
+  # the failed keys are not held on to, the next lookup sends a new batch
+  with pytest.raises(RuntimeError):
+    loader.load('a')
+  assert loader.stats()['batches'] == 2
+
+
+def test_sync_lookups_from_many_threads():
+  load = SlowLoader()
+  load.release.set()
+  loader = BatchLoader('test', load, window=0.05)
+  results = []
+
+  def lookup(key):
+    results.append(loader.load(key, Deadline(5)))
+
+  threads = [threading.Thread(target=lookup, args=(key,)) for key in 'abcd']
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert sorted(results) == ['A', 'B', 'C', 'D']
+  assert sum(len(batch) for batch in load.batches) == 4
+  assert len(load.batches) < 4
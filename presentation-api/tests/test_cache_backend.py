@@ -0,0 +1,63 @@
+from time import time, sleep
+
+import pytest
+from expiringdict import ExpiringDict
+
+import snapshot
+from cache_backend import TieredCache
+from redis_cache import RedisCache
+from shared_cache import SharedCache
+from tinylfu import TinyLFUCache
+
+
+def _shared(tmp_path, max_age=3600):
+  return SharedCache('test', 1024 * 1024, max_age, cache_dir=str(tmp_path))
+
+
+def test_warmed_entry_keeps_the_time_left_on_it(tmp_path):
+  shared = _shared(tmp_path)
+  shared.put('key', {'label': 'x'}, expires=time() + 60)
+  local = ExpiringDict(max_len=10, max_age_seconds=3600)
+  cache = TieredCache(local, shared)
+
+  assert cache.get('key') == {'label': 'x'}
+  _, age = local.get('key', with_age=True)
+  # the local copy is as old as a 3600s entry with 60s left would be
+  assert 3600 - 62 < age <= 3600 - 59
+
+
+def test_local_copy_expires_with_the_shared_entry(tmp_path):
+  shared = _shared(tmp_path)
+  cache = TieredCache(TinyLFUCache(1024 * 1024, max_age_seconds=3600), shared)
+  shared.put('key', b'body', expires=time() + 0.2)
+  assert cache.get('key') == b'body'
+  sleep(0.3)
+  assert cache.get('key') is None
+
+
+def test_redis_tier_carries_its_ttl_to_faster_tiers(tmp_path):
+  fakeredis = pytest.importorskip('fakeredis')
+  redis = RedisCache('test', fakeredis.FakeStrictRedis(server=fakeredis.FakeServer()), 1024 * 1024, 3600)
+  redis.put('key', 'value', expires=time() + 120)
+  shared = _shared(tmp_path)
+  cache = TieredCache(ExpiringDict(max_len=10, max_age_seconds=3600), shared, redis)
+
+  assert cache.get('key') == 'value'
+  value, expires = shared.get_entry('key')
+  assert value == 'value'
+  assert time() + 110 < expires <= time() + 121
+
+
+def test_snapshot_entries_expire_as_exported(tmp_path):
+  path = str(tmp_path / 'cache.snapshot')
+  snapshot.write(path, [('test', 'live', 'a', time() + 300), ('test', 'expired', 'b', time() - 1)])
+  tier = snapshot.SnapshotTier(snapshot.Snapshot(path), 'test')
+  value, expires = tier.get_entry('live')
+  assert value == 'a' and expires > time() + 290
+  assert tier.get_entry('expired') == (None, None)
+
+
+def test_put_never_extends_past_max_age(tmp_path):
+  shared = _shared(tmp_path, max_age=60)
+  shared.put('key', 'value', expires=time() + 3600)
+  assert shared.get_entry('key')[1] <= time() + 60
@@ -0,0 +1,40 @@
+import json
+
+from handlers.wikimedia_commons import Handler
+from rendition import Template
+
+
+SOURCEID = 'Example image.jpg'
+SERVICE = 'https://iiif.example.org/image/abc'
+
+
+def cached_handler(body_id=None):
+  '''A Commons handler holding a cached manifest template, as it is after a cache hit'''
+  handler = Handler.__new__(Handler)
+  handler.sourceid = SOURCEID
+  body_id = body_id or handler._image_url_from_sourceid()
+  handler._m = None
+  handler._image_url = None
+  handler.changes = []
+  handler._service_endpoint = lambda: SERVICE
+  handler.set_service = lambda refresh=False: handler.changes.append('service')
+  handler.add_metadata = lambda *args: handler.changes.append('metadata')
+  facts = {'format': 'image/jpeg', 'body_id': body_id, 'body_type': 'Image', 'body_format': 'image/jpeg',
+           'thumbnail': [{'id': body_id}], 'service_id': SERVICE}
+  handler.template = Template(json.dumps({'id': f'wc:{SOURCEID}'}), facts=facts)
+  return handler
+
+
+def test_matching_cached_manifest_is_served_untouched():
+  handler = cached_handler()
+  assert handler._prepare() is False
+  # neither the image url setter nor set_service ran, so the manifest was never parsed
+  assert handler.changes == []
+  assert handler._m is None and handler._image_url is None
+
+
+def test_stale_cached_manifest_gets_the_derived_image_url_and_service():
+  handler = cached_handler('https://upload.wikimedia.org/wikipedia/commons/0/00/Old.jpg')
+  assert handler._prepare() is True
+  assert handler._image_url == handler._image_url_from_sourceid()
+  assert handler.changes == ['metadata', 'service']
@@ -0,0 +1,40 @@
+import asyncio
+
+from deadline import Deadline
+from handlers import handler_base
+from handlers.handler_base import HandlerBase
+
+
+def _handler():
+  handler = HandlerBase.__new__(HandlerBase)
+  handler.language = 'en'
+  handler.deadline = Deadline(5)
+  handler._labels_looked_up = set()
+  return handler
+
+
+def test_prefetched_qids_without_label_are_not_looked_up_again(monkeypatch):
+  lookups = []
+
+  async def aload_many(keys, deadline=None):
+    lookups.append([qid for qid, _ in keys])
+    return {key: ('Mona Lisa' if key[0] == 'Q12418' else None) for key in keys}
+
+  def load_many(keys, deadline=None):
+    lookups.append([qid for qid, _ in keys])
+    return {}
+
+  monkeypatch.setattr(handler_base.entity_label_loader, 'aload_many', aload_many)
+  monkeypatch.setattr(handler_base.entity_label_loader, 'load_many', load_many)
+  for qid in ('Q12418', 'Q99999999'):
+    handler_base.entity_labels.pop(qid, None)
+
+  handler = _handler()
+  asyncio.run(handler._aprefetch_entity_labels(['Q12418', 'Q99999999']))
+  lm = handler._link_qids({'label': {'en': ['depicts']}, 'value': {'en': ['Q12418', 'Q99999999']}})
+
+  assert lookups == [['Q12418', 'Q99999999']]
+  assert lm['value']['en'] == [
+    '<a href="https://www.wikidata.org/wiki/Q12418">Mona Lisa</a>',
+    '<a href="https://www.wikidata.org/wiki/Q99999999">Q99999999</a>'
+  ]
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+import http_client
+import handlers.github
+
+class FakeResponse(object):
+
+  def __init__(self, status_code, body=None):
+    self.status_code = status_code
+    self.body = body
+
+  def json(self):
+    return self.body
+
+LISTINGS = {
+  '': [{'name': 'iiif-props.yaml', 'sha': 'root-props'}, {'name': 'README.md', 'sha': 'readme'}, {'name': 'dir', 'sha': 'dir-tree'}],
+  'dir': [{'name': 'img.jpg', 'sha': 'img'}, {'name': 'img.yaml', 'sha': 'img-props'}, {'name': 'other.jpg', 'sha': 'other'}]
+}
+
+@pytest.fixture
+def listings(monkeypatch):
+  '''Directory listings of repo a/b by path, a missing path is a 404 and None a failed request'''
+  listings = {path: [dict(item) for item in items] for path, items in LISTINGS.items()}
+  def get(url, **kwargs):
+    path = url.split('/repos/a/b/contents/', 1)[1].split('?')[0]
+    if path not in listings:
+      return FakeResponse(404)
+    return FakeResponse(503) if listings[path] is None else FakeResponse(200, listings[path])
+  async def aget(url, **kwargs):
+    return get(url, **kwargs)
+  monkeypatch.setattr(http_client, 'get', get)
+  monkeypatch.setattr(http_client, 'aget', aget)
+  return listings
+
+def _token(deadline=None):
+  return handlers.github.Handler('a/b/dir/img.jpg', defer_build=True).upstream_change_token(deadline)
+
+def _set_sha(listings, path, name, sha):
+  for item in listings[path]:
+    if item['name'] == name:
+      item['sha'] = sha
+
+def test_unrelated_changes_keep_the_token(listings):
+  token = _token()
+  _set_sha(listings, 'dir', 'other.jpg', 'other-2')
+  _set_sha(listings, '', 'README.md', 'readme-2')
+  _set_sha(listings, '', 'dir', 'dir-tree-2')
+  assert _token() == token
+
+@pytest.mark.parametrize('path,name', [('dir', 'img.jpg'), ('dir', 'img.yaml'), ('', 'iiif-props.yaml')])
+def test_image_and_props_changes_change_the_token(listings, path, name):
+  token = _token()
+  _set_sha(listings, path, name, 'changed')
+  assert _token() != token
+
+def test_added_props_file_changes_the_token(listings):
+  token = _token()
+  listings['dir'].append({'name': 'iiif-props.yaml', 'sha': 'dir-props'})
+  assert _token() != token
+
+def test_sync_and_async_tokens_agree(listings):
+  handler = handlers.github.Handler('a/b/dir/img.jpg', defer_build=True)
+  assert handler._change_token(handler._dir_shas(None)) == handler._change_token(asyncio.run(handler._adir_shas(None))) == _token()
+
+def test_failed_listing_gives_no_token(listings):
+  listings['dir'] = None
+  assert _token() is None
@@ -0,0 +1,151 @@
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+import http_cache
+import http_client
+from http_cache import HttpCache, revalidating
+
+
+def response(status_code=200, content=b'{}', **headers):
+  return SimpleNamespace(status_code=status_code, content=content, headers=dict((name.replace('_', '-'), value) for name, value in headers.items()))
+
+
+def test_max_age_response_is_served_while_fresh(monkeypatch):
+  cache = HttpCache()
+  clock = [1000.0]
+  monkeypatch.setattr(http_cache, 'now', lambda: clock[0])
+  cache.store('https://example.org/a', response(cache_control='max-age=60'))
+  entry = cache.lookup('https://example.org/a')
+  assert cache.serve(entry)
+  clock[0] += 61
+  assert not cache.serve(entry)
+
+
+def test_age_counts_against_freshness():
+  cache = HttpCache()
+  cache.store('https://example.org/a', response(cache_control='max-age=60', age='60', etag='"v1"'))
+  assert not cache.serve(cache.lookup('https://example.org/a'))
+
+
+def test_expires_and_last_modified_heuristic():
+  cache = HttpCache()
+  cache.store('https://example.org/expires', response(date=formatdate(usegmt=True), expires=formatdate(http_cache.now() + 120, usegmt=True)))
+  cache.store('https://example.org/modified', response(last_modified=formatdate(http_cache.now() - 86400, usegmt=True)))
+  assert cache.serve(cache.lookup('https://example.org/expires'))
+  # a tenth of the time since the last change, capped
+  entry = cache.lookup('https://example.org/modified')
+  assert cache.serve(entry) and entry.expires - entry.stored <= http_cache.HTTP_CACHE_HEURISTIC_MAX
+
+
+@pytest.mark.parametrize('cache_control', ['no-store', 'private', 'private, max-age=60', 'max-age=60, no-store'])
+def test_responses_not_to_be_shared_are_not_stored(cache_control):
+  cache = HttpCache()
+  cache.store('https://example.org/a', response(cache_control=cache_control, etag='"v1"'))
+  assert cache.lookup('https://example.org/a') is None
+
+
+def test_no_cache_response_is_stored_for_revalidation_only():
+  cache = HttpCache()
+  cache.store('https://example.org/a', response(cache_control='no-cache, max-age=60', etag='"v1"'))
+  entry = cache.lookup('https://example.org/a')
+  assert not cache.serve(entry)
+  assert entry.conditional_headers() == {'If-None-Match': '"v1"'}
+  # stale on arrival and without validators, there is nothing to keep
+  cache.store('https://example.org/b', response(cache_control='no-cache'))
+  assert cache.lookup('https://example.org/b') is None
+
+
+@pytest.mark.parametrize('status_code, stored', [(200, True), (404, True), (410, True), (500, False), (503, False)])
+def test_cacheable_status(status_code, stored):
+  cache = HttpCache()
+  cache.store('https://example.org/a', response(status_code, cache_control='max-age=60'))
+  entry = cache.lookup('https://example.org/a')
+  assert (entry is not None) == stored
+  if stored:
+    assert cache.serve(entry) and entry.response('GET').status_code == status_code
+
+
+def test_304_merges_new_validators_and_freshness():
+  cache = HttpCache()
+  cache.store('https://example.org/a', response(content=b'{"v": 1}', cache_control='max-age=0', etag='"v1"', content_type='application/json'))
+  entry = cache.lookup('https://example.org/a')
+  assert not cache.serve(entry)
+  cache.revalidate(entry, {'cache-control': 'max-age=60', 'etag': '"v2"'})
+  assert cache.serve(entry)
+  assert entry.headers['etag'] == '"v2"' and entry.headers['content-type'] == 'application/json'
+  assert entry.response('GET').json() == {'v': 1}
+
+
+def test_fresh_entries_are_revalidated_during_a_refresh():
+  cache = HttpCache()
+  cache.store('https://example.org/a', response(cache_control='max-age=60', etag='"v1"'))
+  entry = cache.lookup('https://example.org/a')
+  with revalidating():
+    assert not cache.serve(entry)
+    with revalidating(False):
+      assert cache.serve(entry)
+  assert cache.serve(entry)
+
+
+def test_entries_vary_by_authorization_and_vary_headers():
+  cache = HttpCache()
+  cache.store('https://example.org/a', response(cache_control='max-age=60', vary='Accept'), {'Accept': 'application/json', 'Authorization': 'token a'})
+  assert cache.lookup('https://example.org/a', {'Accept': 'application/json', 'Authorization': 'token a'}) is not None
+  assert cache.lookup('https://example.org/a', {'Accept': 'application/json', 'Authorization': 'token b'}) is None
+  assert cache.lookup('https://example.org/a', {'Accept': 'text/html', 'Authorization': 'token a'}) is None
+
+
+class _Handler(BaseHTTPRequestHandler):
+  '''Answers with an ETag and max-age=0, a matching If-None-Match gets a 304 with a longer max-age'''
+  protocol_version = 'HTTP/1.1'
+  requests = []
+
+  def do_GET(self):
+    self.requests.append(self.headers.get('If-None-Match'))
+    if self.headers.get('If-None-Match') == '"v1"':
+      self.send_response(304)
+      self.send_header('ETag', '"v1"')
+      self.send_header('Cache-Control', 'max-age=60')
+      self.end_headers()
+      return
+    body = b'{"ok": true}'
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', '"v1"')
+    self.send_header('Cache-Control', 'max-age=0')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+@pytest.fixture
+def server():
+  _Handler.requests = []
+  httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f'http://127.0.0.1:{httpd.server_address[1]}'
+  httpd.shutdown()
+  httpd.server_close()
+
+
+def test_http_client_revalidates_with_the_stored_validators(server):
+  url = f'{server}/revalidated'
+  first = http_client.get(url)
+  # stale at once, revalidated by a 304 that makes it fresh for a minute
+  second = http_client.get(url)
+  third = http_client.get(url)
+  assert first.json() == second.json() == third.json() == {'ok': True}
+  assert second.status_code == third.status_code == 200
+  assert _Handler.requests == [None, '"v1"']
+  with revalidating():
+    http_client.get(url)
+  assert _Handler.requests == [None, '"v1"', '"v1"']
+  http_cache.cache.invalidate(url)
@@ -0,0 +1,144 @@
+import asyncio
+import threading
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+import pytest
+
+import http_client
+from deadline import Deadline, DeadlineExceeded
+from handlers.handler_base import HandlerBase, entity_labels
+
+class _Handler(BaseHTTPRequestHandler):
+  '''Paths starting /sleep/<seconds> answer late, /hedge/<key> answers late to the first request only and
+  /fail-late/<key> answers late to the first request and drops the connection of the second'''
+  protocol_version = 'HTTP/1.1'
+  connections = set()
+  requests = Counter()
+  lock = threading.Lock()
+
+  def do_GET(self):
+    self.connections.add(self.client_address)
+    with self.lock:
+      self.requests[self.path] += 1
+      count = self.requests[self.path]
+    kind, arg = (self.path.split('/') + ['', ''])[1:3]
+    if kind == 'sleep':
+      sleep(float(arg))
+    elif kind == 'hedge' and count == 1:
+      sleep(2)
+    elif kind == 'fail-late':
+      sleep(3 if count == 1 else 0.4)
+      if count > 1:
+        self.close_connection = True
+        return
+    body = b'{"ok": true}'
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('Cache-Control', 'no-store')
+    self.end_headers()
+    try:
+      self.wfile.write(body)
+    except (BrokenPipeError, ConnectionResetError):
+      pass # the client gave up on a slow answer
+
+  def log_message(self, *args):
+    pass
+
+@pytest.fixture
+def server():
+  _Handler.connections = set()
+  _Handler.requests = Counter()
+  httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f'http://127.0.0.1:{httpd.server_address[1]}'
+  httpd.shutdown()
+  httpd.server_close()
+
+def test_client_is_shared():
+  assert http_client.client() is http_client.client()
+  assert http_client.client().headers['User-Agent'] == http_client.USER_AGENT
+
+def test_requests_reuse_keep_alive_connections(server):
+  for idx in range(5):
+    resp = http_client.get(f'{server}/item/{idx}')
+    assert resp.status_code == 200 and resp.json() == {'ok': True}
+  assert len(_Handler.connections) == 1
+
+def test_host_timeouts():
+  assert http_client._timeout('www.wikidata.org', None) == http_client.HOST_TIMEOUTS['www.wikidata.org']
+  assert http_client._timeout('example.org', None) == http_client.DEFAULT_TIMEOUT
+  assert http_client._timeout('example.org', None, 2) == (2, 2)
+
+@pytest.fixture
+def hedging(monkeypatch):
+  # hedges after 0.1s, whatever latencies earlier tests recorded for the local server
+  monkeypatch.setattr(http_client, 'HEDGE_AFTER', 0.1)
+  monkeypatch.setattr(http_client, '_latencies', defaultdict(lambda: deque(maxlen=200)))
+
+def test_sparql_queries_are_not_hedged():
+  assert not http_client._should_hedge('GET', 'query.wikidata.org', None)
+  assert http_client._should_hedge('GET', 'www.wikidata.org', None)
+  assert not http_client._should_hedge('POST', 'www.wikidata.org', None)
+
+def test_slow_request_is_answered_by_its_hedge(server, hedging):
+  start = monotonic()
+  resp = http_client.get(f'{server}/hedge/sync', hedge=True, deadline=Deadline(5))
+  assert resp.json() == {'ok': True}
+  assert monotonic() - start < 1
+  assert _Handler.requests['/hedge/sync'] == 2
+
+def test_slow_async_request_is_answered_by_its_hedge(server, hedging):
+  start = monotonic()
+  resp = asyncio.run(http_client.aget(f'{server}/hedge/async', hedge=True, deadline=Deadline(5)))
+  assert resp.json() == {'ok': True}
+  assert monotonic() - start < 1
+  assert _Handler.requests['/hedge/async'] == 2
+
+@pytest.mark.parametrize('hedge', [False, True])
+def test_deadline_exceeded_is_raised_within_the_budget(server, hedging, hedge):
+  start = monotonic()
+  with pytest.raises(DeadlineExceeded):
+    http_client.get(f'{server}/sleep/2/{hedge}', hedge=hedge, deadline=Deadline(0.3))
+  assert monotonic() - start < 0.8
+
+def test_async_deadline_exceeded_is_raised_within_the_budget(server, hedging):
+  start = monotonic()
+  with pytest.raises(DeadlineExceeded):
+    asyncio.run(http_client.aget(f'{server}/sleep/2/async', hedge=True, deadline=Deadline(0.3)))
+  assert monotonic() - start < 0.8
+
+def test_hedge_failing_late_does_not_extend_the_budget(server, hedging):
+  start = monotonic()
+  with pytest.raises(DeadlineExceeded):
+    http_client.get(f'{server}/fail-late/sync', hedge=True, deadline=Deadline(0.8))
+  assert monotonic() - start < 1.2
+  assert _Handler.requests['/fail-late/sync'] == 2
+
+def test_depicts_labels_are_skipped_once_the_budget_runs_short(server):
+  class Handler(HandlerBase):
+    def get_entity_labels(self, qids, language):
+      return {qid: http_client.get(f'{server}/sleep/2/{qid}', deadline=self.deadline).json() for qid in qids}
+
+  for qid in ('Q90000001', 'Q90000002'):
+    entity_labels.pop(qid, None)
+  handler = Handler('test', 'Example', defer_build=True)
+  handler.m = {'metadata': []}
+  # a lookup that runs into the deadline degrades the manifest instead of failing it
+  handler.deadline = Deadline(0.3)
+  handler.deadline.allows = lambda seconds=None: True
+  handler.add_metadata(handler._language_map('depicts', ['Q90000001']))
+  assert handler.degraded
+  assert _Handler.requests['/sleep/2/Q90000001'] == 1
+  # with too little budget left the lookup is not attempted at all
+  handler.deadline = Deadline(1)
+  handler.add_metadata(handler._language_map('depicts', ['Q90000002']))
+  assert _Handler.requests['/sleep/2/Q90000002'] == 0
+  # both are linked with the qid in place of the label
+  assert sorted(value for md in handler.m['metadata'] for value in md['value']['en']) == [
+    '<a href="https://www.wikidata.org/wiki/Q90000001">Q90000001</a>',
+    '<a href="https://www.wikidata.org/wiki/Q90000002">Q90000002</a>'
+  ]
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+from starlette.testclient import TestClient
+
+import main
+import rendition
+
+
+@pytest.fixture
+def client(monkeypatch):
+  sources = {}
+
+  async def get_rendition_async(mid, **kwargs):
+    client.loads += 1
+    return rendition.Rendition(sources[mid], kwargs['baseurl'], manifestid=mid)
+
+  monkeypatch.setattr(main, 'get_rendition_async', get_rendition_async)
+  client = TestClient(main.app)
+  client.sources = sources
+  client.loads = 0
+  return client
+
+
+def stored(client, manifestid, label):
+  _, template = rendition.store(json.dumps({'id': f'{{BASE_URL}}/{manifestid}/manifest.json', 'label': label}), None)
+  rendition.stored_as(manifestid, template)
+  client.sources[manifestid] = template
+
+
+@pytest.mark.parametrize('manifestid, label, encoding', [
+  ('wc:Small.jpg', 'small', None),          # under COMPRESS_MIN_BYTES the body is sent as is
+  ('wc:Large.jpg', 'large ' * 400, 'gzip')
+])
+def test_not_modified_repeats_the_etag_of_the_200(client, manifestid, label, encoding):
+  stored(client, manifestid, label)
+  headers = {'Accept-Encoding': 'gzip'}
+  ok = client.get(f'/{manifestid}/manifest.json', headers=headers)
+  assert ok.status_code == 200
+  assert ok.headers.get('content-encoding') == encoding
+  # the first revalidation is answered from the recorded digest, the second after loading the manifest
+  not_modified = client.get(f'/{manifestid}/manifest.json', headers=dict(headers, **{'If-None-Match': ok.headers['etag']}))
+  assert not_modified.status_code == 304
+  assert not_modified.headers['etag'] == ok.headers['etag']
+  assert client.loads == 1
+  rendition.served.pop(f'3|{client.base_url}|{manifestid}', None)
+  loaded = client.get(f'/{manifestid}/manifest.json', headers=dict(headers, **{'If-None-Match': ok.headers['etag']}))
+  assert loaded.status_code == 304
+  assert loaded.headers['etag'] == ok.headers['etag']
+  assert client.loads == 2
@@ -0,0 +1,94 @@
+from time import sleep
+
+import pytest
+from botocore.exceptions import ClientError
+
+import membership
+import s3
+from membership import BloomFilter, Membership
+
+
+def test_bloom_filter_has_no_false_negatives():
+  bloom = BloomFilter(capacity=1000, error_rate=0.01)
+  keys = [f'wc:File_{idx}.jpg' for idx in range(1000)]
+  for key in keys:
+    bloom.add(key)
+  assert all(key in bloom for key in keys)
+  false_positives = sum(f'wc:Other_{idx}.jpg' in bloom for idx in range(10000))
+  assert false_positives < 300
+
+
+def test_negative_answers_expire_sooner(monkeypatch):
+  monkeypatch.setattr(membership, 'MEMBERSHIP_NEGATIVE_TTL', 0.1)
+  known = Membership('test')
+  known.record('missing', False)
+  known.record('present', True)
+  assert known.lookup('missing') is False and known.lookup('present') is True
+  sleep(0.15)
+  # another worker may have created the object since, the bucket is asked again
+  assert known.lookup('missing') is None
+  assert known.lookup('present') is True
+  known.added('missing')
+  assert known.lookup('missing') is True
+
+
+def test_bloom_filter_rules_out_keys_missing_from_the_listing():
+  known = Membership('test', bloom=True)
+  assert known.needs_seed()
+  def listing():
+    yield 'a'
+    # put by this process while the listing runs
+    known.added('late')
+    yield 'b'
+  known.seed(listing())
+  assert not known.needs_seed()
+  assert known.lookup('never-stored') is False
+  assert known.stats()['bloom_negatives'] == 1
+  known.positive.clear()
+  # keys in the filter may be false positives, they are left to the bucket
+  assert known.lookup('a') is None and known.lookup('late') is None
+
+
+def test_bloom_filter_is_reseeded_when_stale(monkeypatch):
+  known = Membership('test', bloom=True)
+  known.seed(iter(['a']))
+  monkeypatch.setattr(membership, 'MEMBERSHIP_BLOOM_REFRESH', 0)
+  assert known.needs_seed()
+  assert known.lookup('never-stored') is None
+
+
+def test_exists_asks_s3_once_per_answer(make_bucket):
+  bucket = make_bucket()
+  bucket.s3.objects['present'] = (b'1', {'format': 'json'})
+  assert bucket.exists('present') and 'present' in bucket
+  assert not bucket.exists('missing') and 'missing' not in bucket
+  assert bucket.s3.calls['head_object'] == 2
+  assert bucket.metadata('present') == {'format': 'json'}
+  # a put or delete here updates the known answer
+  bucket.put('missing', b'2')
+  assert bucket.exists('missing')
+  del bucket['present']
+  assert not bucket.exists('present')
+  assert bucket.s3.calls['head_object'] == 2
+
+
+def test_head_errors_other_than_not_found_are_raised(make_bucket):
+  bucket = make_bucket()
+  def head_object(Bucket, Key):
+    raise ClientError({'Error': {'Code': '403', 'Message': 'Forbidden'}}, 'HeadObject')
+  bucket.s3.head_object = head_object
+  with pytest.raises(ClientError):
+    bucket.exists('forbidden')
+  # nothing is recorded for a failed lookup
+  assert bucket.membership.lookup('forbidden') is None
+
+
+def test_exists_seeds_the_bloom_filter_from_the_listing(make_bucket, monkeypatch):
+  monkeypatch.setattr(s3, 'run_background', lambda key, fn, *args: fn(*args))
+  bucket = make_bucket(membership_bloom=True)
+  bucket.s3.objects['listed'] = (b'1', {})
+  assert not bucket.exists('never-stored')
+  assert bucket.exists('listed')
+  assert bucket.s3.calls['list_objects_v2'] == 1
+  # only the key the filter could not rule out was looked up
+  assert bucket.s3.calls['head_object'] == 1
@@ -0,0 +1,93 @@
+from email.utils import formatdate
+from time import time
+from types import SimpleNamespace
+
+import pytest
+
+import rate_limit
+from deadline import Deadline, DeadlineExceeded
+from rate_limit import RateLimiter, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = [1000.0]
+  monkeypatch.setattr(rate_limit, 'monotonic', lambda: clock[0])
+  return clock
+
+
+def test_burst_then_refill_at_the_sustained_rate(clock):
+  bucket = TokenBucket(rate=2, burst=3)
+  assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+  # callers past the burst are granted tokens in arrival order, half a second apart
+  assert bucket.reserve() == pytest.approx(0.5)
+  assert bucket.reserve() == pytest.approx(1.0)
+  clock[0] += 10
+  assert bucket.reserve() == 0
+  assert bucket.tokens == pytest.approx(2) # refilled to the burst, never beyond
+
+
+def test_reservation_longer_than_max_wait_is_returned(clock):
+  bucket = TokenBucket(rate=1, burst=1)
+  bucket.reserve()
+  assert bucket.reserve(max_wait=0.5) is None
+  assert bucket.reserve(max_wait=1) == pytest.approx(1)
+
+
+def test_try_acquire_takes_spare_capacity_only(clock):
+  limiter = RateLimiter({'api.example.org': (1, 2)})
+  assert limiter.try_acquire('api.example.org')
+  assert limiter.try_acquire('api.example.org')
+  assert not limiter.try_acquire('api.example.org')
+  # a refused hedge does not push back the requests queued behind it
+  assert limiter.bucket('api.example.org').tokens == pytest.approx(0)
+  assert limiter.try_acquire('unlimited.example.org')
+
+
+def test_acquire_beyond_the_request_budget_raises(clock):
+  limiter = RateLimiter({'api.example.org': (1, 1)})
+  limiter.acquire('api.example.org', Deadline(5))
+  with pytest.raises(DeadlineExceeded):
+    limiter.acquire('api.example.org', Deadline(0.5))
+
+
+@pytest.mark.parametrize('retry_after, blocked', [('2', 2), (None, 1.0)])
+def test_retry_after_blocks_the_host(clock, retry_after, blocked):
+  bucket = TokenBucket(rate=10, burst=10)
+  headers = {'Retry-After': retry_after} if retry_after else {}
+  assert bucket.observe(429, headers) == blocked
+  assert bucket.reserve() == pytest.approx(blocked)
+  assert bucket.throttled == 1
+
+
+def test_retry_after_http_date(clock):
+  bucket = TokenBucket(rate=10, burst=10)
+  assert bucket.observe(503, {'Retry-After': formatdate(time() + 30, usegmt=True)}) == pytest.approx(30, abs=1.5)
+  # a Retry-After on a response that is not throttled does not block
+  assert TokenBucket(rate=10, burst=10).observe(200, {'Retry-After': '30'}) == 30
+
+
+def test_low_remaining_quota_blocks_until_reset(clock):
+  bucket = TokenBucket(rate=10, burst=10)
+  bucket.observe(200, {'X-RateLimit-Remaining': str(rate_limit.RATE_LIMIT_RESERVE), 'X-RateLimit-Reset': str(time() + 60)})
+  assert bucket.reserve() == pytest.approx(60, abs=1.5)
+
+
+def test_remaining_quota_is_spread_over_the_window(clock):
+  bucket = TokenBucket(rate=10, burst=10)
+  # reset as a delta in seconds, 105 requests left for 100 seconds
+  bucket.observe(200, {'X-RateLimit-Remaining': '105', 'X-RateLimit-Reset': '100'})
+  assert bucket.rate == pytest.approx(1.0)
+  bucket.observe(200, {'X-RateLimit-Remaining': '100000', 'X-RateLimit-Reset': '100'})
+  assert bucket.rate == 10 # never above the configured rate
+  bucket.observe(200, {'X-RateLimit-Remaining': 'many', 'X-RateLimit-Reset': '100'})
+  assert bucket.rate == 10
+
+
+def test_throttled_requests_are_retried_within_the_budget():
+  limiter = RateLimiter({})
+  throttled = SimpleNamespace(status_code=429)
+  assert limiter.should_retry(throttled, 1, Deadline(5))
+  assert not limiter.should_retry(throttled, 10, Deadline(5))
+  assert not limiter.should_retry(throttled, rate_limit.MAX_RETRY_AFTER + 1)
+  assert not limiter.should_retry(SimpleNamespace(status_code=200), 1, Deadline(5))
@@ -0,0 +1,47 @@
+import pytest
+import requests
+
+from deadline import DeadlineExceeded
+from negative_cache import negative_cache, SourceNotFound, SourceUnavailable
+import manifest
+
+
+@pytest.fixture
+def mid():
+  mid = 'met:test-record-failures'
+  negative_cache.clear(mid)
+  yield mid
+  negative_cache.clear(mid)
+
+
+def _fail(mid, exc):
+  with manifest._record_failures(mid):
+    raise exc
+
+
+@pytest.mark.parametrize('exc', [KeyError('title'), TypeError('bad operand'), AttributeError('props')])
+def test_programming_errors_propagate_unrecorded(mid, exc):
+  with pytest.raises(type(exc)):
+    _fail(mid, exc)
+  negative_cache.check(mid)
+
+
+def test_transport_error_is_recorded_as_unavailable(mid):
+  with pytest.raises(SourceUnavailable):
+    _fail(mid, requests.ConnectionError('connection reset'))
+  with pytest.raises(SourceUnavailable):
+    negative_cache.check(mid)
+
+
+def test_deadline_is_recorded_and_raised_as_is(mid):
+  with pytest.raises(DeadlineExceeded):
+    _fail(mid, DeadlineExceeded('GET https://collectionapi.metmuseum.org'))
+  with pytest.raises(SourceUnavailable):
+    negative_cache.check(mid)
+
+
+def test_missing_source_is_recorded(mid):
+  with pytest.raises(SourceNotFound):
+    _fail(mid, SourceNotFound(mid, 'object not found'))
+  with pytest.raises(SourceNotFound):
+    negative_cache.check(mid)
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+from urllib.parse import quote
+
+import pytest
+
+import manifest
+from refresh_scheduler import RefreshScheduler
+
+
+class FakeHandler(object):
+  builds_from_sourceid = True
+  built = []
+
+  def __init__(self, sourceid, **kwargs):
+    self.sourceid = sourceid
+    self.built.append(self)
+
+  @property
+  def manifestid(self):
+    return f'test:{quote(self.sourceid)}'
+
+  def refresh_ahead(self, lead):
+    return 600
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+  scheduler = RefreshScheduler(top_n=10, budget=10)
+  scheduler.refresh_fn = manifest.refresh_ahead
+  monkeypatch.setattr(manifest, 'refresh_scheduler', scheduler)
+  monkeypatch.setitem(manifest._handlers, 'test', FakeHandler)
+  FakeHandler.built = []
+  return scheduler
+
+
+def test_escaped_and_plain_ids_are_counted_and_refreshed_as_one(scheduler):
+  manifest._record_request('test:a b', SimpleNamespace(manifestid='test:a%20b'))
+  manifest._count_request('test:a b')
+  assert list(scheduler.hot) == ['test:a b']
+  assert scheduler._candidates() == ['test:a b']
+
+  scheduler._refresh('test:a b')
+  # the handler gets the sourceid once unquoted and so refreshes the manifest under the key it is cached as
+  assert [handler.sourceid for handler in FakeHandler.built] == ['a b']
+  assert FakeHandler.built[0].manifestid == 'test:a%20b'
+  assert scheduler.stats()['failed'] == 0
+
+
+def test_sources_built_from_a_url_are_not_scheduled(scheduler):
+  for _ in range(3):
+    manifest._count_request('edison:D8829AAD')
+  assert scheduler.hot == {}
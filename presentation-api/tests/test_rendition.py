@@ -0,0 +1,75 @@
+import gzip
+import json
+
+import rendition
+from s3 import Bucket
+
+
+MANIFEST = json.dumps({'id': '{BASE_URL}/wc:Example.jpg/manifest.json', 'label': {'en': ['Example ' * 200]}})
+
+
+def test_store_and_load_round_trip():
+  stored, template = rendition.store(MANIFEST, {'updated': None})
+  assert stored[:2] == b'\x1f\x8b'
+  loaded = rendition.load(stored, None)
+  assert loaded.text == MANIFEST
+  assert loaded.digest == template.digest
+  assert loaded.render('https://iiif.example.org').startswith(b'{"id": "https://iiif.example.org/wc:Example.jpg')
+
+
+def test_both_stored_forms_load_as_the_same_template():
+  stored, template = rendition.store(MANIFEST, None)
+  # a plain object stored before compression, and a gzipped one read back decompressed
+  for form in (MANIFEST.encode('utf-8'), gzip.decompress(stored), MANIFEST):
+    loaded = rendition.load(form, lambda m: {'label': m['label']['en'][0]})
+    assert loaded.text == MANIFEST
+    assert loaded.digest == template.digest
+
+
+def test_stored_metadata_marks_the_form():
+  stored, _ = rendition.store(MANIFEST, None)
+  assert rendition.stored_metadata(stored, {'change-token': '42'}) == {'change-token': '42', 'format': 'json+gzip'}
+  assert rendition.stored_metadata(MANIFEST.encode('utf-8')) == {'format': 'json'}
+
+
+class FakeS3(object):
+  def __init__(self):
+    self.puts = []
+
+  def put_object(self, **kwargs):
+    self.puts.append(kwargs)
+
+
+def test_gzipped_manifests_are_put_with_content_encoding():
+  bucket = Bucket('test-bucket')
+  bucket.s3 = FakeS3()
+  stored, _ = rendition.store(MANIFEST, None)
+  bucket.put_object('wc:Example.jpg', stored, rendition.stored_metadata(stored))
+  bucket.put_object('thumbnail.jpg', b'\xff\xd8', {})
+  gzipped, plain = bucket.s3.puts
+  assert gzipped['ContentEncoding'] == 'gzip' and gzipped['ContentType'] == 'application/json'
+  assert gzipped['Metadata'] == {'format': 'json+gzip'}
+  assert 'ContentEncoding' not in plain
+
+
+def test_etag_matches_any_coding_of_the_body():
+  digest = rendition.Rendition(rendition.Template(MANIFEST), 'https://iiif.example.org').digest
+  assert rendition.etag(digest) == f'"{digest}"'
+  assert rendition.etag(digest, 'gzip') == f'"{digest}-gzip"'
+  for if_none_match in (rendition.etag(digest), rendition.etag(digest, 'br'), f'W/{rendition.etag(digest, "gzip")}', f'"other", "{digest}"', '*'):
+    assert rendition.etag_matches(if_none_match, digest)
+  assert not rendition.etag_matches('"other-gzip"', digest)
+  assert not rendition.etag_matches(None, digest)
+  assert not rendition.etag_matches('*', None)
+
+
+def test_known_digest_follows_the_stored_template():
+  _, template = rendition.store(MANIFEST, None)
+  rendition.stored_as('wc:Example.jpg', template)
+  response = rendition.Rendition(template, 'https://iiif.example.org', manifestid='wc:Example.jpg')
+  rendition.remember('wc:Example.jpg|https://iiif.example.org|3', response, response)
+  assert rendition.known_digest('wc:Example.jpg|https://iiif.example.org|3') == ('wc:Example.jpg', response.digest, len(response.body))
+  # a rebuilt manifest stored under the id makes the remembered response stale
+  _, rebuilt = rendition.store(MANIFEST.replace('Example', 'Rebuilt'), None)
+  rendition.stored_as('wc:Example.jpg', rebuilt)
+  assert rendition.known_digest('wc:Example.jpg|https://iiif.example.org|3') == (None, None, None)
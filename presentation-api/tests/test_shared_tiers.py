@@ -0,0 +1,51 @@
+import pickle
+
+import pytest
+
+import snapshot
+from shared_cache import SharedCache
+
+
+class Exploit(object):
+  def __reduce__(self):
+    return (pytest.fail, ('a pickled value was loaded',))
+
+
+def test_shared_cache_round_trips_without_pickle(tmp_path):
+  cache = SharedCache('test', 1024 * 1024, cache_dir=str(tmp_path))
+  values = {'bytes': b'\x1f\x8b body', 'text': 'label', 'json': {'digest': 'abc', 'type': 'Image'}, 'served': ('wc:File.jpg', 'a', 'b')}
+  for key, value in values.items():
+    cache[key] = value
+  assert cache['bytes'] == b'\x1f\x8b body'
+  assert cache['text'] == 'label'
+  assert cache['json'] == {'digest': 'abc', 'type': 'Image'}
+  # tuples come back as lists, readers only index into them
+  assert cache['served'] == ['wc:File.jpg', 'a', 'b']
+
+
+def test_shared_cache_skips_values_json_cannot_hold(tmp_path):
+  cache = SharedCache('test', 1024 * 1024, cache_dir=str(tmp_path))
+  cache['key'] = object()
+  assert cache.get('key') is None
+
+
+def test_redis_tier_ignores_pickled_entries():
+  fakeredis = pytest.importorskip('fakeredis')
+  from redis_cache import RedisCache
+  redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+  cache = RedisCache('test', redis, 1024 * 1024)
+  redis.set(cache._key('key'), b'P' + pickle.dumps(Exploit()))
+  assert cache.get('key') is None
+  cache['key'] = {'label': 'x'}
+  assert cache.get_entry('key')[0] == {'label': 'x'}
+
+
+def test_snapshot_export_reads_the_shared_cache(tmp_path):
+  cache = SharedCache('entity_labels', 1024 * 1024, cache_dir=str(tmp_path))
+  cache['Q12418'] = 'Mona Lisa'
+  cache['summary'] = {'type': 'Image'}
+  path = str(tmp_path / 'cache.snapshot')
+  assert snapshot.export_shared_caches(path, 10, caches=('entity_labels',), cache_dir=str(tmp_path)) == 2
+  tier = snapshot.SnapshotTier(snapshot.Snapshot(path), 'entity_labels')
+  assert tier.get('Q12418') == 'Mona Lisa'
+  assert tier.get('summary') == {'type': 'Image'}
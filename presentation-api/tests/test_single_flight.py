@@ -0,0 +1,88 @@
+import asyncio
+import threading
+from time import sleep
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def _leader_and_followers(flight, fn, followers=3):
+  '''Runs a leader that blocks in fn until every follower has joined, returns each caller's result or error'''
+  started, joined = threading.Event(), threading.Event()
+  outcomes = []
+
+  def build(peer_built):
+    started.set()
+    joined.wait(5)
+    return fn()
+
+  def call(build):
+    try:
+      outcomes.append(flight.do('key', build))
+    except Exception as exc:
+      outcomes.append(exc)
+
+  leader = threading.Thread(target=call, args=(build,))
+  leader.start()
+  started.wait(5)
+  threads = [threading.Thread(target=call, args=(lambda peer_built: pytest.fail('follower built'),)) for _ in range(followers)]
+  for thread in threads:
+    thread.start()
+  while flight.stats()['followers'] < followers:
+    sleep(0.001)
+  joined.set()
+  for thread in [leader] + threads:
+    thread.join()
+  return outcomes
+
+
+def test_followers_share_a_copy_of_the_leader_result(tmp_path):
+  flight = SingleFlight('test', lock_dir=str(tmp_path))
+  outcomes = _leader_and_followers(flight, lambda: {'id': 'manifest'})
+  assert outcomes == [{'id': 'manifest'}] * 4
+  assert len(set(id(outcome) for outcome in outcomes)) == 4
+  assert flight.stats() == {'in_flight': 0, 'leaders': 1, 'followers': 3, 'peer_waits': 0}
+
+
+def test_followers_get_the_leader_error(tmp_path):
+  flight = SingleFlight('test', lock_dir=str(tmp_path))
+
+  def fail():
+    raise RuntimeError('upstream down')
+
+  outcomes = _leader_and_followers(flight, fail)
+  assert len(outcomes) == 4
+  assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+  # the failed flight is not kept, the next call builds again
+  assert flight.do('key', lambda peer_built: 'rebuilt') == 'rebuilt'
+
+
+def test_async_follower_gets_leader_result(tmp_path):
+  flight = SingleFlight('test', lock_dir=str(tmp_path))
+  builds = []
+
+  async def build(peer_built):
+    builds.append(peer_built)
+    await asyncio.sleep(0.05)
+    return ['canvas']
+
+  async def calls():
+    return await asyncio.gather(flight.ado('key', build), flight.ado('key', build))
+
+  assert asyncio.run(calls()) == [['canvas'], ['canvas']]
+  assert builds == [False]
+
+
+def test_peer_lease_is_reported_to_the_waiting_worker(tmp_path):
+  # two instances stand in for two worker processes sharing the lock directory
+  first, second = SingleFlight('test', lock_dir=str(tmp_path)), SingleFlight('test', lock_dir=str(tmp_path))
+  with first._lease('key', None) as peer_built:
+    assert peer_built is False
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(second.do('key', lambda peer_built: peer_built)))
+    waiter.start()
+    while second.stats()['peer_waits'] == 0:
+      sleep(0.001)
+  waiter.join()
+  assert results == [True]
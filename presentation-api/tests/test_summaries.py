@@ -0,0 +1,93 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from time import time
+from types import SimpleNamespace
+
+import pytest
+
+import manifest
+from handlers.handler_base import SOFT_TTL_DAYS, HARD_TTL_DAYS, TIMESTAMP_FORMAT
+from handlers.wikimedia_commons import Handler
+from negative_cache import negative_cache, SourceNotFound
+from rendition import Template
+from summaries import summaries
+
+SERVICE = 'https://iiif.example.org/image/abc'
+
+
+def summary(**values):
+  return dict({'service_id': SERVICE, 'type': 'Image', 'width': 100, 'height': 100,
+               'thumbnail': 'https://example.org/thumb.jpg', 'image_url': 'https://example.org/full.jpg'}, **values)
+
+
+def record(manifestid, due, expires=None, **values):
+  template = Template(json.dumps({'id': manifestid}), facts={'summary': summary(**values)})
+  summaries.record(manifestid, template, due=due, expires=expires)
+
+
+@pytest.fixture
+def scheduled(monkeypatch):
+  scheduled = []
+  monkeypatch.setattr(manifest, 'run_background', lambda key, fn, *args: scheduled.append((key, fn, args)))
+  return scheduled
+
+
+def test_current_summary_is_served_without_revalidating(scheduled):
+  record('wc:Current.jpg', due=time() + 3600)
+  assert manifest._known_summary('wc:Current.jpg')['service_id'] == SERVICE
+  assert scheduled == []
+
+
+def test_summary_due_for_revalidation_is_served_while_the_manifest_is_revalidated(scheduled):
+  record('wc:Stale.jpg', due=time() - 1)
+  assert manifest._known_summary('wc:Stale.jpg')['service_id'] == SERVICE
+  assert scheduled == [('rebuild:wc:Stale.jpg', manifest.refresh_ahead, ('wc:Stale.jpg', 0))]
+
+
+def test_summary_past_the_hard_ttl_is_not_served(scheduled):
+  record('wc:Expired.jpg', due=time() - 1, expires=time() - 1)
+  assert manifest._known_summary('wc:Expired.jpg') is None
+
+
+def test_failed_manifest_fails_fast_on_the_summary_path():
+  record('wc:Missing.jpg', due=time() + 3600)
+  negative_cache.record('wc:Missing.jpg', SourceNotFound('wc:Missing.jpg', 'file not found'))
+  try:
+    with pytest.raises(SourceNotFound):
+      manifest._known_summary('wc:Missing.jpg')
+  finally:
+    negative_cache.clear('wc:Missing.jpg')
+
+
+def test_summary_without_a_service_is_taken_from_the_rendition(monkeypatch):
+  record('wc:Unconverted.jpg', due=time() + 3600, service_id=None)
+  served = {'items': [{'type': 'Canvas', 'items': [{'type': 'AnnotationPage', 'items': [
+    {'type': 'Annotation', 'motivation': 'painting', 'body': {'type': 'Image', 'service': [{'id': '{BASE_URL}/image/abc'}]}}]}]}]}
+
+  async def get_rendition_async(mid, **kwargs):
+    return SimpleNamespace(manifestid=None, manifest=served)
+
+  monkeypatch.setattr(manifest, 'get_rendition_async', get_rendition_async)
+  found = asyncio.run(manifest.get_summary_async('wc:Unconverted.jpg', baseurl='https://iiif.example.org'))
+  assert found['service_id'] == 'https://iiif.example.org/image/abc'
+
+
+def handler(sourceid):
+  handler = Handler.__new__(Handler)
+  handler.source, handler.sourceid = 'wc', sourceid
+  return handler
+
+
+def test_summaries_are_recorded_with_the_manifest_ttls():
+  updated = datetime.now() - timedelta(days=SOFT_TTL_DAYS + 1)
+  facts = {'updated': updated.strftime(TIMESTAMP_FORMAT), 'summary': summary()}
+  stale = handler('Old.jpg')
+  assert stale._check_ttls(Template(json.dumps({'id': 'wc:Old.jpg'}), facts=facts), None)
+  assert stale.stale
+  recorded = summaries.get('wc:Old.jpg')
+  assert summaries.due(recorded) and recorded['expires'] > time()
+
+  facts['updated'] = (datetime.now() - timedelta(days=HARD_TTL_DAYS + 2)).strftime(TIMESTAMP_FORMAT)
+  assert not handler('Ancient.jpg')._check_ttls(Template(json.dumps({'id': 'wc:Ancient.jpg'}), facts=facts), None)
+  assert summaries.get('wc:Ancient.jpg') is None
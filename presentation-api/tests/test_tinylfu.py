@@ -0,0 +1,51 @@
+from tinylfu import TinyLFUCache
+
+
+def _full_cache():
+  '''Main segments filled with k0..k8 in probation, k0 least recent, candidate x waiting in the window'''
+  cache = TinyLFUCache(1000, window_ratio=0.1)
+  for idx in range(9):
+    cache[f'k{idx}'] = 'v' * 100
+  cache['x'] = 'v' * 100
+  assert list(cache.probation) == [f'k{idx}' for idx in range(9)]
+  assert list(cache.window) == ['x']
+  return cache
+
+
+def test_rejected_candidate_evicts_nothing():
+  cache = _full_cache()
+  cache.sketch.add('k0')
+  cache['y'] = 'v' * 100
+  assert 'x' not in cache
+  assert list(cache.probation) == [f'k{idx}' for idx in range(9)]
+  assert cache.stats()['rejections'] == 1
+  assert cache.stats()['evictions'] == 0
+
+
+def test_admitted_candidate_evicts_the_first_victim():
+  cache = _full_cache()
+  for _ in range(3):
+    cache.sketch.add('x')
+  cache.sketch.add('k0')
+  cache['y'] = 'v' * 100
+  assert 'x' in cache and 'k0' not in cache
+  assert list(cache.probation) == [f'k{idx}' for idx in range(1, 9)] + ['x']
+  assert cache.stats()['evictions'] == 1
+  assert cache.bytes <= cache.max_bytes
+
+
+def test_candidate_is_only_compared_with_the_first_victim():
+  cache = TinyLFUCache(1000, window_ratio=0.1)
+  cache['cold'] = 'v' * 50
+  cache['hot'] = 'v' * 50
+  for idx in range(8):
+    cache[f'k{idx}'] = 'v' * 100
+  cache['x'] = 'v' * 100
+  for _ in range(3):
+    cache.sketch.add('hot')
+  cache.sketch.add('x')
+  cache['y'] = 'v' * 100
+  # x outranks the first victim and takes the room of both small entries
+  assert 'x' in cache
+  assert 'cold' not in cache and 'hot' not in cache
+  assert cache.bytes <= cache.max_bytes
@@ -0,0 +1,138 @@
+import os
+import subprocess
+import sys
+import textwrap
+from time import monotonic, sleep
+
+import pytest
+
+import s3
+import write_behind as write_behind_module
+from write_behind import WriteBehind
+
+
+@pytest.fixture
+def queue(monkeypatch):
+  '''A write-behind queue of its own, flushed only when a test asks for it'''
+  monkeypatch.setattr(write_behind_module, 'WRITE_BEHIND_INTERVAL', 60)
+  queue = WriteBehind()
+  monkeypatch.setattr(s3, 'write_behind', queue)
+  yield queue
+  queue.stop(timeout=1)
+
+
+def test_flush_writes_the_latest_put_of_each_key(queue, make_bucket):
+  bucket = make_bucket(write_behind=True)
+  bucket.put('a', b'1', {'format': 'json'})
+  bucket.put('a', b'2', {'format': 'json'})
+  bucket.put('b', b'3')
+  assert bucket.s3.objects == {}
+  assert queue.flush() == 0
+  assert bucket.s3.objects == {'a': (b'2', {'format': 'json'}), 'b': (b'3', {})}
+  assert bucket.s3.calls['put_object'] == 2
+  assert queue.stats()['coalesced'] == 1 and queue.stats()['pending'] == 0
+
+
+def test_flusher_writes_in_the_background(monkeypatch, make_bucket):
+  monkeypatch.setattr(write_behind_module, 'WRITE_BEHIND_INTERVAL', 0.05)
+  queue = WriteBehind()
+  monkeypatch.setattr(s3, 'write_behind', queue)
+  bucket = make_bucket(write_behind=True)
+  bucket.put('a', b'1')
+  start = monotonic()
+  while 'a' not in bucket.s3.objects and monotonic() - start < 2:
+    sleep(0.01)
+  assert bucket.s3.objects['a'] == (b'1', {})
+  queue.stop(timeout=1)
+
+
+def test_failed_writes_are_retried_with_backoff(queue, make_bucket):
+  bucket = make_bucket(write_behind=True)
+  bucket.s3.fail_puts = 2
+  bucket.put('a', b'1')
+  write = queue.get(bucket.bucket_name, 'a')
+  with queue.cond:
+    taken = queue._take(1)
+  queue._write(taken[0])
+  # the next attempt waits for the backoff, doubling with every failure
+  assert write.attempts == 1 and write.due > monotonic() + write_behind_module.WRITE_BEHIND_INTERVAL
+  with queue.cond:
+    assert queue._take(1) == []
+  # an explicit flush does not wait for the backoff
+  assert queue.flush() == 0
+  assert bucket.s3.objects['a'] == (b'1', {})
+  assert bucket.s3.calls['put_object'] == 3 and queue.stats()['retries'] == 2
+
+
+def test_write_is_dropped_after_the_last_attempt(queue, make_bucket, monkeypatch):
+  monkeypatch.setattr(write_behind_module, 'WRITE_BEHIND_ATTEMPTS', 3)
+  bucket = make_bucket(write_behind=True)
+  bucket.s3.fail_puts = 10
+  bucket.put('a', b'1')
+  assert queue.flush() == 0
+  assert bucket.s3.calls['put_object'] == 3
+  assert queue.stats()['dropped'] == 1 and queue.get(bucket.bucket_name, 'a') is None
+
+
+def test_newer_put_queued_during_a_failed_write_is_kept(queue, make_bucket):
+  bucket = make_bucket(write_behind=True)
+  bucket.s3.fail_puts = 1
+  bucket.put('a', b'1')
+  with queue.cond:
+    taken = queue._take(1)
+  bucket.put('a', b'2')
+  queue._write(taken[0])
+  assert queue.get(bucket.bucket_name, 'a').obj == b'2'
+  queue.flush()
+  assert bucket.s3.objects['a'] == (b'2', {})
+
+
+def test_pending_writes_are_read_back_before_they_reach_s3(queue, make_bucket):
+  bucket = make_bucket(write_behind=True)
+  bucket.s3.objects['a'] = (b'old', {'format': 'json'})
+  bucket.put('a', b'new', {'format': 'json+gzip'})
+  bucket.put('b', b'only pending')
+  # past the cache tiers, the pending write is newer than what S3 holds
+  bucket._local_metadata.pop('a', None)
+  bucket._local_metadata.pop('b', None)
+  assert bucket.get('a', refresh=True) == b'new'
+  assert bucket.metadata('a') == {'format': 'json+gzip'}
+  assert bucket.exists('b') and bucket.metadata('b') == {}
+  assert bucket.get('b', refresh=True) == b'only pending'
+  assert bucket.s3.calls['get_object'] == bucket.s3.calls['head_object'] == 0
+  del bucket['b']
+  assert queue.get(bucket.bucket_name, 'b') is None
+
+
+def test_puts_are_synchronous_once_stopped_or_full(queue, make_bucket, monkeypatch):
+  bucket = make_bucket(write_behind=True)
+  bucket.put('a', b'1')
+  assert queue.stop(timeout=1) == 0
+  assert bucket.s3.objects['a'] == (b'1', {})
+  bucket.put('b', b'2')
+  assert bucket.s3.objects['b'] == (b'2', {})
+  monkeypatch.setattr(write_behind_module, 'WRITE_BEHIND_MAX_BYTES', 4)
+  full = WriteBehind()
+  assert full.put(bucket, 'c', b'12345', {}) is False
+  assert full.stats()['synchronous'] == 1
+
+
+def test_pending_writes_are_drained_at_exit(tmp_path):
+  # a worker exiting without the shutdown event still persists what it queued
+  written = tmp_path / 'written'
+  script = textwrap.dedent(f'''
+    import sys
+    sys.path.insert(0, {os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')!r})
+    import write_behind
+
+    class Bucket(object):
+      bucket_name = 'test'
+      def put_object(self, key, obj, metadata):
+        with open({str(written)!r}, 'w') as fp:
+          fp.write(obj)
+
+    write_behind.WRITE_BEHIND_INTERVAL = 60
+    assert write_behind.write_behind.put(Bucket(), 'a', 'persisted', {{}})
+  ''')
+  subprocess.run([sys.executable, '-c', script], check=True, timeout=30)
+  assert written.read_text() == 'persisted'